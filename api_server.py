@@ -1,5 +1,6 @@
-from fastapi import FastAPI, HTTPException, Depends, Header, Query
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers, MutableHeaders
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 import uvicorn
@@ -10,15 +11,35 @@ import json
 from datetime import datetime, timedelta, date, timezone
 import re
 from functools import lru_cache
+from collections import OrderedDict
+from abc import ABC, abstractmethod
+import asyncio
+import contextvars
 import hashlib
+import hmac
 import time
 from sqlalchemy import text
+import gzip
+
+# Быстрая сериализация JSON (orjson) и сжатие brotli — если пакеты установлены,
+# иначе стандартный json и только gzip
+try:
+    import orjson
+    from fastapi.responses import ORJSONResponse as DefaultJSONResponse
+except ImportError:
+    orjson = None
+    from fastapi.responses import JSONResponse as DefaultJSONResponse
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # Загрузка переменных окружения
 load_dotenv()
 
 app = FastAPI(title="Telegram Bot WebApp API", 
-              description="API для интеграции WebApp с Telegram ботом трекера питания")
+              description="API для интеграции WebApp с Telegram ботом трекера питания",
+              default_response_class=DefaultJSONResponse)
 
 # Настройка CORS для доступа с Netlify
 app.add_middleware(
@@ -29,91 +50,745 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Простая система кэширования для оптимизации API запросов
+# Сжатие ответов: меньше этого размера (байт) ответ отдаётся как есть
+API_COMPRESSION_MIN_SIZE = int(os.getenv("API_COMPRESSION_MIN_SIZE", "1024"))
+# Сжимаются только текстовые ответы: фото блюд уже сжаты (JPEG/WebP)
+COMPRESSIBLE_CONTENT_TYPES = ("application/json", "text/")
+
+def choose_content_encoding(accept_encoding: str) -> Optional[str]:
+    """Выбирает сжатие по Accept-Encoding клиента: brotli (если доступен), затем gzip"""
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        token, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(token.strip())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+class CompressionMiddleware:
+    """
+    Сжимает текстовые ответы (gzip или brotli по Accept-Encoding) больше minimum_size.
+    Vary: Accept-Encoding ставится на все текстовые ответы, в том числе отданные без сжатия.
+    Тело ответа собирается целиком — у API нет потоковых JSON-ответов
+    """
+    def __init__(self, app, minimum_size: int = API_COMPRESSION_MIN_SIZE, gzip_level: int = 6, brotli_quality: int = 5):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+    
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level)
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_content_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        
+        start_message = None
+        passthrough = False
+        chunks = []
+        
+        async def send_compressed(message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                content_type = headers.get("content-type", "")
+                passthrough = "content-encoding" in headers or not content_type.startswith(COMPRESSIBLE_CONTENT_TYPES)
+                if not passthrough:
+                    # Ответ зависит от Accept-Encoding, даже если отдаётся без сжатия:
+                    # иначе прокси может отдать несжатую копию клиенту с gzip и наоборот
+                    MutableHeaders(raw=message["headers"]).add_vary_header("Accept-Encoding")
+                    passthrough = encoding is None
+                if passthrough:
+                    await send(message)
+                else:
+                    start_message = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                await send(message)
+                return
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            body = b"".join(chunks)
+            if len(body) >= self.minimum_size:
+                body = self.compress(body, encoding)
+                headers = MutableHeaders(raw=start_message["headers"])
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(body))
+            await send(start_message)
+            await send({"type": "http.response.body", "body": body})
+        
+        await self.app(scope, receive, send_compressed)
+
+app.add_middleware(CompressionMiddleware)
+
+# Кэширование ответов API. Хранилище кэша подключаемое (API_CACHE_BACKEND):
+#   memory   — в памяти процесса, LRU + TTL, ограничено по числу записей и объёму (по умолчанию);
+#   postgres — общая UNLOGGED-таблица в БД бота: все воркеры uvicorn видят одни и те же
+#              записи, и очистка кэша пользователя в одном воркере действует во всех
+API_CACHE_BACKEND = os.getenv("API_CACHE_BACKEND", "memory")
+API_CACHE_MAX_ENTRIES = int(os.getenv("API_CACHE_MAX_ENTRIES", "5000"))
+API_CACHE_MAX_BYTES = int(os.getenv("API_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Как часто фоновая задача удаляет устаревшие записи (секунды)
+API_CACHE_SWEEP_INTERVAL = int(os.getenv("API_CACHE_SWEEP_INTERVAL", "60"))
+# Сколько секунд эндпоинты переиспользуют уже загруженные профиль и записи дня (см. APICache.load_shared)
+API_SHARED_LOAD_WINDOW = float(os.getenv("API_SHARED_LOAD_WINDOW", "2"))
+# Stale-while-revalidate по префиксу ключа: сколько секунд после TTL ещё можно отдавать
+# устаревшее значение, пересчитывая его в фоне. Дальше — обычный промах с синхронным расчётом
+API_CACHE_STALE_TTL = {
+    "stats": 1800,
+    "diary": 600,
+}
+
+class CacheBackend(ABC):
+    """
+    Интерфейс хранилища кэша API. Значения — JSON-совместимые записи APICache
+    ({"fresh_until", "value", "tag"}), у каждой есть теги (пользователь, дата), по которым
+    она инвалидируется. TTL хранилища включает допустимую устарелость (stale-while-revalidate)
+    """
+    name = "base"
+    local = False  # хранилище только этого процесса (его не обновляют другие воркеры)
+    
+    @abstractmethod
+    async def get(self, key: str):
+        """Значение по ключу или None, если его нет или оно устарело"""
+        ...
+    
+    @abstractmethod
+    async def set(self, key: str, value, ttl: int, tags: tuple):
+        """Сохраняет значение на ttl секунд с тегами"""
+        ...
+    
+    @abstractmethod
+    async def delete_tags(self, tags):
+        """Удаляет все записи, у которых есть хотя бы один из тегов"""
+        ...
+    
+    @abstractmethod
+    async def purge_expired(self) -> int:
+        """Удаляет устаревшие записи, возвращает их количество"""
+        ...
+    
+    @abstractmethod
+    async def stats(self) -> dict:
+        """Размер и счётчики хранилища для /api/cache/stats"""
+        ...
+
+def cache_value_size(value) -> int:
+    """Примерный размер значения кэша в байтах — по его JSON-представлению"""
+    return len(json.dumps(value, ensure_ascii=False, default=str).encode("utf-8"))
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    Кэш в памяти процесса: TTL, индекс ключей по тегам и вытеснение давно
+    не использованных записей (LRU) при превышении лимита записей или байт
+    """
+    name = "memory"
+    local = True
+    
+    def __init__(self, max_entries: int = API_CACHE_MAX_ENTRIES, max_bytes: int = API_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (expires_at, tags, value, size), порядок — от давно использованных
+        self.tag_keys = {}  # tag -> set(key)
+        self.bytes = 0
+        self.evictions = 0
+        self.expired = 0
+    
+    def _remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.bytes -= entry[3]
+            for tag in entry[1]:
+                keys = self.tag_keys.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.tag_keys[tag]
+    
+    async def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.time() >= entry[0]:
+            self._remove(key)
+            self.expired += 1
+            return None
+        self.entries.move_to_end(key)
+        return entry[2]
+    
+    async def set(self, key: str, value, ttl: int, tags: tuple):
+        self._remove(key)
+        size = cache_value_size(value)
+        if size > self.max_bytes:
+            # Значение больше всего кэша — не кэшируем, чтобы не вытеснить всё остальное
+            self.evictions += 1
+            return
+        self.entries[key] = (time.time() + ttl, tags, value, size)
+        self.bytes += size
+        for tag in tags:
+            self.tag_keys.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+    
+    async def delete_tags(self, tags):
+        keys = set()
+        for tag in tags:
+            keys |= self.tag_keys.get(tag, set())
+        for key in keys:
+            self._remove(key)
+    
+    async def clear(self):
+        self.entries.clear()
+        self.tag_keys.clear()
+        self.bytes = 0
+    
+    async def purge_expired(self) -> int:
+        now = time.time()
+        expired = [key for key, entry in self.entries.items() if now >= entry[0]]
+        for key in expired:
+            self._remove(key)
+        self.expired += len(expired)
+        return len(expired)
+    
+    async def stats(self) -> dict:
+        now = time.time()
+        return {
+            "backend": self.name,
+            "cache_size": len(self.entries),
+            "max_entries": self.max_entries,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "tags": len(self.tag_keys),
+            "cache_keys": list(self.entries.keys())[-10:],  # 10 последних использованных ключей
+            "ttl_info": {k: entry[0] - now for k, entry in list(self.entries.items())[-5:]}
+        }
+
+class PostgresCacheBackend(CacheBackend):
+    """
+    Общий кэш для всех воркеров в UNLOGGED-таблице (без WAL: быстрые записи,
+    после аварийного перезапуска БД таблица просто очищается — для кэша это допустимо).
+    Теги хранятся массивом с GIN-индексом
+    """
+    name = "postgres"
+    
+    def __init__(self, table: str = "api_cache"):
+        self.table = table
+        self._ready = False
+        self._ready_lock = asyncio.Lock()
+    
+    async def _session(self):
+        sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+        from bot import async_session
+        if not self._ready:
+            async with self._ready_lock:
+                if not self._ready:
+                    async with async_session() as session:
+                        await session.execute(text(
+                            f"CREATE UNLOGGED TABLE IF NOT EXISTS {self.table} ("
+                            "key TEXT PRIMARY KEY, tags TEXT[] NOT NULL DEFAULT '{}', "
+                            "value TEXT NOT NULL, expires_at DOUBLE PRECISION NOT NULL)"
+                        ))
+                        await session.execute(text(
+                            f"CREATE INDEX IF NOT EXISTS ix_{self.table}_tags ON {self.table} USING GIN (tags)"
+                        ))
+                        await session.commit()
+                    self._ready = True
+        return async_session()
+    
+    async def get(self, key: str):
+        async with await self._session() as session:
+            result = await session.execute(
+                text(f"SELECT value FROM {self.table} WHERE key = :key AND expires_at > :now"),
+                {"key": key, "now": time.time()}
+            )
+            row = result.first()
+        return json.loads(row[0]) if row else None
+    
+    async def set(self, key: str, value, ttl: int, tags: tuple):
+        async with await self._session() as session:
+            await session.execute(
+                text(
+                    f"INSERT INTO {self.table} (key, tags, value, expires_at) "
+                    "VALUES (:key, :tags, :value, :expires_at) "
+                    "ON CONFLICT (key) DO UPDATE SET tags = EXCLUDED.tags, "
+                    "value = EXCLUDED.value, expires_at = EXCLUDED.expires_at"
+                ),
+                {
+                    "key": key,
+                    "tags": list(tags),
+                    "value": json.dumps(value, ensure_ascii=False, default=str),
+                    "expires_at": time.time() + ttl
+                }
+            )
+            await session.commit()
+    
+    async def delete_tags(self, tags):
+        async with await self._session() as session:
+            await session.execute(
+                text(f"DELETE FROM {self.table} WHERE tags && CAST(:tags AS TEXT[])"),
+                {"tags": list(tags)}
+            )
+            await session.commit()
+    
+    async def purge_expired(self) -> int:
+        async with await self._session() as session:
+            result = await session.execute(
+                text(f"DELETE FROM {self.table} WHERE expires_at <= :now"), {"now": time.time()}
+            )
+            await session.commit()
+        return result.rowcount
+    
+    async def stats(self) -> dict:
+        async with await self._session() as session:
+            result = await session.execute(
+                text(
+                    "SELECT count(*), count(*) FILTER (WHERE expires_at <= :now), "
+                    f"coalesce(sum(octet_length(value)), 0), pg_total_relation_size('{self.table}') FROM {self.table}"
+                ),
+                {"now": time.time()}
+            )
+            total, expired, value_bytes, table_bytes = result.first()
+        return {
+            "backend": self.name,
+            "cache_size": total,
+            "expired_pending": expired,
+            "bytes": value_bytes,
+            "table_bytes": table_bytes
+        }
+
+CACHE_BACKENDS = {
+    "memory": MemoryCacheBackend,
+    "postgres": PostgresCacheBackend,
+}
+
+# Расчёт значения в single_flight: (user_id, поколение кэша пользователя на момент старта,
+# тег версии данных, по которой считается значение — см. current_data_tag)
+api_cache_build = contextvars.ContextVar("api_cache_build", default=None)
+
 class APICache:
-    def __init__(self):
-        self.cache = {}
-        self.cache_ttl = {}
+    """
+    Кэш ответов API поверх подключаемого хранилища. Ошибки хранилища не ломают
+    запрос: чтение считается промахом, запись и очистка пропускаются.
+    
+    Одновременные промахи по одному ключу считаются один раз (single_flight), а данные,
+    нужные сразу нескольким эндпоинтам при открытии WebApp, загружаются один раз
+    на короткое окно (load_shared).
+    
+    У кэша каждого пользователя есть поколение, инвалидация начинает новое: расчёт,
+    начатый до изменения данных, не сохраняет результат и не принимает новых ожидающих
+    """
+    def __init__(self, backend: CacheBackend, shared_window: float = API_SHARED_LOAD_WINDOW,
+                 stale_ttl: dict = API_CACHE_STALE_TTL):
+        self.backend = backend
         self.default_ttl = 300  # 5 минут по умолчанию
+        self.shared_window = shared_window
+        self.stale_ttl = stale_ttl
+        self.refreshing = set()  # фоновые пересчёты (устаревшие значения, прогрев после записи)
+        self.in_flight = {}  # ключ кэша -> (поколение, тег версии данных, задача, считающая значение)
+        self.generations = {}  # user_id -> поколение кэша пользователя
+        self.epoch = 0  # общее поколение, растёт при сбросе кэша всех пользователей (forget_local)
+        self.shared = {}  # (user_id, имя, аргументы) -> (истекает, задача загрузки)
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.coalesced = 0
+        self.shared_hits = 0
+        self.stale_serves = 0
+        self.refresh_errors = 0
+        self.discarded = 0
     
     def get_cache_key(self, prefix: str, user_id: str, **kwargs) -> str:
-        """Генерирует уникальный ключ кэша"""
+        """Генерирует уникальный ключ кэша вида <user_id>:<prefix>:<md5 параметров>"""
         key_parts = [prefix, user_id]
         for k, v in sorted(kwargs.items()):
             key_parts.append(f"{k}={v}")
         key_data = ":".join(key_parts)
-        return hashlib.md5(key_data.encode()).hexdigest()
+        return f"{user_id}:{prefix}:{hashlib.md5(key_data.encode()).hexdigest()}"
+    
+    async def _read(self, key: str):
+        try:
+            return await self.backend.get(key)
+        except Exception as e:
+            print(f"Ошибка чтения кэша ({self.backend.name}): {e}")
+            self.errors += 1
+            return None
     
-    def get(self, key: str):
+    async def get(self, key: str):
         """Получает данные из кэша если они не устарели"""
-        if key in self.cache:
-            if time.time() < self.cache_ttl.get(key, 0):
-                return self.cache[key]
-            else:
-                # Удаляем устаревшие данные
-                self.cache.pop(key, None)
-                self.cache_ttl.pop(key, None)
-        return None
+        entry = await self._read(key)
+        if entry is None or time.time() >= entry["fresh_until"]:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry["value"]
+    
+    async def fetch(self, key: str, loader, tag: str = None, stale: bool = False) -> tuple:
+        """
+        Значение ключа: из кэша, если оно свежее и посчитано по той же версии данных tag,
+        иначе через single_flight. При stale=True устаревшее (или посчитанное по прежней версии)
+        значение отдаётся сразу, а loader() пересчитывает его в фоне.
+
+        Returns:
+            tuple: (значение, тег версии данных, по которой оно посчитано; None — устаревшее значение)
+        """
+        entry = await self._read(key)
+        if entry is not None and entry.get("tag") == tag and time.time() < entry["fresh_until"]:
+            self.hits += 1
+            return entry["value"], tag
+        if entry is not None and stale:
+            self.stale_serves += 1
+            self.refresh_in_background(key, loader, tag)
+            return entry["value"], None
+        self.misses += 1
+        return await self.single_flight(key, loader, tag), tag
+    
+    async def contains(self, key: str) -> bool:
+        """Есть ли в кэше запись по ключу (в том числе устаревшая, но ещё хранимая)"""
+        try:
+            return await self.backend.get(key) is not None
+        except Exception as e:
+            print(f"Ошибка чтения кэша ({self.backend.name}): {e}")
+            self.errors += 1
+            return False
+    
+    def generation(self, user_id: str) -> tuple:
+        return self.epoch, self.generations.get(user_id, 0)
+    
+    def refresh_in_background(self, key: str, loader, tag: str = None):
+        """Пересчитывает значение ключа в фоновой задаче (если он уже не считается по текущим данным)"""
+        flight = self.in_flight.get(key)
+        if flight and flight[:2] == (self.generation(key.split(":", 1)[0]), tag):
+            return
+        task = asyncio.ensure_future(self._refresh(key, loader, tag))
+        self.refreshing.add(task)
+        task.add_done_callback(self.refreshing.discard)
+    
+    async def _refresh(self, key: str, loader, tag: str = None):
+        try:
+            await self.single_flight(key, loader, tag)
+        except Exception as e:
+            print(f"Ошибка фонового обновления кэша {key}: {e}")
+            self.refresh_errors += 1
     
-    def set(self, key: str, value, ttl: int = None):
-        """Сохраняет данные в кэш"""
-        self.cache[key] = value
-        self.cache_ttl[key] = time.time() + (ttl or self.default_ttl)
+    @staticmethod
+    def user_tag(user_id: str) -> str:
+        """Тег всех записей пользователя"""
+        return f"user:{user_id}"
     
-    def invalidate_user_cache(self, user_id: str):
+    @staticmethod
+    def date_tag(user_id: str, day) -> str:
+        """Тег записей, построенных по одному дню дневника (локальная дата пользователя)"""
+        return f"user:{user_id}:date:{day}"
+    
+    @staticmethod
+    def aggregate_tag(user_id: str) -> str:
+        """Тег записей, построенных по всей истории питания (дневник, статистика)"""
+        return f"user:{user_id}:aggregate"
+    
+    async def set(self, key: str, value, ttl: int = None, tags=()):
+        """
+        Сохраняет данные в кэш. Тег пользователя (из ключа) добавляется всегда.
+        Для префиксов со stale-while-revalidate запись хранится дольше TTL на допустимую устарелость.
+        Внутри single_flight запись помечается тегом версии данных расчёта
+        """
+        user_id, prefix = key.split(":", 2)[:2]
+        build = api_cache_build.get()
+        if build and build[0] == user_id and build[1] != self.generation(user_id):
+            # Значение посчитано по данным до их изменения — новый расчёт уже запланирован или будет при чтении
+            self.discarded += 1
+            return
+        tags = (self.user_tag(user_id), *tags)
+        ttl = ttl or self.default_ttl
+        data_tag = build[2] if build and build[0] == user_id else None
+        entry = {"fresh_until": time.time() + ttl, "value": value, "tag": data_tag}
+        try:
+            await self.backend.set(key, entry, ttl + self.stale_ttl.get(prefix, 0), tags)
+        except Exception as e:
+            print(f"Ошибка записи в кэш ({self.backend.name}): {e}")
+            self.errors += 1
+    
+    async def single_flight(self, key: str, loader, tag: str = None):
+        """
+        Считает значение через loader(), если по этому ключу ещё никто не считает,
+        иначе ждёт уже идущий расчёт (того же поколения и версии данных tag).
+        Отмена одного запроса не отменяет расчёт для остальных
+        """
+        user_id = key.split(":", 1)[0]
+        generation = self.generation(user_id)
+        flight = self.in_flight.get(key)
+        if flight is None or flight[:2] != (generation, tag):
+            task = asyncio.ensure_future(self._build(user_id, generation, tag, loader))
+            self.in_flight[key] = (generation, tag, task)
+            task.add_done_callback(lambda done: self._land(key, done))
+        else:
+            task = flight[2]
+            self.coalesced += 1
+        return await asyncio.shield(task)
+    
+    @staticmethod
+    async def _build(user_id: str, generation: tuple, tag: str, loader):
+        api_cache_build.set((user_id, generation, tag))
+        return await loader()
+    
+    def _land(self, key: str, task):
+        flight = self.in_flight.get(key)
+        if flight and flight[2] is task:
+            del self.in_flight[key]
+    
+    async def load_shared(self, user_id: str, name: str, func, *args):
+        """
+        Загружает func(*args) один раз на shared_window секунд для всех запросов.
+        Результат общий для нескольких эндпоинтов — его нельзя изменять на месте
+        """
+        key = (user_id, name, args)
+        now = time.time()
+        shared = self.shared.get(key)
+        failed = shared and shared[1].done() and (shared[1].cancelled() or shared[1].exception() is not None)
+        if shared and now < shared[0] and not failed:
+            self.shared_hits += 1
+            return await asyncio.shield(shared[1])
+        for stale_key in [k for k, (expires_at, _) in self.shared.items() if now >= expires_at]:
+            del self.shared[stale_key]
+        task = asyncio.ensure_future(func(*args))
+        self.shared[key] = (now + self.shared_window, task)
+        return await asyncio.shield(task)
+    
+    def forget_shared(self, user_id: str):
+        """
+        Сбрасывает общие загрузки пользователя после изменения его данных и начинает
+        новое поколение его кэша: идущие расчёты не сохранят устаревший результат
+        """
+        self.generations[user_id] = self.generations.get(user_id, 0) + 1
+        for key in [k for k in self.shared if k[0] == user_id]:
+            del self.shared[key]
+    
+    async def invalidate_tags(self, tags):
+        """Удаляет записи с любым из тегов"""
+        try:
+            await self.backend.delete_tags(list(tags))
+        except Exception as e:
+            print(f"Ошибка инвалидации кэша по тегам {list(tags)} ({self.backend.name}): {e}")
+            self.errors += 1
+    
+    async def invalidate_user_cache(self, user_id: str):
         """Очищает весь кэш пользователя"""
-        # Генерируем возможные ключи кэша для этого пользователя
-        possible_prefixes = ["day_summary", "diary", "stats", "recipes", "profile", "diary_data"]
-        keys_to_remove = []
-        
-        for prefix in possible_prefixes:
-            # Генерируем ключ без дополнительных параметров
-            key = self.get_cache_key(prefix, user_id)
-            if key in self.cache:
-                keys_to_remove.append(key)
-            
-            # Для diary_data также проверяем с разными датами
-            if prefix == "diary_data":
-                for days_offset in range(-7, 8):  # Проверяем неделю назад и вперед
-                    from datetime import datetime, timedelta
-                    date = datetime.now() + timedelta(days=days_offset)
-                    date_str = date.strftime("%Y-%m-%d")
-                    key_with_date = self.get_cache_key(prefix, user_id, date=date_str)
-                    if key_with_date in self.cache:
-                        keys_to_remove.append(key_with_date)
-                
-                # Также проверяем ключ с "today"
-                key_today = self.get_cache_key(prefix, user_id, date="today")
-                if key_today in self.cache:
-                    keys_to_remove.append(key_today)
-        
-        for key in keys_to_remove:
-            self.cache.pop(key, None)
-            self.cache_ttl.pop(key, None)
+        self.forget_shared(user_id)
+        await self.invalidate_tags([self.user_tag(user_id)])
+    
+    async def invalidate_user_dates(self, user_id: str, days):
+        """
+        Инвалидация после изменения приёмов пищи: только затронутые дни
+        и сводные данные по всей истории, профиль и рецепты остаются в кэше
+        """
+        self.forget_shared(user_id)
+        await self.invalidate_tags([self.aggregate_tag(user_id), *(self.date_tag(user_id, day) for day in days)])
+    
+    async def forget_local(self):
+        """
+        Сбрасывает всё, что процесс мог не обновить, пропустив уведомления об изменениях:
+        общие загрузки, идущие расчёты (новое общее поколение) и записи локального хранилища
+        """
+        self.epoch += 1
+        self.shared.clear()
+        if self.backend.local:
+            await self.backend.clear()
+    
+    async def purge_expired(self) -> int:
+        """Удаляет устаревшие записи из хранилища"""
+        return await self.backend.purge_expired()
+    
+    async def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            **await self.backend.stats(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "coalesced": self.coalesced,
+            "in_flight": len(self.in_flight),
+            "shared_hits": self.shared_hits,
+            "stale_serves": self.stale_serves,
+            "refreshing": len(self.refreshing),
+            "refresh_errors": self.refresh_errors,
+            "discarded": self.discarded,
+            "errors": self.errors
+        }
 
 # Глобальный экземпляр кэша
-api_cache = APICache()
+if API_CACHE_BACKEND not in CACHE_BACKENDS:
+    print(f"Неизвестный API_CACHE_BACKEND={API_CACHE_BACKEND}, используется memory")
+api_cache = APICache(CACHE_BACKENDS.get(API_CACHE_BACKEND, MemoryCacheBackend)())
+
+async def sweep_api_cache():
+    """Фоновая задача: периодически удаляет устаревшие записи кэша, не дожидаясь повторного чтения ключа"""
+    while True:
+        await asyncio.sleep(API_CACHE_SWEEP_INTERVAL)
+        try:
+            await api_cache.purge_expired()
+        except Exception as e:
+            print(f"Ошибка очистки устаревших записей кэша: {e}")
 
-# Кэшированные функции для парсинга данных
-@lru_cache(maxsize=1000)
-def parse_nutrition_cached(response_text: str) -> tuple:
-    """Кэшированное извлечение БЖУ из ответа"""
-    match = re.search(
-        r'Итого:\s*[~≈]?\s*(\d+\.?\d*)\s*ккал.*?'
-        r'Белки[:\-]?\s*[~≈]?\s*(\d+\.?\d*)\s*г.*?'
-        r'Жиры[:\-]?\s*[~≈]?\s*(\d+\.?\d*)\s*г.*?'
-        r'Углеводы[:\-]?\s*[~≈]?\s*(\d+\.?\d*)\s*г.*?'
-        r'Клетчатка[:\-]?\s*([~≈]?\s*\d+\.?\d*)\s*г',
-        response_text, flags=re.IGNORECASE | re.DOTALL
-    )
+# Пауза перед повторной подпиской на изменения после обрыва соединения (секунды)
+USER_CHANGES_RECONNECT_DELAY = 5
+
+async def handle_user_change(payload: str):
+    """
+    Обновляет кэш по уведомлению об изменении данных пользователя (из бота или
+    другого воркера API): приём пищи — только затронутые дни и сводные данные, остальное — весь кэш пользователя
+    """
+    from bot import CHANGE_SOURCE_ID, get_user_data
+    try:
+        event = json.loads(payload)
+        if event.get("source") == CHANGE_SOURCE_ID:
+            # Запись сделана этим же процессом — кэш уже обновлён обработчиком запроса
+            return
+        user_id = event["user_id"]
+        if event["kind"] == "favorites":
+            # Избранное не кэшируется — достаточно новой версии данных (ETag)
+            return
+        if event["kind"] == "meal" and event["days"]:
+            user_data = await get_user_data(user_id)
+            days = {date.fromisoformat(day) for day in event["days"]}
+            await refresh_meal_caches(user_id, days, user_data.get("utc_offset", 0))
+        else:
+            await api_cache.invalidate_user_cache(user_id)
+    except Exception as e:
+        print(f"Ошибка обработки уведомления об изменении {payload}: {e}")
+
+async def listen_user_changes():
+    """
+    Фоновая задача: подписка (LISTEN) на изменения данных пользователей через соединение
+    из пула БД бота — одно на воркер, с переподключением при обрыве. Уведомления,
+    пришедшие во время обрыва, теряются, поэтому после каждой подписки локальный
+    кэш процесса сбрасывается (api_cache.forget_local)
+    """
+    try:
+        sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+        from bot import engine, USER_CHANGES_CHANNEL
+    except ImportError as import_error:
+        print(f"Ошибка импорта bot.py в listen_user_changes: {import_error}")
+        return
+    
+    handlers = set()
     
-    if match:
-        kcal, prot, fat, carb = map(lambda x: round(float(x)), match.groups()[:4])
-        fiber = round(float(match.groups()[4]), 1)
-        return kcal, prot, fat, carb, fiber
+    def on_notification(connection, pid, channel, payload):
+        task = asyncio.ensure_future(handle_user_change(payload))
+        handlers.add(task)
+        task.add_done_callback(handlers.discard)
     
-    return 0, 0, 0, 0, 0.0
+    while True:
+        try:
+            async with engine.connect() as conn:
+                raw_connection = await conn.get_raw_connection()
+                listener = raw_connection.driver_connection
+                lost = asyncio.Event()
+                
+                def on_termination(connection, lost=lost):
+                    lost.set()
+                
+                listener.add_termination_listener(on_termination)
+                try:
+                    await listener.add_listener(USER_CHANGES_CHANNEL, on_notification)
+                    await api_cache.forget_local()
+                    await lost.wait()
+                finally:
+                    # Соединение возвращается в пул: слушатели этой подписки на нём не остаются
+                    listener.remove_termination_listener(on_termination)
+                    if not listener.is_closed():
+                        await listener.remove_listener(USER_CHANGES_CHANNEL, on_notification)
+            print("Соединение подписки на изменения пользователей закрыто, переподключаемся")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Ошибка подписки на изменения пользователей: {e}")
+        await asyncio.sleep(USER_CHANGES_RECONNECT_DELAY)
+
+@app.on_event("startup")
+async def start_api_cache_tasks():
+    app.state.api_cache_tasks = [
+        asyncio.create_task(sweep_api_cache()),
+        asyncio.create_task(listen_user_changes()),
+    ]
 
+@app.on_event("shutdown")
+async def stop_api_cache_tasks():
+    for task in getattr(app.state, "api_cache_tasks", []):
+        task.cancel()
+
+# Идентификатор сборки API: после деплоя ETag ответов, собранных прежним кодом, не совпадут
+API_BUILD_ID = hashlib.md5(open(__file__, "rb").read()).hexdigest()[:8]
+
+async def current_data_tag(user_id: str) -> str | None:
+    """
+    Тег текущей версии данных пользователя: версия (растёт при каждой записи в историю
+    или профиль), локальная дата пользователя («сегодня» в ответах меняется и без записей)
+    и окно подписи ссылок на фото (иначе ответ 304 оставил бы в браузере просроченные ссылки).
+    None — если версию получить не удалось
+    """
+    try:
+        sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+        from bot import get_user_version
+        version, utc_offset = await get_user_version(user_id)
+    except Exception as e:
+        print(f"Ошибка получения версии данных пользователя {user_id}: {e}")
+        return None
+    today = datetime.now(timezone(timedelta(hours=utc_offset))).date()
+    return f"{version}-{today.isoformat()}-{meal_image_window()}"
+
+async def conditional_get(request: Request, response: Response, user_id: str) -> Response | None:
+    """
+    Условный GET по версии данных пользователя. ETag — тег версии данных (current_data_tag)
+    и сборка API. При совпадении If-None-Match возвращает 304 — до загрузки истории и до кэша;
+    иначе запоминает тег в request.state.data_tag, ставит ETag в заголовки ответа и возвращает None.
+    Ответы из кэша сохраняют ETag, только если значение посчитано по этой же версии (cached_response)
+    """
+    tag = await current_data_tag(user_id)
+    request.state.data_tag = tag
+    if tag is None:
+        return None
+    etag = f'W/"{tag}-{API_BUILD_ID}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+def drop_etag(response: Response):
+    """Ответ не по текущей версии данных (устаревший или частичный): без ETag и без сохранения в браузере"""
+    if "etag" in response.headers:
+        del response.headers["etag"]
+    response.headers["Cache-Control"] = "no-store"
+
+async def cached_response(request: Request, response: Response, cache_key: str, loader, stale: bool = False):
+    """
+    Ответ эндпоинта из кэша или через single_flight (см. APICache.fetch). ETag от conditional_get
+    остаётся, только если значение посчитано по текущей версии данных — иначе браузер
+    закрепил бы устаревший ответ ответами 304 до следующей записи
+    """
+    tag = getattr(request.state, "data_tag", None)
+    value, value_tag = await api_cache.fetch(cache_key, loader, tag, stale=stale)
+    if tag is None or value_tag != tag:
+        drop_etag(response)
+    return value
+
+# За сколько последних дней статистика считает топ продуктов
+STATS_TOP_PRODUCTS_DAYS = 90
+
+# Кэшированные функции для парсинга данных
 @lru_cache(maxsize=500)
 def parse_products_cached(response_text: str) -> str:
     """Кэшированное извлечение списка продуктов из ответа"""
@@ -122,13 +797,47 @@ def parse_products_cached(response_text: str) -> str:
     return ", ".join([re.sub(r'^[•\-]\s*', '', line).split("–")[0].strip() for line in food_lines]) or "Без описания"
 
 
+async def get_day_food_entries(user_id: str, day: date, user_offset: int) -> list:
+    """
+    Записи о еде за локальный день — общий запрос итогов дня, дневника за дату и
+    «сегодня» в статистике (загружается через api_cache.load_shared)
+    """
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    from bot import get_history_range, NUTRITION_COLUMNS
+    return await get_history_range(
+        user_id, day, day, user_offset, types=["food", "text"],
+        columns=("id", "timestamp", "response", "has_image", *NUTRITION_COLUMNS)
+    )
+
+# Ссылки на фото блюд подписываются (HMAC от пользователя, записи, размера и срока): <img> не
+# передаёт X-API-Key, а ID записей идут подряд — без подписи фото можно было бы перебрать.
+# Срок округляется до окна MEAL_IMAGE_URL_TTL: в пределах окна ссылка не меняется (кэш браузера),
+# а подписанная в прошлом окне действует ещё одно окно
+MEAL_IMAGE_URL_SECRET = os.getenv("MEAL_IMAGE_URL_SECRET", os.getenv("TELEGRAM_TOKEN", "")).encode()
+MEAL_IMAGE_URL_TTL = int(os.getenv("MEAL_IMAGE_URL_TTL", str(24 * 3600)))
+
+def meal_image_window() -> int:
+    """Номер текущего окна подписи ссылок на фото (входит в тег версии данных, см. current_data_tag)"""
+    return int(time.time()) // MEAL_IMAGE_URL_TTL
+
+def meal_image_signature(user_id: str, entry_id: int, size: str, expires: int) -> str:
+    message = f"{user_id}:{entry_id}:{size}:{expires}".encode()
+    return hmac.new(MEAL_IMAGE_URL_SECRET, message, hashlib.sha256).hexdigest()[:32]
+
+def meal_image_url(user_id: str, entry_id: int, size: str = "thumb") -> str:
+    """Подписанная ссылка на фото блюда — само изображение не встраивается в JSON. В списках — миниатюра"""
+    expires = (meal_image_window() + 2) * MEAL_IMAGE_URL_TTL
+    signature = meal_image_signature(user_id, entry_id, size, expires)
+    return f"/api/meal-image/{user_id}/{entry_id}?size={size}&expires={expires}&sig={signature}"
+
+
 # Модели данных
 class MealEntry(BaseModel):
     time: str
     name: str
     calories: int
     items: List[Dict[str, Any]]
-    image: Optional[str] = None  # Добавлено поле для изображения в формате base64
+    image_url: Optional[str] = None  # Ссылка на миниатюру в /api/meal-image вместо base64 в JSON
 
 class DiaryDay(BaseModel):
     date: str
@@ -202,662 +911,441 @@ async def api_root():
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.now().isoformat()}
 
+async def build_day_summary(cache_key: str, user_id: str, date_str: Optional[str]):
+    """Считает итоги дня (при промахе кэша, см. get_day_summary)"""
+    # Добавляем обработку ошибок импорта
+    try:
+        # Импортируем функции из bot.py
+        sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+        from bot import get_user_data, get_history_range, entry_macros
+    except ImportError as import_error:
+        print(f"Ошибка импорта bot.py в get_day_summary: {import_error}")
+        # Возвращаем тестовые данные если bot.py недоступен
+        target_date = date_str or datetime.now().strftime("%Y-%m-%d")
+        result = {
+            "status": "success", 
+            "data": {
+                "date": target_date,
+                "total_calories": 1500,
+                "total_protein": 80,
+                "total_fat": 50,
+                "total_carb": 180,
+                "total_fiber": 15.5,
+                "meals": [
+                    {
+                        "id": 1,
+                        "time": "08:30",
+                        "description": "Тестовый завтрак",
+                        "calories": 400,
+                        "protein": 20,
+                        "fat": 15,
+                        "carb": 50
+                    }
+                ],
+                "remaining_calories": 500,
+                "remaining_protein": 20,
+                "remaining_fat": 17,
+                "remaining_carb": 70,
+                "remaining_fiber": 9.5,
+                "warnings": ["🔧 Режим отладки - используются тестовые данные"],
+                "message": "Тестовые данные (bot.py недоступен)"
+            }
+        }
+        # Кэшируем тестовые данные на короткое время
+        await api_cache.set(cache_key, result, ttl=60)
+        return result
+    
+    # Получаем данные пользователя
+    user_data = await api_cache.load_shared(user_id, "user_data", get_user_data, user_id)
+    user_offset = user_data.get("utc_offset", 0)
+    user_tz = timezone(timedelta(hours=user_offset))
+    
+    # Определяем дату для анализа
+    if date_str:
+        target_date = datetime.strptime(date_str, "%Y-%m-%d").date()
+    else:
+        target_date = datetime.now(user_tz).date()
+    
+    # Получаем записи о еде за указанную дату (включая текстовые и голосовые)
+    entries_today = await api_cache.load_shared(
+        user_id, "day_entries", get_day_food_entries, user_id, target_date, user_offset
+    )
+    
+    if not entries_today:
+        result = {
+            "status": "success", 
+            "data": {
+                "date": target_date.strftime("%Y-%m-%d"),
+                "total_calories": 0,
+                "total_protein": 0,
+                "total_fat": 0,
+                "total_carb": 0,
+                "total_fiber": 0,
+                "meals": [],
+                "remaining_calories": user_data.get("target_kcal", 0),
+                "remaining_protein": user_data.get("target_protein", 0),
+                "remaining_fat": user_data.get("target_fat", 0),
+                "remaining_carb": user_data.get("target_carb", 0),
+                "remaining_fiber": user_data.get("target_fiber", 20),
+                "warnings": [],
+                "message": "В этот день не было добавлено ни одного блюда."
+            }
+        }
+        # Кэшируем пустые данные на 90 секунд (оптимизированное время)
+        await api_cache.set(cache_key, result, ttl=90, tags=[api_cache.date_tag(user_id, target_date)])
+        return result
+    
+    # Подсчитываем общие значения
+    total_kcal = total_prot = total_fat = total_carb = total_fiber = 0.0
+    meals = []
+    
+    for i, entry in enumerate(entries_today, start=1):
+        # Используем кэшированную функцию парсинга БЖУ
+        kcal, prot, fat, carb, fiber = entry_macros(entry)
+        
+        total_kcal += kcal
+        total_prot += prot
+        total_fat += fat
+        total_carb += carb
+        total_fiber += fiber
+        
+        # Используем кэшированную функцию парсинга продуктов
+        short_desc = parse_products_cached(entry['response'])
+        
+        meals.append({
+            "id": i,
+            "time": entry['timestamp'].strftime("%H:%M"),
+            "description": short_desc,
+            "calories": kcal,
+            "protein": prot,
+            "fat": fat,
+            "carb": carb,
+            "fiber": fiber,
+            "full_response": entry['response'],
+            "timestamp": entry['timestamp'].isoformat(),
+            "entry_id": entry['id'],
+            "image_url": meal_image_url(user_id, entry['id']) if entry['has_image'] else None
+        })
+    
+    # Получаем целевые значения
+    target_kcal = int(user_data.get("target_kcal", 0))
+    target_protein = int(user_data.get("target_protein", 0))
+    target_fat = int(user_data.get("target_fat", 0))
+    target_carb = int(user_data.get("target_carb", 0))
+    target_fiber = int(user_data.get("target_fiber", 20))
+    
+    # Рассчитываем остатки
+    remaining_kcal = target_kcal - total_kcal
+    remaining_prot = target_protein - total_prot
+    remaining_fat = target_fat - total_fat
+    remaining_carb = target_carb - total_carb
+    remaining_fiber = target_fiber - total_fiber
+    
+    # Формируем предупреждения
+    warnings = []
+    if remaining_kcal < 0:
+        maintenance_kcal = int(target_kcal / 0.83) if target_kcal else 0
+        if total_kcal <= maintenance_kcal and user_data.get("goal", 0) < user_data.get("weight", 0):
+            warnings.append(
+                f"⚖️ По калориям уже перебор для похудения, но ты всё ещё в рамках нормы для поддержания веса — до неё ещё {maintenance_kcal - total_kcal} ккал. Вес не прибавится, не переживай 😊"
+            )
+        else:
+            warnings.append("🍩 Калорий вышло чуть больше нормы — не страшно, но завтра можно чуть аккуратнее 😉")
+    
+    if remaining_prot < 0:
+        warnings.append("🥩 Белка получилось больше, чем нужно — это не страшно.")
+    
+    if remaining_fat < 0:
+        warnings.append("🧈 Жиров вышло многовато — обрати внимание, может где-то масло лишнее.")
+    
+    if remaining_carb < 0:
+        warnings.append("🍞 Углеводов перебор — может, сегодня было много сладкого?")
+    
+    summary_data = {
+        "date": target_date.strftime("%Y-%m-%d"),
+        "total_calories": int(total_kcal),
+        "total_protein": int(total_prot),
+        "total_fat": int(total_fat),
+        "total_carb": int(total_carb),
+        "total_fiber": round(total_fiber, 1),
+        "meals": meals,
+        "remaining_calories": max(0, remaining_kcal),
+        "remaining_protein": max(0, remaining_prot),
+        "remaining_fat": max(0, remaining_fat),
+        "remaining_carb": max(0, remaining_carb),
+        "remaining_fiber": max(0, round(remaining_fiber, 1)),
+        "warnings": warnings,
+        "targets": {
+            "calories": target_kcal,
+            "protein": target_protein,
+            "fat": target_fat,
+            "carb": target_carb,
+            "fiber": target_fiber
+        }
+    }
+    
+    result = {"status": "success", "data": summary_data}
+    # Оптимизированное кэширование: 90 секунд (компромисс между скоростью и нагрузкой)
+    await api_cache.set(cache_key, result, ttl=90, tags=[api_cache.date_tag(user_id, target_date)])
+    return result
+
 # Новый эндпоинт для получения итогов дня
-@app.get("/api/day-summary/{user_id}", response_model=Dict[str, Any])
-async def get_day_summary(user_id: str, date_str: Optional[str] = None, api_key: str = Depends(verify_api_key)):
+@app.get("/api/day-summary/{user_id}")
+async def get_day_summary(user_id: str, request: Request, response: Response, date_str: Optional[str] = None, api_key: str = Depends(verify_api_key)):
     """
     Получение итогов дня для пользователя с кэшированием
     """
+    not_modified = await conditional_get(request, response, user_id)
+    if not_modified:
+        return not_modified
+    
     try:
         # Проверяем кэш
         cache_key = api_cache.get_cache_key("day_summary", user_id, date=date_str or "today")
-        cached_result = api_cache.get(cache_key)
-        if cached_result:
-            return cached_result
-        
-        # Добавляем обработку ошибок импорта
-        try:
-            # Импортируем функции из bot.py
-            sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-            from bot import get_user_data, get_history
-        except ImportError as import_error:
-            print(f"Ошибка импорта bot.py в get_day_summary: {import_error}")
-            # Возвращаем тестовые данные если bot.py недоступен
-            target_date = date_str or datetime.now().strftime("%Y-%m-%d")
-            result = {
-                "status": "success", 
-                "data": {
-                    "date": target_date,
-                    "total_calories": 1500,
-                    "total_protein": 80,
-                    "total_fat": 50,
-                    "total_carb": 180,
-                    "total_fiber": 15.5,
-                    "meals": [
-                        {
-                            "id": 1,
-                            "time": "08:30",
-                            "description": "Тестовый завтрак",
-                            "calories": 400,
-                            "protein": 20,
-                            "fat": 15,
-                            "carb": 50
-                        }
-                    ],
-                    "remaining_calories": 500,
-                    "remaining_protein": 20,
-                    "remaining_fat": 17,
-                    "remaining_carb": 70,
-                    "remaining_fiber": 9.5,
-                    "warnings": ["🔧 Режим отладки - используются тестовые данные"],
-                    "message": "Тестовые данные (bot.py недоступен)"
-                }
-            }
-            # Кэшируем тестовые данные на короткое время
-            api_cache.set(cache_key, result, ttl=60)
-            return result
-        
-        # Получаем данные пользователя
-        user_data = await get_user_data(user_id)
-        user_offset = user_data.get("utc_offset", 0)
-        user_tz = timezone(timedelta(hours=user_offset))
-        
-        # Определяем дату для анализа
-        if date_str:
-            target_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-        else:
-            target_date = datetime.now(user_tz).date()
-        
-        # Получаем историю пользователя
-        history = await get_history(user_id)
-        
-        # Фильтруем записи за указанную дату и записи о еде (включая текстовые и голосовые)
-        entries_today = [e for e in history if e["timestamp"].astimezone(user_tz).date() == target_date and e.get("type") in ["food", "text"]]
-        
-        if not entries_today:
-            result = {
-                "status": "success", 
-                "data": {
-                    "date": target_date.strftime("%Y-%m-%d"),
-                    "total_calories": 0,
-                    "total_protein": 0,
-                    "total_fat": 0,
-                    "total_carb": 0,
-                    "total_fiber": 0,
-                    "meals": [],
-                    "remaining_calories": user_data.get("target_kcal", 0),
-                    "remaining_protein": user_data.get("target_protein", 0),
-                    "remaining_fat": user_data.get("target_fat", 0),
-                    "remaining_carb": user_data.get("target_carb", 0),
-                    "remaining_fiber": user_data.get("target_fiber", 20),
-                    "warnings": [],
-                    "message": "В этот день не было добавлено ни одного блюда."
-                }
-            }
-            # Кэшируем пустые данные на 90 секунд (оптимизированное время)
-            api_cache.set(cache_key, result, ttl=90)
-            return result
-        
-        # Подсчитываем общие значения
-        total_kcal = total_prot = total_fat = total_carb = total_fiber = 0.0
-        meals = []
-        
-        for i, entry in enumerate(entries_today, start=1):
-            # Используем кэшированную функцию парсинга БЖУ
-            kcal, prot, fat, carb, fiber = parse_nutrition_cached(entry['response'])
-            
-            total_kcal += kcal
-            total_prot += prot
-            total_fat += fat
-            total_carb += carb
-            total_fiber += fiber
-            
-            # Используем кэшированную функцию парсинга продуктов
-            short_desc = parse_products_cached(entry['response'])
-            
-            meals.append({
-                "id": i,
-                "time": entry['timestamp'].strftime("%H:%M"),
-                "description": short_desc,
-                "calories": kcal,
-                "protein": prot,
-                "fat": fat,
-                "carb": carb,
-                "fiber": fiber,
-                "full_response": entry['response'],
-                "timestamp": entry['timestamp'].isoformat(),
-                "image": entry.get('compressed_image')  # Добавляем изображение если есть
-            })
-        
-        # Получаем целевые значения
-        target_kcal = int(user_data.get("target_kcal", 0))
-        target_protein = int(user_data.get("target_protein", 0))
-        target_fat = int(user_data.get("target_fat", 0))
-        target_carb = int(user_data.get("target_carb", 0))
-        target_fiber = int(user_data.get("target_fiber", 20))
-        
-        # Рассчитываем остатки
-        remaining_kcal = target_kcal - total_kcal
-        remaining_prot = target_protein - total_prot
-        remaining_fat = target_fat - total_fat
-        remaining_carb = target_carb - total_carb
-        remaining_fiber = target_fiber - total_fiber
-        
-        # Формируем предупреждения
-        warnings = []
-        if remaining_kcal < 0:
-            maintenance_kcal = int(target_kcal / 0.83) if target_kcal else 0
-            if total_kcal <= maintenance_kcal and user_data.get("goal", 0) < user_data.get("weight", 0):
-                warnings.append(
-                    f"⚖️ По калориям уже перебор для похудения, но ты всё ещё в рамках нормы для поддержания веса — до неё ещё {maintenance_kcal - total_kcal} ккал. Вес не прибавится, не переживай 😊"
-                )
-            else:
-                warnings.append("🍩 Калорий вышло чуть больше нормы — не страшно, но завтра можно чуть аккуратнее 😉")
-        
-        if remaining_prot < 0:
-            warnings.append("🥩 Белка получилось больше, чем нужно — это не страшно.")
-        
-        if remaining_fat < 0:
-            warnings.append("🧈 Жиров вышло многовато — обрати внимание, может где-то масло лишнее.")
-        
-        if remaining_carb < 0:
-            warnings.append("🍞 Углеводов перебор — может, сегодня было много сладкого?")
-        
-        summary_data = {
-            "date": target_date.strftime("%Y-%m-%d"),
-            "total_calories": int(total_kcal),
-            "total_protein": int(total_prot),
-            "total_fat": int(total_fat),
-            "total_carb": int(total_carb),
-            "total_fiber": round(total_fiber, 1),
-            "meals": meals,
-            "remaining_calories": max(0, remaining_kcal),
-            "remaining_protein": max(0, remaining_prot),
-            "remaining_fat": max(0, remaining_fat),
-            "remaining_carb": max(0, remaining_carb),
-            "remaining_fiber": max(0, round(remaining_fiber, 1)),
-            "warnings": warnings,
-            "targets": {
-                "calories": target_kcal,
-                "protein": target_protein,
-                "fat": target_fat,
-                "carb": target_carb,
-                "fiber": target_fiber
-            }
-        }
-        
-        result = {"status": "success", "data": summary_data}
-        # Оптимизированное кэширование: 90 секунд (компромисс между скоростью и нагрузкой)
-        api_cache.set(cache_key, result, ttl=90)
-        return result
+        return await cached_response(request, response, cache_key, lambda: build_day_summary(cache_key, user_id, date_str))
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-# Эндпоинты API
-@app.get("/api/diary/{user_id}", response_model=Dict[str, Any])
-async def get_diary(user_id: str, api_key: str = Depends(verify_api_key)):
+# Страница дневника (/api/diary): сколько дней с приёмами пищи отдаётся по умолчанию и максимум
+DIARY_PAGE_SIZE = 30
+DIARY_MAX_PAGE_SIZE = 90
+
+async def build_diary(cache_key: str, user_id: str, before: Optional[date] = None, limit: int = DIARY_PAGE_SIZE):
     """
-    Получение данных дневника питания пользователя с кэшированием
+    Собирает страницу дневника питания (при промахе кэша, см. get_diary): limit последних
+    локальных дней с приёмами пищи раньше before. Дни страницы берутся из дневных итогов,
+    записи — одним запросом по диапазону этих дней, поэтому работа не зависит от длины истории
     """
+    # Добавляем обработку ошибок импорта
     try:
-        # Проверяем кэш
-        cache_key = api_cache.get_cache_key("diary", user_id)
-        cached_result = api_cache.get(cache_key)
-        if cached_result:
-            return cached_result
-        
-        # Добавляем обработку ошибок импорта
-        try:
-            # Импортируем функции из bot.py
-            sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-            from bot import get_user_data, get_history
-        except ImportError as import_error:
-            print(f"Ошибка импорта bot.py в get_diary: {import_error}")
-            # Возвращаем тестовые данные если bot.py недоступен
-            result = {
-                "status": "success", 
-                "data": {
-                    "days": [
-                        {
-                            "date": "06.08.2025",
-                            "total_calories": 1800,
-                            "meals": [
-                                {
-                                    "time": "08:30",
-                                    "name": "Завтрак",
-                                    "calories": 400,
-                                    "items": [{"name": "Овсянка", "calories": 150}]
-                                }
-                            ]
-                        }
-                    ],
-                    "user_targets": {
-                        "calories": 2000,
-                        "protein": 100,
-                        "fat": 67,
-                        "carb": 250,
-                        "fiber": 25
+        # Импортируем функции из bot.py
+        sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+        from bot import get_user_data, get_history_range, get_daily_rollup
+    except ImportError as import_error:
+        print(f"Ошибка импорта bot.py в get_diary: {import_error}")
+        # Возвращаем тестовые данные если bot.py недоступен
+        result = {
+            "status": "success", 
+            "data": {
+                "days": [
+                    {
+                        "date": "06.08.2025",
+                        "total_calories": 1800,
+                        "meals": [
+                            {
+                                "time": "08:30",
+                                "name": "Завтрак",
+                                "calories": 400,
+                                "items": [{"name": "Овсянка", "calories": 150}]
+                            }
+                        ]
                     }
+                ],
+                "user_targets": {
+                    "calories": 2000,
+                    "protein": 100,
+                    "fat": 67,
+                    "carb": 250,
+                    "fiber": 25
                 }
             }
-            # Кэшируем тестовые данные
-            api_cache.set(cache_key, result, ttl=60)
-            return result
-        
-        # Получаем данные пользователя
-        user_data = await get_user_data(user_id)
-        
-        # Получаем историю пользователя
-        history = await get_history(user_id)
-        
-        # Преобразуем данные в нужный формат
-        diary_data = {
-            "days": [],
-            "user_targets": {
-                "calories": user_data.get("target_kcal", 2000),
-                "protein": user_data.get("target_protein", 100),
-                "fat": user_data.get("target_fat", 67),
-                "carb": user_data.get("target_carb", 250),
-                "fiber": user_data.get("target_fiber", 25)
-            }
         }
+        # Кэшируем тестовые данные
+        await api_cache.set(cache_key, result, ttl=60)
+        return result
+    
+    # Получаем данные пользователя
+    user_data = await api_cache.load_shared(user_id, "user_data", get_user_data, user_id)
+    user_offset = user_data.get("utc_offset", 0)
+    
+    # Дни страницы (на один больше — чтобы узнать, есть ли следующая)
+    page_days = await get_daily_rollup(
+        user_id, end_date=before - timedelta(days=1) if before else None, newest_first=True, limit=limit + 1
+    )
+    has_more = len(page_days) > limit
+    page_days = [row["day"] for row in page_days[:limit]]
+    
+    # Получаем записи о еде за дни страницы без изображений и служебных полей
+    history = await get_history_range(
+        user_id, page_days[-1], page_days[0], user_offset,
+        types=["food", "text"], columns=("timestamp", "type", "prompt", "response", "kcal")
+    ) if page_days else []
+    
+    # Преобразуем данные в нужный формат
+    diary_data = {
+        "days": [],
+        # Курсор следующей страницы: передать как before
+        "next_before": page_days[-1].isoformat() if has_more else None,
+        "has_more": has_more,
+        "user_targets": {
+            "calories": user_data.get("target_kcal", 2000),
+            "protein": user_data.get("target_protein", 100),
+            "fat": user_data.get("target_fat", 67),
+            "carb": user_data.get("target_carb", 250),
+            "fiber": user_data.get("target_fiber", 25)
+        }
+    }
+    
+    # Группируем записи по дням
+    days_dict = {}
+    for entry in history:
+        # Включаем все записи о еде: и с фото (type="food"), и текстовые/голосовые (type="text")
+        if entry.get("type") not in ["food", "text"]:
+            continue
+            
+        # Локальная дата и время записи (timestamp хранится в UTC)
+        entry_time = entry.get("timestamp") if isinstance(entry.get("timestamp"), datetime) else datetime.fromisoformat(entry.get("timestamp"))
+        entry_time += timedelta(hours=user_offset)
+        entry_date = entry_time.date()
+        date_str = entry_date.strftime("%Y-%m-%d")
+        
+        # Инициализируем день, если его еще нет
+        if date_str not in days_dict:
+            days_dict[date_str] = {
+                "date": entry_date.strftime("%d.%m.%Y"),
+                "total_calories": 0,
+                "meals": []
+            }
         
-        # Группируем записи по дням
-        days_dict = {}
-        for entry in history:
-            # Включаем все записи о еде: и с фото (type="food"), и текстовые/голосовые (type="text")
-            if entry.get("type") not in ["food", "text"]:
-                continue
-                
-            # Получаем дату из timestamp
-            entry_date = entry.get("timestamp").date() if isinstance(entry.get("timestamp"), datetime) else datetime.fromisoformat(entry.get("timestamp")).date()
-            date_str = entry_date.strftime("%Y-%m-%d")
-            
-            # Инициализируем день, если его еще нет
-            if date_str not in days_dict:
-                days_dict[date_str] = {
-                    "date": entry_date.strftime("%d.%m.%Y"),
-                    "total_calories": 0,
-                    "meals": []
-                }
-            
-            # Извлекаем калории из ответа
+        # Калории из колонки записи; для старых записей — из текста ответа
+        if entry.get("kcal") is not None:
+            calories = int(entry["kcal"])
+        else:
             calories = 0
             match = re.search(r"(\d+(?:[.,]\d+)?) ккал", entry.get("response", ""))
             if match:
                 calories = int(float(match.group(1).replace(",", ".")))
-            
-            # Извлекаем продукты из ответа
-            items = []
-            for line in entry.get("response", "").split("\n"):
-                if line.strip().startswith("•") or line.strip().startswith("-"):
-                    item_parts = line.strip()[1:].strip().split("–")
-                    if len(item_parts) >= 2:
-                        item_name = item_parts[0].strip()
-                        item_calories = 0
-                        cal_match = re.search(r"(\d+(?:[.,]\d+)?) ккал", item_parts[1])
-                        if cal_match:
-                            item_calories = int(float(cal_match.group(1).replace(",", ".")))
-                        items.append({"name": item_name, "calories": item_calories})
-            
-            # Добавляем прием пищи
-            meal_time = entry_date.strftime("%H:%M")
-            if "timestamp" in entry and isinstance(entry.get("timestamp"), datetime):
-                meal_time = entry.get("timestamp").strftime("%H:%M")
-            
-            meal_name = "Прием пищи"
-            if "завтрак" in entry.get("prompt", "").lower():
-                meal_name = "Завтрак"
-            elif "обед" in entry.get("prompt", "").lower():
-                meal_name = "Обед"
-            elif "ужин" in entry.get("prompt", "").lower():
-                meal_name = "Ужин"
-            elif "перекус" in entry.get("prompt", "").lower():
-                meal_name = "Перекус"
-            
-            days_dict[date_str]["meals"].append({
-                "time": meal_time,
-                "name": meal_name,
-                "calories": calories,
-                "items": items
-            })
-            
-            days_dict[date_str]["total_calories"] += calories
-        
-        # Сортируем дни по дате (от новых к старым)
-        sorted_days = sorted(days_dict.values(), key=lambda x: datetime.strptime(x["date"], "%d.%m.%Y"), reverse=True)
-        diary_data["days"] = sorted_days
         
-        result = {"status": "success", "data": diary_data}
-        # Кэшируем результат на 5 минут
-        api_cache.set(cache_key, result, ttl=300)
-        return result
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        # Извлекаем продукты из ответа
+        items = []
+        for line in entry.get("response", "").split("\n"):
+            if line.strip().startswith("•") or line.strip().startswith("-"):
+                item_parts = line.strip()[1:].strip().split("–")
+                if len(item_parts) >= 2:
+                    item_name = item_parts[0].strip()
+                    item_calories = 0
+                    cal_match = re.search(r"(\d+(?:[.,]\d+)?) ккал", item_parts[1])
+                    if cal_match:
+                        item_calories = int(float(cal_match.group(1).replace(",", ".")))
+                    items.append({"name": item_name, "calories": item_calories})
+        
+        # Добавляем прием пищи
+        meal_time = entry_time.strftime("%H:%M")
+        
+        meal_name = "Прием пищи"
+        if "завтрак" in entry.get("prompt", "").lower():
+            meal_name = "Завтрак"
+        elif "обед" in entry.get("prompt", "").lower():
+            meal_name = "Обед"
+        elif "ужин" in entry.get("prompt", "").lower():
+            meal_name = "Ужин"
+        elif "перекус" in entry.get("prompt", "").lower():
+            meal_name = "Перекус"
+        
+        days_dict[date_str]["meals"].append({
+            "time": meal_time,
+            "name": meal_name,
+            "calories": calories,
+            "items": items
+        })
+        
+        days_dict[date_str]["total_calories"] += calories
+    
+    # Сортируем дни по дате (от новых к старым)
+    sorted_days = sorted(days_dict.values(), key=lambda x: datetime.strptime(x["date"], "%d.%m.%Y"), reverse=True)
+    diary_data["days"] = sorted_days
+    
+    result = {"status": "success", "data": diary_data}
+    # Кэшируем результат на 5 минут
+    await api_cache.set(cache_key, result, ttl=300, tags=[api_cache.aggregate_tag(user_id)])
+    return result
 
-@app.get("/api/stats/{user_id}", response_model=Dict[str, Any])
-async def get_stats(user_id: str, api_key: str = Depends(verify_api_key)):
+# Эндпоинты API
+@app.get("/api/diary/{user_id}")
+async def get_diary(
+    user_id: str,
+    request: Request,
+    response: Response,
+    before: Optional[date] = Query(None, description="Курсор: вернуть дни раньше этой локальной даты (next_before предыдущей страницы)"),
+    limit: int = Query(DIARY_PAGE_SIZE, ge=1, le=DIARY_MAX_PAGE_SIZE, description="Сколько дней с приёмами пищи вернуть"),
+    api_key: str = Depends(verify_api_key)
+):
     """
-    Получение статистики пользователя с кэшированием
+    Получение страницы дневника питания пользователя с кэшированием (от новых дней к старым)
     """
+    not_modified = await conditional_get(request, response, user_id)
+    if not_modified:
+        return not_modified
+    
     try:
         # Проверяем кэш
-        cache_key = api_cache.get_cache_key("stats", user_id)
-        cached_result = api_cache.get(cache_key)
-        if cached_result:
-            return cached_result
-        
-        # Добавляем обработку ошибок импорта
-        try:
-            # Импортируем функции из bot.py
-            sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-            from bot import get_user_data, get_history, calculate_summary_text
-            # Отладочное логирование удалено для оптимизации
-        except ImportError as import_error:
-            print(f"Ошибка импорта bot.py в get_stats: {import_error}")
-            # НЕ возвращаем тестовые данные, а пробуем продолжить
-            # return тестовые данные - УБИРАЕМ ЭТО
-            pass
-        
-        # Получаем данные пользователя
-        try:
-            user_data = await get_user_data(user_id)
-            # Отладочное логирование удалено для оптимизации
-        except Exception as e:
-            print(f"Ошибка получения данных пользователя {user_id}: {e}")
-            # Используем значения по умолчанию
-            user_data = {
-                "target_kcal": 2000,
-                "target_protein": 100,
-                "target_fat": 67,
-                "target_carb": 250,
-                "target_fiber": 25,
-                "utc_offset": 0
-            }
-        
-        # Получаем историю пользователя
-        try:
-            history = await get_history(user_id)
-            # Отладочное логирование удалено для оптимизации
-        except Exception as e:
-            print(f"Ошибка получения истории пользователя {user_id}: {e}")
-            history = []
-        
-        # Фильтруем записи о еде (food и text типы содержат информацию о еде)
-        food_entries = [entry for entry in history if entry.get("type") in ["food", "text"]]
-        # Отладочное логирование удалено для оптимизации
-        
-        # Подсчет типов записей для анализа (без вывода)
-        types_count = {}
-        for entry in history:
-            entry_type = entry.get("type", "unknown")
-            types_count[entry_type] = types_count.get(entry_type, 0) + 1
-        # Отладочное логирование удалено для оптимизации
-        
-        # Если нет записей о еде, возвращаем базовые данные
-        if not food_entries:
-            # Отладочное логирование удалено для оптимизации
-            stats_data = {
-                "general": {
-                    "avg_calories": 0,
-                    "days_tracked": 0,
-                    "adherence_percent": 0,
-                    "weight_change": 0
-                },
-                "nutrition_distribution": {
-                    "protein": 33,
-                    "fat": 33,
-                    "carb": 34
-                },
-                "top_products": [],
-                "user_targets": {
-                    "calories": user_data.get("target_kcal", 2000),
-                    "protein": user_data.get("target_protein", 100),
-                    "fat": user_data.get("target_fat", 67),
-                    "carb": user_data.get("target_carb", 250),
-                    "fiber": user_data.get("target_fiber", 25)
-                },
-                "today_summary": None
-            }
-            return {"status": "success", "data": stats_data}
-        
-        # Группируем по дням для подсчета дней
-        days = {}
-        total_calories = 0
-        total_protein = 0
-        total_fat = 0
-        total_carb = 0
-        total_fiber = 0
-        
-        # Отладочное логирование удалено для оптимизации
-        
-        for i, entry in enumerate(food_entries):
-            try:
-                # Получаем дату из timestamp
-                timestamp = entry.get("timestamp")
-                if isinstance(timestamp, datetime):
-                    entry_date = timestamp.date()
-                else:
-                    entry_date = datetime.fromisoformat(str(timestamp)).date()
-                date_str = entry_date.strftime("%Y-%m-%d")
-                
-                # Инициализируем день, если его еще нет
-                if date_str not in days:
-                    days[date_str] = {
-                        "calories": 0,
-                        "protein": 0,
-                        "fat": 0,
-                        "carb": 0,
-                        "fiber": 0
-                    }
-                
-                # Используем кэшированную функцию парсинга БЖУ (как в других эндпоинтах)
-                response = entry.get("response", "")
-                kcal, prot, fat, carb, fiber = parse_nutrition_cached(response)
-                
-                if kcal > 0:  # Если удалось распарсить данные
-                    days[date_str]["calories"] += kcal
-                    days[date_str]["protein"] += prot
-                    days[date_str]["fat"] += fat
-                    days[date_str]["carb"] += carb
-                    days[date_str]["fiber"] += fiber
-                    
-                    total_calories += kcal
-                    total_protein += prot
-                    total_fat += fat
-                    total_carb += carb
-                    total_fiber += fiber
-                        
-            except Exception as e:
-                print(f"Ошибка обработки записи {i+1}: {e}")
-                continue
-        
-        # Отладочное логирование удалено для оптимизации
-        
-        days_tracked = len(days)
-        
-        # Правильный расчет средних калорий - учитываем общий период отслеживания
-        # Находим первую и последнюю записи для определения периода
-        if food_entries:
-            # Сортируем записи по дате
-            sorted_entries = sorted(food_entries, key=lambda x: x.get("timestamp") if isinstance(x.get("timestamp"), datetime) else datetime.fromisoformat(str(x.get("timestamp"))))
-            first_date = sorted_entries[0].get("timestamp")
-            last_date = sorted_entries[-1].get("timestamp")
-            
-            if isinstance(first_date, str):
-                first_date = datetime.fromisoformat(first_date)
-            if isinstance(last_date, str):
-                last_date = datetime.fromisoformat(last_date)
-                
-            # Считаем общее количество дней в периоде
-            total_period_days = (last_date.date() - first_date.date()).days + 1
-            avg_calories = round(total_calories / total_period_days) if total_period_days > 0 else 0
-            
-            # Отладочное логирование удалено для оптимизации
-        else:
-            avg_calories = 0
-        
-        # Расчет распределения БЖУ
-        total_nutrients = total_protein + total_fat + total_carb
-        
-        protein_percent = round((total_protein / total_nutrients * 100) if total_nutrients > 0 else 0)
-        fat_percent = round((total_fat / total_nutrients * 100) if total_nutrients > 0 else 0)
-        carb_percent = round((total_carb / total_nutrients * 100) if total_nutrients > 0 else 0)
-        
-        # Подготавливаем данные по дням для графиков
-        daily_data = []
-        if food_entries:
-            # Создаем полный список дней в периоде
-            sorted_entries = sorted(food_entries, key=lambda x: x.get("timestamp") if isinstance(x.get("timestamp"), datetime) else datetime.fromisoformat(str(x.get("timestamp"))))
-            first_date = sorted_entries[0].get("timestamp")
-            last_date = sorted_entries[-1].get("timestamp")
-            
-            if isinstance(first_date, str):
-                first_date = datetime.fromisoformat(first_date)
-            if isinstance(last_date, str):
-                last_date = datetime.fromisoformat(last_date)
-            
-            # Генерируем все дни в периоде
-            current_date = first_date.date()
-            end_date = last_date.date()
-            
-            while current_date <= end_date:
-                date_str = current_date.strftime("%Y-%m-%d")
-                day_data = days.get(date_str, {
-                    "calories": 0,
-                    "protein": 0,
-                    "fat": 0,
-                    "carb": 0,
-                    "fiber": 0
-                })
-                daily_data.append({
-                    "date": current_date.strftime("%d.%m.%Y"),
-                    "calories": day_data["calories"],
-                    "protein": day_data["protein"],
-                    "fat": day_data["fat"],
-                    "carb": day_data["carb"],
-                    "fiber": day_data["fiber"]
-                })
-                current_date += timedelta(days=1)
-        
-        # Расчет изменения веса
-        weight_entries = [entry for entry in history if entry.get("type") == "weight"]
-        weight_entries.sort(key=lambda x: x.get("timestamp") if isinstance(x.get("timestamp"), datetime) else datetime.fromisoformat(x.get("timestamp")))
-        weight_change = 0
-        if len(weight_entries) >= 2:
-            first_weight = float(weight_entries[0].get("weight", 0))
-            last_weight = float(weight_entries[-1].get("weight", 0))
-            weight_change = last_weight - first_weight
-        
-        # Подсчет топ продуктов
-        products = {}
-        for entry in food_entries:
-            for line in entry.get("response", "").split("\n"):
-                if line.strip().startswith("•") or line.strip().startswith("-"):
-                    item_parts = line.strip()[1:].strip().split("–")
-                    if len(item_parts) >= 1:
-                        product_name = item_parts[0].strip()
-                        products[product_name] = products.get(product_name, 0) + 1
-        
-        top_products = [{"name": name, "count": count} for name, count in sorted(products.items(), key=lambda x: x[1], reverse=True)[:5]]
-        
-        # Расчет соблюдения нормы
-        target_kcal = user_data.get("target_kcal", 2000)
-        adherence_percent = round((avg_calories / target_kcal * 100) if target_kcal > 0 else 0)
-        if adherence_percent > 100:
-            adherence_percent = 200 - adherence_percent  # Инвертируем процент, если превышает 100%
-        adherence_percent = max(0, min(100, adherence_percent))  # Ограничиваем от 0 до 100
-        
-        # Получаем итоги за сегодня
-        user_offset = user_data.get("utc_offset", 0)
-        user_tz = timezone(timedelta(hours=user_offset))
-        today = datetime.now(user_tz).date()
-        
-        # Вызываем функцию напрямую без API endpoint
-        try:
-            # Получаем данные дневника за сегодня (включая текстовые и голосовые записи)
-            entries_today = [e for e in history if e["timestamp"].astimezone(user_tz).date() == today and e.get("type") in ["food", "text"]]
-            
-            if entries_today:
-                # Подсчитываем общие значения за сегодня
-                today_kcal = today_prot = today_fat = today_carb = today_fiber = 0.0
-                today_meals = []
-                
-                for i, entry in enumerate(entries_today, start=1):
-                    # Используем кэшированную функцию парсинга БЖУ
-                    kcal, prot, fat, carb, fiber = parse_nutrition_cached(entry['response'])
-                    
-                    today_kcal += kcal
-                    today_prot += prot
-                    today_fat += fat
-                    today_carb += carb
-                    today_fiber += fiber
-                    
-                    # Используем кэшированную функцию парсинга продуктов
-                    short_desc = parse_products_cached(entry['response'])
-                    
-                    today_meals.append({
-                        "time": entry['timestamp'].astimezone(user_tz).strftime("%H:%M"),
-                        "description": short_desc,
-                        "calories": kcal
-                    })
-                
-                # Получаем целевые значения
-                target_kcal = int(user_data.get("target_kcal", 2000))
-                target_protein = int(user_data.get("target_protein", 100))
-                target_fat = int(user_data.get("target_fat", 67))
-                target_carb = int(user_data.get("target_carb", 250))
-                target_fiber = int(user_data.get("target_fiber", 25))
-                
-                today_summary_data = {
-                    "date": today.strftime("%Y-%m-%d"),
-                    "total_calories": int(today_kcal),
-                    "total_protein": int(today_prot),
-                    "total_fat": int(today_fat),
-                    "total_carb": int(today_carb),
-                    "total_fiber": round(today_fiber, 1),
-                    "meals": today_meals,
-                    "remaining_calories": max(0, target_kcal - today_kcal),
-                    "remaining_protein": max(0, target_protein - today_prot),
-                    "remaining_fat": max(0, target_fat - today_fat),
-                    "remaining_carb": max(0, target_carb - today_carb),
-                    "remaining_fiber": max(0, round(target_fiber - today_fiber, 1)),
-                    "warnings": []
-                }
-            else:
-                today_summary_data = {
-                    "date": today.strftime("%Y-%m-%d"),
-                    "total_calories": 0,
-                    "total_protein": 0,
-                    "total_fat": 0,
-                    "total_carb": 0,
-                    "total_fiber": 0,
-                    "meals": [],
-                    "remaining_calories": user_data.get("target_kcal", 2000),
-                    "remaining_protein": user_data.get("target_protein", 100),
-                    "remaining_fat": user_data.get("target_fat", 67),
-                    "remaining_carb": user_data.get("target_carb", 250),
-                    "remaining_fiber": user_data.get("target_fiber", 25),
-                    "warnings": []
-                }
-        except Exception as e:
-            print(f"Ошибка при получении итогов дня: {e}")
-            today_summary_data = None
+        cache_key = api_cache.get_cache_key("diary", user_id, before=before or "latest", limit=limit)
+        return await cached_response(request, response, cache_key, lambda: build_diary(cache_key, user_id, before, limit), stale=True)
         
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def build_stats(cache_key: str, user_id: str):
+    """Считает статистику пользователя (при промахе кэша, см. get_stats)"""
+    # Добавляем обработку ошибок импорта
+    try:
+        # Импортируем функции из bot.py
+        sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+        from bot import get_user_data, get_history_range, get_daily_rollup, entry_macros
+        # Отладочное логирование удалено для оптимизации
+    except ImportError as import_error:
+        print(f"Ошибка импорта bot.py в get_stats: {import_error}")
+        # НЕ возвращаем тестовые данные, а пробуем продолжить
+        # return тестовые данные - УБИРАЕМ ЭТО
+        pass
+    
+    # Получаем данные пользователя
+    try:
+        user_data = await api_cache.load_shared(user_id, "user_data", get_user_data, user_id)
+        # Отладочное логирование удалено для оптимизации
+    except Exception as e:
+        print(f"Ошибка получения данных пользователя {user_id}: {e}")
+        # Используем значения по умолчанию
+        user_data = {
+            "target_kcal": 2000,
+            "target_protein": 100,
+            "target_fat": 67,
+            "target_carb": 250,
+            "target_fiber": 25,
+            "utc_offset": 0
+        }
+    
+    user_offset = user_data.get("utc_offset", 0)
+    user_tz = timezone(timedelta(hours=user_offset))
+    today = datetime.now(user_tz).date()
+    
+    # Дневные итоги КБЖУ — один индексированный запрос к daily_nutrition_rollup
+    # вместо разбора всей истории
+    try:
+        rollup = await get_daily_rollup(user_id)
+    except Exception as e:
+        print(f"Ошибка получения дневных итогов пользователя {user_id}: {e}")
+        rollup = []
+    # Днём отслеживания считается день, где распознаны калории
+    rollup = [day for day in rollup if day["kcal"] > 0]
+    
+    # Если нет записей о еде, возвращаем базовые данные
+    if not rollup:
+        # Отладочное логирование удалено для оптимизации
         stats_data = {
             "general": {
-                "avg_calories": avg_calories,
-                "days_tracked": days_tracked,
-                "adherence_percent": adherence_percent,
-                "weight_change": round(weight_change, 1)
+                "avg_calories": 0,
+                "days_tracked": 0,
+                "adherence_percent": 0,
+                "weight_change": 0
             },
             "nutrition_distribution": {
-                "protein": protein_percent,
-                "fat": fat_percent,
-                "carb": carb_percent
+                "protein": 33,
+                "fat": 33,
+                "carb": 34
             },
-            "top_products": top_products,
+            "top_products": [],
             "user_targets": {
                 "calories": user_data.get("target_kcal", 2000),
                 "protein": user_data.get("target_protein", 100),
@@ -865,16 +1353,191 @@ async def get_stats(user_id: str, api_key: str = Depends(verify_api_key)):
                 "carb": user_data.get("target_carb", 250),
                 "fiber": user_data.get("target_fiber", 25)
             },
-            "today_summary": today_summary_data,
-            "daily_data": daily_data  # Добавляем реальные данные по дням
+            "today_summary": None
         }
+        return {"status": "success", "data": stats_data}
+    
+    days_tracked = len(rollup)
+    total_calories = sum(day["kcal"] for day in rollup)
+    total_protein = sum(day["protein"] for day in rollup)
+    total_fat = sum(day["fat"] for day in rollup)
+    total_carb = sum(day["carb"] for day in rollup)
+    
+    # Средние калории считаем по всему периоду отслеживания (от первого до последнего дня с едой)
+    first_date = rollup[0]["day"]
+    end_date = rollup[-1]["day"]
+    total_period_days = (end_date - first_date).days + 1
+    avg_calories = round(total_calories / total_period_days) if total_period_days > 0 else 0
+    
+    # Расчет распределения БЖУ
+    total_nutrients = total_protein + total_fat + total_carb
+    
+    protein_percent = round((total_protein / total_nutrients * 100) if total_nutrients > 0 else 0)
+    fat_percent = round((total_fat / total_nutrients * 100) if total_nutrients > 0 else 0)
+    carb_percent = round((total_carb / total_nutrients * 100) if total_nutrients > 0 else 0)
+    
+    # Подготавливаем данные по дням для графиков (дни без еды заполняем нулями)
+    days = {day["day"]: day for day in rollup}
+    daily_data = []
+    current_date = first_date
+    while current_date <= end_date:
+        day_data = days.get(current_date)
+        daily_data.append({
+            "date": current_date.strftime("%d.%m.%Y"),
+            "calories": round(day_data["kcal"]) if day_data else 0,
+            "protein": round(day_data["protein"]) if day_data else 0,
+            "fat": round(day_data["fat"]) if day_data else 0,
+            "carb": round(day_data["carb"]) if day_data else 0,
+            "fiber": round(day_data["fiber"], 1) if day_data else 0
+        })
+        current_date += timedelta(days=1)
+    
+    # Расчет изменения веса (вес хранится в data записи)
+    weight_entries = await get_history_range(user_id, types=["weight"], columns=("timestamp", "data"))
+    weights = [float(e["data"]["weight"]) for e in weight_entries if (e.get("data") or {}).get("weight") is not None]
+    weight_change = weights[-1] - weights[0] if len(weights) >= 2 else 0
+    
+    # Подсчет топ продуктов за последние STATS_TOP_PRODUCTS_DAYS дней
+    recent_entries = await get_history_range(
+        user_id, today - timedelta(days=STATS_TOP_PRODUCTS_DAYS - 1), today, user_offset,
+        types=["food", "text"], columns=("response",)
+    )
+    products = {}
+    for entry in recent_entries:
+        for line in (entry.get("response") or "").split("\n"):
+            if line.strip().startswith("•") or line.strip().startswith("-"):
+                item_parts = line.strip()[1:].strip().split("–")
+                if len(item_parts) >= 1:
+                    product_name = item_parts[0].strip()
+                    products[product_name] = products.get(product_name, 0) + 1
+    
+    top_products = [{"name": name, "count": count} for name, count in sorted(products.items(), key=lambda x: x[1], reverse=True)[:5]]
+    
+    # Расчет соблюдения нормы
+    target_kcal = user_data.get("target_kcal", 2000)
+    adherence_percent = round((avg_calories / target_kcal * 100) if target_kcal > 0 else 0)
+    if adherence_percent > 100:
+        adherence_percent = 200 - adherence_percent  # Инвертируем процент, если превышает 100%
+    adherence_percent = max(0, min(100, adherence_percent))  # Ограничиваем от 0 до 100
+    
+    # Получаем итоги за сегодня
+    try:
+        # Получаем данные дневника за сегодня (включая текстовые и голосовые записи)
+        entries_today = await api_cache.load_shared(
+            user_id, "day_entries", get_day_food_entries, user_id, today, user_offset
+        )
+        
+        if entries_today:
+            # Подсчитываем общие значения за сегодня
+            today_kcal = today_prot = today_fat = today_carb = today_fiber = 0.0
+            today_meals = []
+            
+            for i, entry in enumerate(entries_today, start=1):
+                # Используем кэшированную функцию парсинга БЖУ
+                kcal, prot, fat, carb, fiber = entry_macros(entry)
+                
+                today_kcal += kcal
+                today_prot += prot
+                today_fat += fat
+                today_carb += carb
+                today_fiber += fiber
+                
+                # Используем кэшированную функцию парсинга продуктов
+                short_desc = parse_products_cached(entry['response'])
+                
+                today_meals.append({
+                    "time": entry['timestamp'].astimezone(user_tz).strftime("%H:%M"),
+                    "description": short_desc,
+                    "calories": kcal
+                })
+            
+            # Получаем целевые значения
+            target_kcal = int(user_data.get("target_kcal", 2000))
+            target_protein = int(user_data.get("target_protein", 100))
+            target_fat = int(user_data.get("target_fat", 67))
+            target_carb = int(user_data.get("target_carb", 250))
+            target_fiber = int(user_data.get("target_fiber", 25))
+            
+            today_summary_data = {
+                "date": today.strftime("%Y-%m-%d"),
+                "total_calories": int(today_kcal),
+                "total_protein": int(today_prot),
+                "total_fat": int(today_fat),
+                "total_carb": int(today_carb),
+                "total_fiber": round(today_fiber, 1),
+                "meals": today_meals,
+                "remaining_calories": max(0, target_kcal - today_kcal),
+                "remaining_protein": max(0, target_protein - today_prot),
+                "remaining_fat": max(0, target_fat - today_fat),
+                "remaining_carb": max(0, target_carb - today_carb),
+                "remaining_fiber": max(0, round(target_fiber - today_fiber, 1)),
+                "warnings": []
+            }
+        else:
+            today_summary_data = {
+                "date": today.strftime("%Y-%m-%d"),
+                "total_calories": 0,
+                "total_protein": 0,
+                "total_fat": 0,
+                "total_carb": 0,
+                "total_fiber": 0,
+                "meals": [],
+                "remaining_calories": user_data.get("target_kcal", 2000),
+                "remaining_protein": user_data.get("target_protein", 100),
+                "remaining_fat": user_data.get("target_fat", 67),
+                "remaining_carb": user_data.get("target_carb", 250),
+                "remaining_fiber": user_data.get("target_fiber", 25),
+                "warnings": []
+            }
+    except Exception as e:
+        print(f"Ошибка при получении итогов дня: {e}")
+        today_summary_data = None
+    
+    stats_data = {
+        "general": {
+            "avg_calories": avg_calories,
+            "days_tracked": days_tracked,
+            "adherence_percent": adherence_percent,
+            "weight_change": round(weight_change, 1)
+        },
+        "nutrition_distribution": {
+            "protein": protein_percent,
+            "fat": fat_percent,
+            "carb": carb_percent
+        },
+        "top_products": top_products,
+        "user_targets": {
+            "calories": user_data.get("target_kcal", 2000),
+            "protein": user_data.get("target_protein", 100),
+            "fat": user_data.get("target_fat", 67),
+            "carb": user_data.get("target_carb", 250),
+            "fiber": user_data.get("target_fiber", 25)
+        },
+        "today_summary": today_summary_data,
+        "daily_data": daily_data  # Добавляем реальные данные по дням
+    }
+    
+    # Отладочное логирование удалено для оптимизации
+    
+    result = {"status": "success", "data": stats_data}
+    # Кэшируем результат на 10 минут (статистика обновляется реже)
+    await api_cache.set(cache_key, result, ttl=600, tags=[api_cache.aggregate_tag(user_id)])
+    return result
+
+@app.get("/api/stats/{user_id}")
+async def get_stats(user_id: str, request: Request, response: Response, api_key: str = Depends(verify_api_key)):
+    """
+    Получение статистики пользователя с кэшированием
+    """
+    not_modified = await conditional_get(request, response, user_id)
+    if not_modified:
+        return not_modified
+    
+    try:
+        # Проверяем кэш
+        cache_key = api_cache.get_cache_key("stats", user_id)
+        return await cached_response(request, response, cache_key, lambda: build_stats(cache_key, user_id), stale=True)
         
-        # Отладочное логирование удалено для оптимизации
-        
-        result = {"status": "success", "data": stats_data}
-        # Кэшируем результат на 10 минут (статистика обновляется реже)
-        api_cache.set(cache_key, result, ttl=600)
-        return result
     except Exception as e:
         print(f"КРИТИЧЕСКАЯ ОШИБКА в get_stats для пользователя {user_id}: {e}")
         print(f"Тип ошибки: {type(e)}")
@@ -882,7 +1545,7 @@ async def get_stats(user_id: str, api_key: str = Depends(verify_api_key)):
         print(f"Трассировка: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/recipes/{user_id}", response_model=Dict[str, Any])
+@app.get("/api/recipes/{user_id}")
 async def get_recipes(user_id: str, api_key: str = Depends(verify_api_key)):
     """
     Получение рецептов для пользователя с кэшированием
@@ -890,7 +1553,7 @@ async def get_recipes(user_id: str, api_key: str = Depends(verify_api_key)):
     try:
         # Проверяем кэш
         cache_key = api_cache.get_cache_key("recipes", user_id)
-        cached_result = api_cache.get(cache_key)
+        cached_result = await api_cache.get(cache_key)
         if cached_result:
             return cached_result
         
@@ -900,7 +1563,7 @@ async def get_recipes(user_id: str, api_key: str = Depends(verify_api_key)):
             from bot import get_user_data
         except ImportError:
             result = {"status": "success", "data": {"test": "mode"}}
-            api_cache.set(cache_key, result, ttl=60)
+            await api_cache.set(cache_key, result, ttl=60)
             return result
         
         # Получаем данные пользователя
@@ -982,7 +1645,7 @@ async def get_recipes(user_id: str, api_key: str = Depends(verify_api_key)):
         
         result = {"status": "success", "data": recipes_data}
         # Кэшируем рецепты на 1 час (они статичны)
-        api_cache.set(cache_key, result, ttl=3600)
+        await api_cache.set(cache_key, result, ttl=3600)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -994,7 +1657,7 @@ class MealData(BaseModel):
     meal_time: str
     items: List[Dict[str, Any]]
 
-@app.post("/api/meal", response_model=Dict[str, Any])
+@app.post("/api/meal")
 async def add_meal(meal_data: MealData, api_key: str = Depends(verify_api_key)):
     """
     Добавление приема пищи
@@ -1011,39 +1674,43 @@ async def add_meal(meal_data: MealData, api_key: str = Depends(verify_api_key)):
         raise HTTPException(status_code=500, detail=str(e))
 
 # Эндпоинт для получения профиля пользователя
-@app.get("/api/profile/{user_id}", response_model=Dict[str, Any])
-async def get_user_profile(user_id: str, api_key: str = Depends(verify_api_key)):
+async def build_profile(cache_key: str, user_id: str):
+    """Загружает профиль пользователя (при промахе кэша, см. get_user_profile)"""
+    # Импортируем функции из bot.py
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        from bot import get_user_data
+    except ImportError:
+        result = {"status": "success", "data": {"test": "mode"}}
+        await api_cache.set(cache_key, result, ttl=60)
+        return result
+    
+    # Получаем данные пользователя
+    user_data = await api_cache.load_shared(user_id, "user_data", get_user_data, user_id)
+    
+    result = {"status": "success", "data": user_data}
+    # Кэшируем профиль на 30 минут (меняется редко)
+    await api_cache.set(cache_key, result, ttl=1800)
+    return result
+
+@app.get("/api/profile/{user_id}")
+async def get_user_profile(user_id: str, request: Request, response: Response, api_key: str = Depends(verify_api_key)):
     """
     Получение данных профиля пользователя с кэшированием
     """
+    not_modified = await conditional_get(request, response, user_id)
+    if not_modified:
+        return not_modified
+    
     try:
         # Проверяем кэш
         cache_key = api_cache.get_cache_key("profile", user_id)
-        cached_result = api_cache.get(cache_key)
-        if cached_result:
-            return cached_result
-        
-        # Импортируем функции из bot.py
-        sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-        try:
-            from bot import get_user_data
-        except ImportError:
-            result = {"status": "success", "data": {"test": "mode"}}
-            api_cache.set(cache_key, result, ttl=60)
-            return result
-        
-        # Получаем данные пользователя
-        user_data = await get_user_data(user_id)
-        
-        result = {"status": "success", "data": user_data}
-        # Кэшируем профиль на 30 минут (меняется редко)
-        api_cache.set(cache_key, result, ttl=1800)
-        return result
+        return await cached_response(request, response, cache_key, lambda: build_profile(cache_key, user_id))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # Эндпоинт для обновления профиля пользователя
-@app.put("/api/profile/{user_id}", response_model=Dict[str, Any])
+@app.put("/api/profile/{user_id}")
 async def update_user_profile(user_id: str, profile_data: ProfileUpdateData, api_key: str = Depends(verify_api_key)):
     """
     Обновление данных профиля пользователя с автоматическим пересчетом целевых значений и инвалидацией кэша
@@ -1125,7 +1792,7 @@ async def update_user_profile(user_id: str, profile_data: ProfileUpdateData, api
         await update_user_data(user_id, current_data)
         
         # Очищаем кэш пользователя после обновления
-        api_cache.invalidate_user_cache(user_id)
+        await api_cache.invalidate_user_cache(user_id)
         
         response_data = {
             "status": "success", 
@@ -1148,7 +1815,7 @@ async def update_user_profile(user_id: str, profile_data: ProfileUpdateData, api
         raise HTTPException(status_code=500, detail=str(e))
 
 # Эндпоинт для пересчета целевых значений
-@app.post("/api/profile/{user_id}/recalculate", response_model=Dict[str, Any])
+@app.post("/api/profile/{user_id}/recalculate")
 async def recalculate_user_targets(user_id: str, api_key: str = Depends(verify_api_key)):
     """
     Пересчет целевых значений пользователя
@@ -1234,272 +1901,377 @@ async def recalculate_user_targets(user_id: str, api_key: str = Depends(verify_a
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-# НОВЫЙ эндпоинт для детального дневника с навигацией по датам
-@app.get("/api/diary-data/{user_id}")
-async def get_diary_data(user_id: str, date_str: Optional[str] = None, api_key: str = Depends(verify_api_key)):
-    """
-    Получение детальных данных дневника питания для пользователя за конкретную дату с кэшированием
-    """
+async def build_diary_data(cache_key: str, user_id: str, date_str: Optional[str]):
+    """Собирает дневник за дату (при промахе кэша, см. get_diary_data)"""
+    # Добавляем обработку ошибок импорта
     try:
-        # Проверяем кэш
-        cache_key = api_cache.get_cache_key("diary_data", user_id, date=date_str or "today")
-        cached_result = api_cache.get(cache_key)
-        if cached_result:
-            return cached_result
-        
-        # Добавляем обработку ошибок импорта
-        try:
-            # Импортируем функции из bot.py
-            sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-            from bot import get_user_data, get_history
-        except ImportError as import_error:
-            print(f"Ошибка импорта bot.py в get_diary_data: {import_error}")
-            # Возвращаем тестовые данные если bot.py недоступен
-            target_date = date_str or datetime.now().strftime("%Y-%m-%d")
-            result = {
-                "status": "success", 
-                "data": {
-                    "date": target_date,
-                    "total_calories": 1650,
-                    "total_protein": 85,
-                    "total_fat": 55,
-                    "total_carb": 190,
-                    "total_fiber": 18.5,
-                    "meals": [
-                        {
-                            "id": 1,
-                            "time": "08:30",
-                            "description": "Овсянка с бананом и орехами",
-                            "calories": 420,
-                            "protein": 15,
-                            "fat": 12,
-                            "carb": 65,
-                            "fiber": 8.2,
-                            "items": [
-                                {"name": "Овсянка", "weight": "50г", "calories": 180},
-                                {"name": "Банан", "weight": "120г", "calories": 108},
-                                {"name": "Грецкие орехи", "weight": "20г", "calories": 132}
-                            ]
-                        },
-                        {
-                            "id": 2,
-                            "time": "13:15",
-                            "description": "Куриная грудка с рисом и овощами",
-                            "calories": 580,
-                            "protein": 45,
-                            "fat": 8,
-                            "carb": 75,
-                            "fiber": 6.5,
-                            "items": [
-                                {"name": "Куриная грудка", "weight": "150г", "calories": 248},
-                                {"name": "Рис отварной", "weight": "100г", "calories": 130},
-                                {"name": "Брокколи", "weight": "150г", "calories": 51},
-                                {"name": "Морковь", "weight": "100г", "calories": 41}
-                            ]
-                        },
-                        {
-                            "id": 3,
-                            "time": "19:45",
-                            "description": "Творог с ягодами",
-                            "calories": 280,
-                            "protein": 25,
-                            "fat": 9,
-                            "carb": 20,
-                            "fiber": 3.8,
-                            "items": [
-                                {"name": "Творог 5%", "weight": "150г", "calories": 180},
-                                {"name": "Черника", "weight": "80г", "calories": 46},
-                                {"name": "Мед", "weight": "15г", "calories": 54}
-                            ]
-                        }
-                    ],
-                    "targets": {
-                        "calories": 2000,
-                        "protein": 100,
-                        "fat": 67,
-                        "carb": 250,
-                        "fiber": 25
-                    },
-                    "remaining": {
-                        "calories": 350,
+        # Импортируем функции из bot.py
+        sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+        from bot import get_user_data, get_history_range, entry_macros
+    except ImportError as import_error:
+        print(f"Ошибка импорта bot.py в get_diary_data: {import_error}")
+        # Возвращаем тестовые данные если bot.py недоступен
+        target_date = date_str or datetime.now().strftime("%Y-%m-%d")
+        result = {
+            "status": "success", 
+            "data": {
+                "date": target_date,
+                "total_calories": 1650,
+                "total_protein": 85,
+                "total_fat": 55,
+                "total_carb": 190,
+                "total_fiber": 18.5,
+                "meals": [
+                    {
+                        "id": 1,
+                        "time": "08:30",
+                        "description": "Овсянка с бананом и орехами",
+                        "calories": 420,
                         "protein": 15,
                         "fat": 12,
-                        "carb": 60,
-                        "fiber": 6.5
-                    },
-                    "message": "🔧 Режим отладки - используются тестовые данные"
-                }
-            }
-            # Кэшируем тестовые данные
-            api_cache.set(cache_key, result, ttl=60)
-            return result
-        
-        # Получаем данные пользователя
-        user_data = await get_user_data(user_id)
-        user_offset = user_data.get("utc_offset", 0)
-        user_tz = timezone(timedelta(hours=user_offset))
-        
-        # Определяем дату для анализа
-        if date_str:
-            target_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-        else:
-            target_date = datetime.now(user_tz).date()
-        
-        # Получаем историю пользователя
-        history = await get_history(user_id)
-        
-        # Отладочное логирование удалено для оптимизации
-        food_entries_with_images = [e for e in history if e.get('type') == 'food' and e.get('compressed_image')]
-        food_entries_without_images = [e for e in history if e.get('type') == 'food' and not e.get('compressed_image')]
-        
-        # Фильтруем записи за указанную дату и записи о еде (включая текстовые и голосовые)
-        entries_today = [e for e in history if e["timestamp"].astimezone(user_tz).date() == target_date and e.get("type") in ["food", "text"]]
-        
-        # Отладочное логирование удалено для оптимизации
-        for i, entry in enumerate(entries_today):
-            has_image = bool(entry.get('compressed_image'))
-            # Отладочное логирование удалено для оптимизации
-            if has_image:
-                image_length = len(entry.get('compressed_image', ''))
-                # Отладочное логирование удалено для оптимизации
-        
-        # Получаем целевые значения
-        target_kcal = int(user_data.get("target_kcal", 2000))
-        target_protein = int(user_data.get("target_protein", 100))
-        target_fat = int(user_data.get("target_fat", 67))
-        target_carb = int(user_data.get("target_carb", 250))
-        target_fiber = int(user_data.get("target_fiber", 25))
-        
-        if not entries_today:
-            return {
-                "status": "success", 
-                "data": {
-                    "date": target_date.strftime("%Y-%m-%d"),
-                    "total_calories": 0,
-                    "total_protein": 0,
-                    "total_fat": 0,
-                    "total_carb": 0,
-                    "total_fiber": 0,
-                    "meals": [],
-                    "targets": {
-                        "calories": target_kcal,
-                        "protein": target_protein,
-                        "fat": target_fat,
-                        "carb": target_carb,
-                        "fiber": target_fiber
+                        "carb": 65,
+                        "fiber": 8.2,
+                        "items": [
+                            {"name": "Овсянка", "weight": "50г", "calories": 180},
+                            {"name": "Банан", "weight": "120г", "calories": 108},
+                            {"name": "Грецкие орехи", "weight": "20г", "calories": 132}
+                        ]
                     },
-                    "remaining": {
-                        "calories": target_kcal,
-                        "protein": target_protein,
-                        "fat": target_fat,
-                        "carb": target_carb,
-                        "fiber": target_fiber
+                    {
+                        "id": 2,
+                        "time": "13:15",
+                        "description": "Куриная грудка с рисом и овощами",
+                        "calories": 580,
+                        "protein": 45,
+                        "fat": 8,
+                        "carb": 75,
+                        "fiber": 6.5,
+                        "items": [
+                            {"name": "Куриная грудка", "weight": "150г", "calories": 248},
+                            {"name": "Рис отварной", "weight": "100г", "calories": 130},
+                            {"name": "Брокколи", "weight": "150г", "calories": 51},
+                            {"name": "Морковь", "weight": "100г", "calories": 41}
+                        ]
                     },
-                    "message": "В этот день не было добавлено ни одного блюда."
-                }
+                    {
+                        "id": 3,
+                        "time": "19:45",
+                        "description": "Творог с ягодами",
+                        "calories": 280,
+                        "protein": 25,
+                        "fat": 9,
+                        "carb": 20,
+                        "fiber": 3.8,
+                        "items": [
+                            {"name": "Творог 5%", "weight": "150г", "calories": 180},
+                            {"name": "Черника", "weight": "80г", "calories": 46},
+                            {"name": "Мед", "weight": "15г", "calories": 54}
+                        ]
+                    }
+                ],
+                "targets": {
+                    "calories": 2000,
+                    "protein": 100,
+                    "fat": 67,
+                    "carb": 250,
+                    "fiber": 25
+                },
+                "remaining": {
+                    "calories": 350,
+                    "protein": 15,
+                    "fat": 12,
+                    "carb": 60,
+                    "fiber": 6.5
+                },
+                "message": "🔧 Режим отладки - используются тестовые данные"
             }
-        
-        # Подсчитываем общие значения
-        total_kcal = total_prot = total_fat = total_carb = total_fiber = 0.0
-        meals = []
-        
-        for i, entry in enumerate(entries_today, start=1):
-            # Используем кэшированную функцию парсинга БЖУ
-            kcal, prot, fat, carb, fiber = parse_nutrition_cached(entry['response'])
-            
-            total_kcal += kcal
-            total_prot += prot
-            total_fat += fat
-            total_carb += carb
-            total_fiber += fiber
-            
-            # Извлекаем продукты из ответа
-            lines = entry['response'].splitlines()
-            food_lines = [line for line in lines if line.strip().startswith(("•", "-"))]
-            
-            # Парсим продукты для детального отображения
-            items = []
-            for line in food_lines:
-                clean_line = re.sub(r'^[•\-]\s*', '', line).strip()
-                if "–" in clean_line:
-                    parts = clean_line.split("–")
-                    product_info = parts[0].strip()
-                    nutrition_info = parts[1].strip() if len(parts) > 1 else ""
-                    
-                    # Извлекаем вес продукта
-                    weight_match = re.search(r'(\d+(?:[.,]\d+)?)\s*г', product_info)
-                    weight = weight_match.group(0) if weight_match else "100г"
-                    
-                    # Извлекаем калории продукта
-                    cal_match = re.search(r'(\d+(?:[.,]\d+)?)\s*ккал', nutrition_info)
-                    product_calories = int(float(cal_match.group(1).replace(",", "."))) if cal_match else 0
-                    
-                    # Название продукта (убираем вес)
-                    product_name = re.sub(r'\s*\d+(?:[.,]\d+)?\s*г.*', '', product_info).strip()
-                    
-                    items.append({
-                        "name": product_name,
-                        "weight": weight,
-                        "calories": product_calories
-                    })
-            
-            short_desc = ", ".join([re.sub(r'^[•\-]\s*', '', line).split("–")[0].strip() for line in food_lines]) or "Без описания"
-            
-            meals.append({
-                "id": i,
-                "time": entry['timestamp'].astimezone(user_tz).strftime("%H:%M"),
-                "description": short_desc,
-                "calories": kcal,
-                "protein": prot,
-                "fat": fat,
-                "carb": carb,
-                "fiber": fiber,
-                "items": items,
-                "full_response": entry['response'],
-                "timestamp": entry['timestamp'].isoformat(),
-                "image": entry.get('compressed_image')  # Добавляем изображение если есть
-            })
-        
-        # Рассчитываем остатки
-        remaining_kcal = max(0, target_kcal - total_kcal)
-        remaining_prot = max(0, target_protein - total_prot)
-        remaining_fat = max(0, target_fat - total_fat)
-        remaining_carb = max(0, target_carb - total_carb)
-        remaining_fiber = max(0, target_fiber - total_fiber)
-        
-        diary_data = {
-            "date": target_date.strftime("%Y-%m-%d"),
-            "total_calories": int(total_kcal),
-            "total_protein": int(total_prot),
-            "total_fat": int(total_fat),
-            "total_carb": int(total_carb),
-            "total_fiber": round(total_fiber, 1),
-            "meals": meals,
-            "targets": {
-                "calories": target_kcal,
-                "protein": target_protein,
-                "fat": target_fat,
-                "carb": target_carb,
-                "fiber": target_fiber
-            },
-            "remaining": {
-                "calories": remaining_kcal,
-                "protein": remaining_prot,
-                "fat": remaining_fat,
-                "carb": remaining_carb,
-                "fiber": round(remaining_fiber, 1)
+        }
+        # Кэшируем тестовые данные
+        await api_cache.set(cache_key, result, ttl=60)
+        return result
+    
+    # Получаем данные пользователя
+    user_data = await api_cache.load_shared(user_id, "user_data", get_user_data, user_id)
+    user_offset = user_data.get("utc_offset", 0)
+    user_tz = timezone(timedelta(hours=user_offset))
+    
+    # Определяем дату для анализа
+    if date_str:
+        target_date = datetime.strptime(date_str, "%Y-%m-%d").date()
+    else:
+        target_date = datetime.now(user_tz).date()
+    
+    # Получаем записи о еде за указанную дату (включая текстовые и голосовые)
+    entries_today = await api_cache.load_shared(
+        user_id, "day_entries", get_day_food_entries, user_id, target_date, user_offset
+    )
+    
+    # Получаем целевые значения
+    target_kcal = int(user_data.get("target_kcal", 2000))
+    target_protein = int(user_data.get("target_protein", 100))
+    target_fat = int(user_data.get("target_fat", 67))
+    target_carb = int(user_data.get("target_carb", 250))
+    target_fiber = int(user_data.get("target_fiber", 25))
+    
+    if not entries_today:
+        return {
+            "status": "success", 
+            "data": {
+                "date": target_date.strftime("%Y-%m-%d"),
+                "total_calories": 0,
+                "total_protein": 0,
+                "total_fat": 0,
+                "total_carb": 0,
+                "total_fiber": 0,
+                "meals": [],
+                "targets": {
+                    "calories": target_kcal,
+                    "protein": target_protein,
+                    "fat": target_fat,
+                    "carb": target_carb,
+                    "fiber": target_fiber
+                },
+                "remaining": {
+                    "calories": target_kcal,
+                    "protein": target_protein,
+                    "fat": target_fat,
+                    "carb": target_carb,
+                    "fiber": target_fiber
+                },
+                "message": "В этот день не было добавлено ни одного блюда."
             }
         }
+    
+    # Подсчитываем общие значения
+    total_kcal = total_prot = total_fat = total_carb = total_fiber = 0.0
+    meals = []
+    
+    for i, entry in enumerate(entries_today, start=1):
+        # Используем кэшированную функцию парсинга БЖУ
+        kcal, prot, fat, carb, fiber = entry_macros(entry)
+        
+        total_kcal += kcal
+        total_prot += prot
+        total_fat += fat
+        total_carb += carb
+        total_fiber += fiber
+        
+        # Извлекаем продукты из ответа
+        lines = entry['response'].splitlines()
+        food_lines = [line for line in lines if line.strip().startswith(("•", "-"))]
+        
+        # Парсим продукты для детального отображения
+        items = []
+        for line in food_lines:
+            clean_line = re.sub(r'^[•\-]\s*', '', line).strip()
+            if "–" in clean_line:
+                parts = clean_line.split("–")
+                product_info = parts[0].strip()
+                nutrition_info = parts[1].strip() if len(parts) > 1 else ""
+                
+                # Извлекаем вес продукта
+                weight_match = re.search(r'(\d+(?:[.,]\d+)?)\s*г', product_info)
+                weight = weight_match.group(0) if weight_match else "100г"
+                
+                # Извлекаем калории продукта
+                cal_match = re.search(r'(\d+(?:[.,]\d+)?)\s*ккал', nutrition_info)
+                product_calories = int(float(cal_match.group(1).replace(",", "."))) if cal_match else 0
+                
+                # Название продукта (убираем вес)
+                product_name = re.sub(r'\s*\d+(?:[.,]\d+)?\s*г.*', '', product_info).strip()
+                
+                items.append({
+                    "name": product_name,
+                    "weight": weight,
+                    "calories": product_calories
+                })
         
-        result = {"status": "success", "data": diary_data}
-        # Оптимизированное кэширование: 90 секунд (компромисс между скоростью и нагрузкой)
-        api_cache.set(cache_key, result, ttl=90)
-        return result
+        short_desc = ", ".join([re.sub(r'^[•\-]\s*', '', line).split("–")[0].strip() for line in food_lines]) or "Без описания"
+        
+        meals.append({
+            "id": i,
+            "time": entry['timestamp'].astimezone(user_tz).strftime("%H:%M"),
+            "description": short_desc,
+            "calories": kcal,
+            "protein": prot,
+            "fat": fat,
+            "carb": carb,
+            "fiber": fiber,
+            "items": items,
+            "full_response": entry['response'],
+            "timestamp": entry['timestamp'].isoformat(),
+            "entry_id": entry['id'],
+            "image_url": meal_image_url(user_id, entry['id']) if entry['has_image'] else None
+        })
+    
+    # Рассчитываем остатки
+    remaining_kcal = max(0, target_kcal - total_kcal)
+    remaining_prot = max(0, target_protein - total_prot)
+    remaining_fat = max(0, target_fat - total_fat)
+    remaining_carb = max(0, target_carb - total_carb)
+    remaining_fiber = max(0, target_fiber - total_fiber)
+    
+    diary_data = {
+        "date": target_date.strftime("%Y-%m-%d"),
+        "total_calories": int(total_kcal),
+        "total_protein": int(total_prot),
+        "total_fat": int(total_fat),
+        "total_carb": int(total_carb),
+        "total_fiber": round(total_fiber, 1),
+        "meals": meals,
+        "targets": {
+            "calories": target_kcal,
+            "protein": target_protein,
+            "fat": target_fat,
+            "carb": target_carb,
+            "fiber": target_fiber
+        },
+        "remaining": {
+            "calories": remaining_kcal,
+            "protein": remaining_prot,
+            "fat": remaining_fat,
+            "carb": remaining_carb,
+            "fiber": round(remaining_fiber, 1)
+        }
+    }
+    
+    result = {"status": "success", "data": diary_data}
+    # Оптимизированное кэширование: 90 секунд (компромисс между скоростью и нагрузкой)
+    await api_cache.set(cache_key, result, ttl=90, tags=[api_cache.date_tag(user_id, target_date)])
+    return result
+
+# НОВЫЙ эндпоинт для детального дневника с навигацией по датам
+@app.get("/api/diary-data/{user_id}")
+async def get_diary_data(user_id: str, request: Request, response: Response, date_str: Optional[str] = None, api_key: str = Depends(verify_api_key)):
+    """
+    Получение детальных данных дневника питания для пользователя за конкретную дату с кэшированием
+    """
+    not_modified = await conditional_get(request, response, user_id)
+    if not_modified:
+        return not_modified
+    
+    try:
+        # Проверяем кэш
+        cache_key = api_cache.get_cache_key("diary_data", user_id, date=date_str or "today")
+        return await cached_response(request, response, cache_key, lambda: build_diary_data(cache_key, user_id, date_str))
         
     except Exception as e:
         print(f"Ошибка в get_diary_data: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Разделы первого экрана WebApp, которые умеет отдавать /api/bootstrap
+BOOTSTRAP_SECTIONS = ("profile", "day_summary", "diary_data", "stats", "favorites")
+
+@app.get("/api/bootstrap/{user_id}")
+async def get_bootstrap(
+    user_id: str,
+    request: Request,
+    response: Response,
+    sections: Optional[str] = Query(None, description="Разделы через запятую: " + ", ".join(BOOTSTRAP_SECTIONS)),
+    date_str: Optional[str] = None,
+    api_key: str = Depends(verify_api_key)
+):
+    """
+    Первый экран WebApp одним запросом: профиль, итоги дня, дневник за дату, статистика
+    и избранное (или только разделы из sections). Разделы считаются параллельно через
+    тот же кэш, что и отдельные эндпоинты; профиль и записи дня загружаются один раз
+    (api_cache.load_shared). Ошибка одного раздела не мешает остальным — она попадает в errors
+    """
+    requested = [name.strip() for name in sections.split(",") if name.strip()] if sections else list(BOOTSTRAP_SECTIONS)
+    unknown = [name for name in requested if name not in BOOTSTRAP_SECTIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Неизвестные разделы: {', '.join(unknown)}")
+    
+    not_modified = await conditional_get(request, response, user_id)
+    if not_modified:
+        return not_modified
+    
+    date_key = date_str or "today"
+    loaders = {
+        "profile": lambda: cached_response(
+            request, response, api_cache.get_cache_key("profile", user_id),
+            lambda: build_profile(api_cache.get_cache_key("profile", user_id), user_id)
+        ),
+        "day_summary": lambda: cached_response(
+            request, response, api_cache.get_cache_key("day_summary", user_id, date=date_key),
+            lambda: build_day_summary(api_cache.get_cache_key("day_summary", user_id, date=date_key), user_id, date_str)
+        ),
+        "diary_data": lambda: cached_response(
+            request, response, api_cache.get_cache_key("diary_data", user_id, date=date_key),
+            lambda: build_diary_data(api_cache.get_cache_key("diary_data", user_id, date=date_key), user_id, date_str)
+        ),
+        "stats": lambda: cached_response(
+            request, response, api_cache.get_cache_key("stats", user_id),
+            lambda: build_stats(api_cache.get_cache_key("stats", user_id), user_id),
+            stale=True
+        ),
+        "favorites": lambda: load_favorites(user_id),
+    }
+    
+    results = await asyncio.gather(*(loaders[name]() for name in requested), return_exceptions=True)
+    data, errors = {}, {}
+    for name, result in zip(requested, results):
+        if isinstance(result, Exception):
+            print(f"Ошибка раздела {name} в get_bootstrap для пользователя {user_id}: {result}")
+            errors[name] = str(result)
+        elif name == "favorites":
+            data[name] = result
+        else:
+            data[name] = result.get("data")
+    if errors:
+        # Частичный ответ нельзя закреплять в браузере: повторный запрос должен досчитать разделы
+        drop_etag(response)
+    
+    return {"status": "success", "data": data, "errors": errors}
+
+# Эндпоинт для отдачи фото блюда отдельно от JSON дневника
+@app.get("/api/meal-image/{user_id}/{entry_id}")
+async def get_meal_image_endpoint(
+    user_id: str,
+    entry_id: int,
+    request: Request,
+    size: str = Query("full", pattern="^(full|thumb)$"),
+    expires: int = Query(...),
+    sig: str = Query(...)
+):
+    """
+    Отдаёт фото блюда по подписанной ссылке (meal_image_url): полное или миниатюру (size=thumb),
+    в WebP — если браузер его принимает и копия есть. ETag — ключ отданной копии (sha256 содержимого):
+    она не меняется, поэтому кэшируется браузером навсегда. Если нужной копии нет и отдано полное фото
+    (или фото ещё не перенесено из записи), ответ проверяется заново при каждом запросе
+    """
+    if expires < time.time() or not hmac.compare_digest(sig, meal_image_signature(user_id, entry_id, size, expires)):
+        raise HTTPException(status_code=403, detail="Ссылка на фото недействительна или устарела")
+    
+    try:
+        sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+        from bot import find_meal_image, load_meal_image
+    except ImportError as import_error:
+        print(f"Ошибка импорта bot.py в get_meal_image_endpoint: {import_error}")
+        raise HTTPException(status_code=500, detail="Ошибка сервера: не удается получить доступ к данным")
+    
+    webp = "image/webp" in request.headers.get("accept", "")
+    image = await find_meal_image(user_id, entry_id, size=size, webp=webp)
+    if not image:
+        raise HTTPException(status_code=404, detail="Фото не найдено")
+    
+    served_size = image["name"].split("_")[0]
+    if image["key"] and served_size == size:
+        etag = f'"{image["key"]}"'
+        cache_control = "private, max-age=31536000, immutable"
+    else:
+        etag = f'"meal-{entry_id}-{image["name"]}"'
+        cache_control = "private, no-cache"
+    headers = {"Cache-Control": cache_control, "Vary": "Accept", "ETag": etag}
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    
+    image_bytes = await load_meal_image(user_id, entry_id, image)
+    if not image_bytes:
+        raise HTTPException(status_code=404, detail="Фото не найдено")
+    return Response(content=image_bytes, media_type=image["content_type"], headers=headers)
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
 
@@ -1510,20 +2282,43 @@ async def get_cache_stats():
     """Получение статистики кэша"""
     return {
         "status": "success",
-        "data": {
-            "cache_size": len(api_cache.cache),
-            "cache_keys": list(api_cache.cache.keys())[:10],  # Первые 10 ключей
-            "ttl_info": {k: v - time.time() for k, v in list(api_cache.cache_ttl.items())[:5]}
-        }
+        "data": await api_cache.stats()
     }
 
 @app.delete("/api/cache/clear/{user_id}")
 async def clear_user_cache(user_id: str):
     """Очистка кэша пользователя"""
-    api_cache.invalidate_user_cache(user_id)
+    await api_cache.invalidate_user_cache(user_id)
     return {"status": "success", "message": f"Кэш пользователя {user_id} очищен"}
 
 
+async def refresh_meal_caches(user_id: str, days, user_offset: int):
+    """
+    Кэш после добавления или удаления блюда: записи за затронутые дни и сводные данные
+    удаляются, а те из них, что были в кэше или считались (их сейчас смотрят в WebApp), сразу
+    пересчитываются в фоне — чтение сразу после записи попадает в готовое значение
+    или присоединяется к идущему расчёту. Расчёты, начатые до записи, результат не сохраняют
+    """
+    today = datetime.now(timezone(timedelta(hours=user_offset))).date()
+    builders = [
+        (api_cache.get_cache_key("stats", user_id), build_stats, ()),
+        (api_cache.get_cache_key("diary", user_id, before="latest", limit=DIARY_PAGE_SIZE), build_diary, (None, DIARY_PAGE_SIZE)),
+    ]
+    for day in days:
+        date_strs = [day.isoformat(), None] if day == today else [day.isoformat()]
+        for date_str in date_strs:
+            builders.append((api_cache.get_cache_key("day_summary", user_id, date=date_str or "today"), build_day_summary, (date_str,)))
+            builders.append((api_cache.get_cache_key("diary_data", user_id, date=date_str or "today"), build_diary_data, (date_str,)))
+    
+    cached = [
+        (key, builder, args) for key, builder, args in builders
+        if key in api_cache.in_flight or await api_cache.contains(key)
+    ]
+    await api_cache.invalidate_user_dates(user_id, days)
+    tag = await current_data_tag(user_id)
+    for key, builder, args in cached:
+        api_cache.refresh_in_background(key, lambda key=key, builder=builder, args=args: builder(key, user_id, *args), tag)
+
 # Эндпоинт для удаления блюда
 @app.delete("/api/meal/{user_id}/{timestamp}")
 async def delete_meal(user_id: str, timestamp: str, api_key: str = Depends(verify_api_key)):
@@ -1535,40 +2330,35 @@ async def delete_meal(user_id: str, timestamp: str, api_key: str = Depends(verif
         try:
             # Импортируем функции из bot.py
             sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-            from bot import get_history, async_session, UserHistory
-            from sqlalchemy import delete
+            from bot import get_user_data, get_history_entry, delete_history_entries
         except ImportError as import_error:
             print(f"Ошибка импорта bot.py в delete_meal: {import_error}")
             raise HTTPException(status_code=500, detail="Ошибка сервера: не удается получить доступ к данным")
         
-        # Получаем историю пользователя
-        history = await get_history(user_id)
-        
         # Ищем запись для удаления
-        entry_to_remove = None
-        for entry in history:
-            if entry["timestamp"].isoformat() == timestamp:
-                entry_to_remove = entry
-                break
+        try:
+            entry_to_remove = await get_history_entry(
+                user_id, datetime.fromisoformat(timestamp), columns=("timestamp", "response")
+            )
+        except ValueError:
+            entry_to_remove = None
         
         if not entry_to_remove:
             raise HTTPException(status_code=404, detail="Блюдо не найдено")
         
         # Удаляем из базы данных
         try:
-            dt = entry_to_remove["timestamp"]
-            async with async_session() as session:
-                async with session.begin():
-                    await session.execute(delete(UserHistory).where(
-                        UserHistory.user_id == user_id, 
-                        UserHistory.timestamp == dt
-                    ))
+            removed = await delete_history_entries(user_id, entry_to_remove["timestamp"])
         except Exception as e:
             print(f"Ошибка удаления записи из БД: {e}")
             raise HTTPException(status_code=500, detail="Ошибка при удалении из базы данных")
         
-        # Очищаем кэш пользователя
-        api_cache.invalidate_user_cache(user_id)
+        # Обновляем кэш только за день удалённого блюда (по локальной дате пользователя) и сводные данные
+        user_data = await get_user_data(user_id)
+        user_offset = user_data.get("utc_offset", 0)
+        await refresh_meal_caches(
+            user_id, {(entry["timestamp"] + timedelta(hours=user_offset)).date() for entry in removed}, user_offset
+        )
         
         return {
             "status": "success", 
@@ -1604,7 +2394,7 @@ class WeightHistory(BaseModel):
 
 # Эндпоинты для работы с весом
 
-@app.post("/api/weight/{user_id}", response_model=Dict[str, Any])
+@app.post("/api/weight/{user_id}")
 async def add_weight_entry(user_id: str, weight_data: WeightEntry, api_key: str = Depends(verify_api_key)):
     """
     Добавление новой записи веса с автоматическим пересчетом целевых значений
@@ -1729,7 +2519,7 @@ async def add_weight_entry(user_id: str, weight_data: WeightEntry, api_key: str
         await update_user_data(user_id, current_data)
         
         # Очищаем кэш пользователя
-        api_cache.invalidate_user_cache(user_id)
+        await api_cache.invalidate_user_cache(user_id)
         
         weight_change = None
         if old_weight:
@@ -1750,7 +2540,7 @@ async def add_weight_entry(user_id: str, weight_data: WeightEntry, api_key: str
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/weight/{user_id}", response_model=Dict[str, Any])
+@app.get("/api/weight/{user_id}")
 async def get_weight_history(user_id: str, period: str = "month", api_key: str = Depends(verify_api_key)):
     """
     Получение истории веса пользователя
@@ -1760,7 +2550,7 @@ async def get_weight_history(user_id: str, period: str = "month", api_key: str =
         # Импортируем функции из bot.py
         sys.path.append(os.path.dirname(os.path.abspath(__file__)))
         try:
-            from bot import get_user_data, get_history
+            from bot import get_user_data, get_history_range
         except ImportError:
             return {"status": "success", "message": "Test mode", "data": {"entries": [], "current_weight": 70.0}}
         
@@ -1769,12 +2559,6 @@ async def get_weight_history(user_id: str, period: str = "month", api_key: str =
         current_weight = user_data.get("weight")
         goal_weight = user_data.get("goal")
         
-        # Получаем историю
-        history = await get_history(user_id)
-        
-        # Фильтруем записи веса (включая новый тип weight_update)
-        weight_entries = [entry for entry in history if entry.get("type") in ["weight", "weight_update"]]
-        
         # Определяем период для фильтрации
         now = datetime.now()
         if period == "week":
@@ -1788,6 +2572,12 @@ async def get_weight_history(user_id: str, period: str = "month", api_key: str =
         else:
             start_date = now - timedelta(days=30)  # По умолчанию месяц
         
+        # Получаем записи веса за период (включая новый тип weight_update)
+        weight_entries = await get_history_range(
+            user_id, start_date=start_date.date(), types=["weight", "weight_update"],
+            columns=("timestamp", "type", "prompt", "data")
+        )
+        
         # Фильтруем записи по периоду и извлекаем вес из разных источников
         filtered_entries = []
         for entry in weight_entries:
@@ -1859,7 +2649,7 @@ async def delete_weight_entry(user_id: str, timestamp: str = Query(...), api_key
         # Импортируем функции из bot.py
         sys.path.append(os.path.dirname(os.path.abspath(__file__)))
         try:
-            from bot import get_user_data, update_user_data, async_session, UserHistory
+            from bot import get_user_data, update_user_data, async_session, UserHistory, record_user_change
             from sqlalchemy import select, delete as sql_delete
         except ImportError:
             return {"status": "success", "message": "Test mode"}
@@ -1987,16 +2777,18 @@ async def delete_weight_entry(user_id: str, timestamp: str = Query(...), api_key
                         sql_delete(UserHistory).where(UserHistory.id == entry_id)
                     )
                 
+                await record_user_change(session, user_id, "history")
                 await session.commit()
             else:
                 # Если это не последняя запись, просто удаляем
                 await session.execute(
                     sql_delete(UserHistory).where(UserHistory.id == entry_to_delete.id)
                 )
+                await record_user_change(session, user_id, "history")
                 await session.commit()
         
         # Очищаем кэш пользователя
-        api_cache.invalidate_user_cache(user_id)
+        await api_cache.invalidate_user_cache(user_id)
         
         return {
             "status": "success",
@@ -2143,7 +2935,8 @@ async def get_shared_diary(share_token: str):
             # Получаем данные дневника за указанный период
             print(f"📖 Загрузка записей дневника для пользователя {user_id}...")
             result = await session.execute(text("""
-                SELECT timestamp, prompt, response, data, compressed_image
+                SELECT timestamp, prompt, response, data,
+                       (image_key IS NOT NULL OR (compressed_image IS NOT NULL AND compressed_image <> '')) AS has_image, id
                 FROM user_history 
                 WHERE user_id = :user_id AND type IN ('food', 'text')
                 AND DATE(timestamp) BETWEEN :start_date AND :end_date
@@ -2189,7 +2982,7 @@ async def get_shared_diary(share_token: str):
                     "prompt": row[1],
                     "response": row[2],
                     "data": row[3] if row[3] else {},
-                    "image": row[4]
+                    "image_url": meal_image_url(user_id, row[5]) if row[4] else None
                 }
                 for row in meal_entries
             ],
@@ -2220,7 +3013,7 @@ async def get_shared_weight(share_token: str, period: str = "month"):
         print("📡 Подключение к базе данных...")
         # Импортируем настройки базы данных из bot.py
         sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-        from bot import async_session, get_user_data, get_history
+        from bot import async_session, get_user_data, get_history_range
         
         async with async_session() as session:
             print("✅ Подключение к БД установлено")
@@ -2252,14 +3045,6 @@ async def get_shared_weight(share_token: str, period: str = "month"):
             
             print(f"📊 Данные пользователя: вес={current_weight}, цель={goal_weight}")
             
-            # Получаем историю
-            print(f"📚 Получение истории пользователя: {user_id}")
-            history = await get_history(user_id)
-            
-            # Фильтруем записи веса (включая новый тип weight_update)
-            weight_entries = [entry for entry in history if entry.get("type") in ["weight", "weight_update"]]
-            print(f"⚖️ Найдено записей о весе: {len(weight_entries)}")
-            
             # Определяем период для фильтрации
             now = datetime.now()
             if period == "week":
@@ -2273,6 +3058,14 @@ async def get_shared_weight(share_token: str, period: str = "month"):
             else:
                 start_date = now - timedelta(days=30)  # По умолчанию месяц
             
+            # Получаем записи веса за период (включая новый тип weight_update)
+            print(f"📚 Получение истории веса пользователя: {user_id}")
+            weight_entries = await get_history_range(
+                user_id, start_date=start_date.date(), types=["weight", "weight_update"],
+                columns=("timestamp", "type", "prompt", "data")
+            )
+            print(f"⚖️ Найдено записей о весе: {len(weight_entries)}")
+            
             print(f"📅 Фильтрация по периоду: с {start_date.strftime('%Y-%m-%d')} по {now.strftime('%Y-%m-%d')}")
             
             # Фильтруем записи по периоду и извлекаем вес из разных источников
@@ -2367,6 +3160,7 @@ class FavoriteItem(BaseModel):
     carb: int
     fiber: float
     image: Optional[str] = None
+    image_url: Optional[str] = None
     products: Optional[List[Dict[str, Any]]] = None
     added_date: str
 
@@ -2378,14 +3172,14 @@ async def add_favorite(user_id: str, request: FavoriteRequest):
         
         # Импортируем функции из bot.py
         sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-        from bot import async_session, UserHistory, get_user_data
+        from bot import async_session, UserHistory, get_user_data, record_user_change, lock_image_keys
         from sqlalchemy import select, cast, JSON
         
         # Получаем данные дневника за сегодня используя тот же код что в /api/diary-data
         print(f"🔍 Получение данных дневника для пользователя {user_id}...")
         
         # Импортируем функции из bot.py
-        from bot import get_user_data, get_history
+        from bot import get_user_data, get_history_range, entry_macros, NUTRITION_COLUMNS
         
         # Получаем данные пользователя и историю
         user_data = await get_user_data(user_id)
@@ -2400,16 +3194,11 @@ async def add_favorite(user_id: str, request: FavoriteRequest):
             target_date = datetime.now(user_tz).date()
             print(f"📅 Используем сегодняшнюю дату: {target_date}")
         
-        # Получаем историю пользователя
-        history = await get_history(user_id)
-        
-        # Фильтруем записи за указанную дату
-        entries_today = []
-        for entry in history:
-            if entry.get("type") == "food":
-                entry_date = entry['timestamp'].astimezone(user_tz).date()
-                if entry_date == target_date:
-                    entries_today.append(entry)
+        # Получаем блюда за указанную дату
+        entries_today = await get_history_range(
+            user_id, target_date, target_date, user_offset,
+            types=["food"], columns=("id", "timestamp", "response", "has_image", *NUTRITION_COLUMNS)
+        )
         
         print(f"🍽️ Найдено блюд в дневнике за {target_date}: {len(entries_today)}")
         
@@ -2425,7 +3214,7 @@ async def add_favorite(user_id: str, request: FavoriteRequest):
         meal_entry = entries_today[request.meal_id - 1]
         
         # Парсим данные блюда используя те же функции что в API
-        kcal, prot, fat, carb, fiber = parse_nutrition_cached(meal_entry['response'])
+        kcal, prot, fat, carb, fiber = entry_macros(meal_entry)
         description = parse_products_cached(meal_entry['response'])
         
         print(f"✅ Блюдо найдено: {description[:50]}...")
@@ -2443,6 +3232,19 @@ async def add_favorite(user_id: str, request: FavoriteRequest):
             if existing_result.scalar_one_or_none():
                 raise HTTPException(status_code=400, detail="Блюдо уже в избранном")
             
+            # Избранное ссылается на само фото, а не на запись о еде:
+            # после удаления блюда из дневника фото избранного остаётся
+            image_query = (
+                select(UserHistory.image_key, UserHistory.image_renditions, UserHistory.compressed_image)
+                .where(UserHistory.id == meal_entry['id'])
+            )
+            image_key, image_renditions, image_base64 = (await session.execute(image_query)).first() or (None, None, None)
+            if image_key:
+                # Под блокировкой ключа фото не удалится из хранилища, пока избранное не сохранено
+                await lock_image_keys(session, [image_key])
+                if not (await session.execute(image_query)).first():
+                    raise HTTPException(status_code=404, detail="Блюдо не найдено")
+            
             # Добавляем в избранное с полными данными блюда
             favorite_data = {
                 "meal_id": request.meal_id,
@@ -2453,7 +3255,7 @@ async def add_favorite(user_id: str, request: FavoriteRequest):
                 "fat": fat,
                 "carb": carb,
                 "fiber": fiber,
-                "image": meal_entry.get('compressed_image', ''),
+                "image_url": None,
                 "full_response": meal_entry['response'],
                 "added_date": datetime.now(timezone.utc).isoformat()
             }
@@ -2461,11 +3263,18 @@ async def add_favorite(user_id: str, request: FavoriteRequest):
             new_favorite = UserHistory(
                 user_id=user_id,
                 type="favorite",
-                data=json.dumps(favorite_data),
+                image_key=image_key,
+                image_renditions=image_renditions,
+                compressed_image=None if image_key else image_base64,
                 timestamp=datetime.now(timezone.utc).replace(tzinfo=None)
             )
             
             session.add(new_favorite)
+            await session.flush()
+            if meal_entry['has_image']:
+                favorite_data["image_url"] = meal_image_url(user_id, new_favorite.id)
+            new_favorite.data = json.dumps(favorite_data)
+            await record_user_change(session, user_id, "favorites")
             await session.commit()
         
         print(f"✅ Блюдо {request.meal_id} добавлено в избранное пользователя {user_id}")
@@ -2481,6 +3290,15 @@ async def add_favorite(user_id: str, request: FavoriteRequest):
         print(f"❌ Ошибка при добавлении в избранное: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка при добавлении в избранное: {str(e)}")
 
+async def release_favorite_images(removed: list):
+    """Удаляет фото удалённого избранного из хранилища, если на него больше никто не ссылается"""
+    try:
+        sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+        from bot import release_meal_images
+        await release_meal_images(removed)
+    except Exception as e:
+        print(f"Не удалось удалить фото избранного из хранилища: {e}")
+
 @app.delete("/favorites/{user_id}")
 async def remove_favorite(user_id: str, request: FavoriteRequest):
     """Удалить блюдо из избранного"""
@@ -2489,7 +3307,8 @@ async def remove_favorite(user_id: str, request: FavoriteRequest):
         
         # Импортируем функции из bot.py
         sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-        from bot import async_session, UserHistory, get_user_data, get_history
+        from bot import async_session, UserHistory, get_user_data, get_history_range, record_user_change
+        from bot import entry_macros, NUTRITION_COLUMNS
         from sqlalchemy import select, delete, cast, JSON, String
         
         # Получаем данные пользователя для timezone
@@ -2530,12 +3349,15 @@ async def remove_favorite(user_id: str, request: FavoriteRequest):
                 favorite_record = sorted_favorites[request.meal_id - 1]
                 
                 print(f"✅ Найдена запись избранного для удаления: ID={favorite_record.id}")
+                removed = [{"image_key": favorite_record.image_key, "image_renditions": favorite_record.image_renditions}]
                 
                 # Удаляем найденную запись
                 await session.execute(
                     delete(UserHistory).where(UserHistory.id == favorite_record.id)
                 )
+                await record_user_change(session, user_id, "favorites")
                 await session.commit()
+                await release_favorite_images(removed)
                 
                 print(f"✅ Блюдо {request.meal_id} удалено из избранного пользователя {user_id}")
                 
@@ -2544,14 +3366,11 @@ async def remove_favorite(user_id: str, request: FavoriteRequest):
                     "message": "Блюдо удалено из избранного"
                 }
         
-        # Получаем историю и находим блюдо
-        history = await get_history(user_id)
-        entries_for_date = []
-        for entry in history:
-            if entry.get("type") == "food":
-                entry_date = entry['timestamp'].astimezone(user_tz).date()
-                if entry_date == target_date:
-                    entries_for_date.append(entry)
+        # Получаем блюда за дату и находим нужное
+        entries_for_date = await get_history_range(
+            user_id, target_date, target_date, user_offset,
+            types=["food"], columns=("timestamp", "response", *NUTRITION_COLUMNS)
+        )
         
         print(f"🍽️ Найдено блюд за {target_date}: {len(entries_for_date)}")
         
@@ -2563,7 +3382,7 @@ async def remove_favorite(user_id: str, request: FavoriteRequest):
         
         # Получаем блюдо для проверки
         meal_entry = entries_for_date[request.meal_id - 1]
-        kcal, prot, fat, carb, fiber = parse_nutrition_cached(meal_entry['response'])
+        kcal, prot, fat, carb, fiber = entry_macros(meal_entry)
         description = parse_products_cached(meal_entry['response'])
         
         print(f"🔍 Ищем в избранном блюдо: {description[:50]}...")
@@ -2600,12 +3419,15 @@ async def remove_favorite(user_id: str, request: FavoriteRequest):
             favorite_record = favorite_result.scalar_one_or_none()
             if not favorite_record:
                 raise HTTPException(status_code=404, detail="Блюдо не найдено в избранном")
+            removed = [{"image_key": favorite_record.image_key, "image_renditions": favorite_record.image_renditions}]
             
             # Удаляем из избранного
             await session.execute(
                 delete(UserHistory).where(UserHistory.id == favorite_record.id)
             )
+            await record_user_change(session, user_id, "favorites")
             await session.commit()
+        await release_favorite_images(removed)
         
         print(f"✅ Блюдо {request.meal_id} удалено из избранного пользователя {user_id}")
         
@@ -2620,55 +3442,63 @@ async def remove_favorite(user_id: str, request: FavoriteRequest):
         print(f"❌ Ошибка при удалении из избранного: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка при удалении из избранного: {str(e)}")
 
+async def load_favorites(user_id: str) -> list:
+    """Список избранных блюд пользователя, от недавно добавленных"""
+    # Импортируем функции из bot.py
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    from bot import async_session, UserHistory
+    from sqlalchemy import select
+    
+    # Получаем все записи избранного
+    async with async_session() as session:
+        favorites_result = await session.execute(
+            select(UserHistory).where(
+                UserHistory.user_id == user_id,
+                UserHistory.type == "favorite"
+            ).order_by(UserHistory.timestamp.desc())
+        )
+        
+        favorites_records = favorites_result.scalars().all()
+    
+    favorites_list = []
+    for favorite_record in favorites_records:
+        try:
+            favorite_data = json.loads(favorite_record.data)
+            
+            # Теперь данные уже сохранены в избранном, просто извлекаем их
+            favorite_item = {
+                "meal_id": favorite_data.get("meal_id"),
+                "description": favorite_data.get("description", "Описание недоступно"),
+                "time": favorite_data.get("time", ""),
+                "calories": favorite_data.get("calories", 0),
+                "protein": favorite_data.get("protein", 0),
+                "fat": favorite_data.get("fat", 0),
+                "carb": favorite_data.get("carb", 0),
+                "fiber": favorite_data.get("fiber", 0),
+                "image": favorite_data.get("image", ""),
+                "image_url": meal_image_url(user_id, favorite_record.id) if favorite_record.image_key or favorite_record.compressed_image else None,
+                "full_response": favorite_data.get("full_response", ""),
+                "added_date": favorite_data.get("added_date", favorite_record.timestamp.isoformat())
+            }
+            favorites_list.append(favorite_item)
+                
+        except Exception as e:
+            print(f"Ошибка обработки записи избранного: {e}")
+            continue
+    
+    return favorites_list
+
 @app.get("/favorites/{user_id}")
-async def get_favorites(user_id: str):
+async def get_favorites(user_id: str, request: Request, response: Response):
     """Получить список избранных блюд"""
+    not_modified = await conditional_get(request, response, user_id)
+    if not_modified:
+        return not_modified
+    
     try:
         print(f"📋 Получение избранного для пользователя {user_id}")
         
-        # Импортируем функции из bot.py
-        sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-        from bot import async_session, UserHistory, get_history
-        from sqlalchemy import select
-        
-        # Получаем все записи избранного
-        async with async_session() as session:
-            favorites_result = await session.execute(
-                select(UserHistory).where(
-                    UserHistory.user_id == user_id,
-                    UserHistory.type == "favorite"
-                ).order_by(UserHistory.timestamp.desc())
-            )
-            
-            favorites_records = favorites_result.scalars().all()
-        
-        # Получаем историю пользователя для получения данных о блюдах
-        history = await get_history(user_id)
-        
-        favorites_list = []
-        for favorite_record in favorites_records:
-            try:
-                favorite_data = json.loads(favorite_record.data)
-                
-                # Теперь данные уже сохранены в избранном, просто извлекаем их
-                favorite_item = {
-                    "meal_id": favorite_data.get("meal_id"),
-                    "description": favorite_data.get("description", "Описание недоступно"),
-                    "time": favorite_data.get("time", ""),
-                    "calories": favorite_data.get("calories", 0),
-                    "protein": favorite_data.get("protein", 0),
-                    "fat": favorite_data.get("fat", 0),
-                    "carb": favorite_data.get("carb", 0),
-                    "fiber": favorite_data.get("fiber", 0),
-                    "image": favorite_data.get("image", ""),
-                    "full_response": favorite_data.get("full_response", ""),
-                    "added_date": favorite_data.get("added_date", favorite_record.timestamp.isoformat())
-                }
-                favorites_list.append(favorite_item)
-                    
-            except Exception as e:
-                print(f"Ошибка обработки записи избранного: {e}")
-                continue
+        favorites_list = await load_favorites(user_id)
         
         print(f"✅ Найдено {len(favorites_list)} избранных блюд для пользователя {user_id}")
         
@@ -2720,7 +3550,7 @@ async def clear_user_cache(user_id: str):
     Принудительно очищает весь кэш пользователя для мгновенного обновления данных
     """
     try:
-        api_cache.invalidate_user_cache(user_id)
+        await api_cache.invalidate_user_cache(user_id)
         return {
             "status": "success",
             "message": f"Кэш пользователя {user_id} очищен",
@@ -0,0 +1,217 @@
+"""
+Сравнение сериализации ответов API: прежний путь (валидация response_model=Dict[str, Any]
++ стандартный json) против нового (orjson без повторной валидации) и размер тела
+без сжатия, с gzip и brotli.
+
+Ответы строятся настоящими функциями API (build_stats, get_shared_diary) по базе DATABASE_URL.
+/shared-diary сравнивается в двух вариантах: как сейчас (ссылки на фото, image_url) и как отдавал
+прежний /shared-diary — с полным фото записи в base64 в поле image.
+
+Нужны те же переменные окружения, что и боту (DATABASE_URL, TELEGRAM_TOKEN, OPENAI_KEYS).
+Пользователь-фикстура (месяц приёмов пищи с фото, вес, ссылка на дневник) создаётся
+только по --seed — запускать его на тестовой базе, не на рабочей.
+
+Запуск: python benchmark_responses.py [--seed] [--user-id ID] [--runs 200]
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import gzip
+import io
+import json
+import os
+import random
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from sqlalchemy import text
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+FIXTURE_USER_ID = "900000001"
+FIXTURE_DAYS = 30
+# (название, граммы, ккал, белки, жиры, углеводы, клетчатка) на порцию
+FIXTURE_DISHES = [
+    ("Овсяная каша на молоке", 250, 255, 9, 8, 37, 4.0),
+    ("Банан", 120, 107, 1, 0, 25, 2.1),
+    ("Куриная грудка жареная", 150, 248, 46, 6, 0, 0.0),
+    ("Рис отварной", 180, 209, 4, 1, 45, 0.7),
+    ("Греческий салат", 200, 188, 5, 16, 8, 2.4),
+    ("Творог 5%", 180, 218, 31, 9, 5, 0.0),
+    ("Борщ со сметаной", 300, 171, 5, 9, 17, 3.0),
+    ("Гречка отварная", 200, 220, 8, 2, 43, 5.4),
+    ("Омлет из двух яиц", 130, 240, 15, 19, 2, 0.0),
+    ("Хлеб ржаной", 40, 86, 3, 1, 17, 2.3),
+]
+
+def fixture_photo(rng: random.Random) -> bytes:
+    """Фото «тарелки» 1280×960: градиент с шумом, сжимается в JPEG примерно как снимок еды"""
+    from PIL import Image, ImageDraw, ImageFilter
+    image = Image.effect_noise((1280, 960), 40).convert("RGB")
+    tint = Image.new("RGB", (1280, 960), tuple(rng.randint(90, 230) for _ in range(3)))
+    image = Image.blend(image, tint, 0.6)
+    draw = ImageDraw.Draw(image)
+    for _ in range(6):
+        x, y, r = rng.randint(200, 1080), rng.randint(150, 810), rng.randint(60, 220)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randint(30, 255) for _ in range(3)))
+    image = image.filter(ImageFilter.GaussianBlur(1.5))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=92)
+    return buffer.getvalue()
+
+def fixture_meal(rng: random.Random) -> tuple:
+    """Ответ бота и разобранные ингредиенты для случайного приёма пищи — в формате handle_photo"""
+    items = []
+    for name, grams, kcal, protein, fat, carb, fiber in rng.sample(FIXTURE_DISHES, rng.randint(1, 3)):
+        items.append({"name": name, "grams": grams, "kcal": kcal, "protein": protein,
+                      "fat": fat, "carb": carb, "fiber": fiber})
+    lines = ["🍽 Состав блюда:"]
+    lines += [f"• {i['name']} – {i['grams']} г, {i['kcal']} ккал" for i in items]
+    total = {k: sum(i[k] for i in items) for k in ("kcal", "protein", "fat", "carb", "fiber")}
+    lines.append(
+        f"📊 Итого: {total['kcal']} ккал, Белки: {total['protein']} г, Жиры: {total['fat']} г, "
+        f"Углеводы: {total['carb']} г, Клетчатка: {round(total['fiber'], 1)} г"
+    )
+    return "\n".join(lines), items
+
+async def seed_fixture(user_id: str) -> str:
+    """Создаёт пользователя-фикстуру через функции бота и ссылку на его дневник; возвращает токен ссылки"""
+    from bot import (engine, Base, check_and_fix_database_structure, update_user_data, add_history_entry,
+                     process_photo, meal_photo_fields, nutrition_totals)
+    from api_server import create_diary_share
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    with contextlib.redirect_stdout(io.StringIO()):
+        await check_and_fix_database_structure()
+
+    rng = random.Random(42)
+    await update_user_data(user_id, {
+        "first_name": "Анна", "gender": "female", "age": 32, "height": 168, "weight": 68.0, "goal": 63.0,
+        "activity": "medium", "utc_offset": 3, "profile_stage": None,
+        "target_kcal": 1850, "target_protein": 110, "target_fat": 62, "target_carb": 210, "target_fiber": 25,
+    })
+    now = datetime.utcnow().replace(microsecond=0)
+    for day in range(FIXTURE_DAYS):
+        for hour in (5, 9, 13, 17):
+            response, items = fixture_meal(rng)
+            image_bytes, _, _, renditions = process_photo(fixture_photo(rng))
+            image_fields, images = meal_photo_fields(image_bytes, renditions)
+            await add_history_entry(user_id, {
+                "prompt": "", "response": response, "type": "food", "data": items,
+                "timestamp": now - timedelta(days=day, hours=hour, minutes=rng.randint(0, 59)),
+                **nutrition_totals(items), **image_fields,
+            }, images=images)
+        if day % 3 == 0:
+            weight = round(68.0 - (FIXTURE_DAYS - day) * 0.05, 1)
+            await add_history_entry(user_id, {
+                "prompt": f"Обновление веса: {weight} кг", "response": f"Вес обновлен на {weight} кг",
+                "type": "weight", "timestamp": now - timedelta(days=day), "data": {"weight": weight},
+            })
+    with contextlib.redirect_stdout(io.StringIO()):
+        share = await create_diary_share(user_id, period="week")
+    return share["share_token"]
+
+async def find_share_token(user_id: str) -> str | None:
+    from bot import async_session
+    async with async_session() as session:
+        result = await session.execute(text("""
+            SELECT share_token FROM diary_shares
+            WHERE user_id = :user_id AND expires_at > :now
+            ORDER BY created_at DESC LIMIT 1
+        """), {"user_id": user_id, "now": datetime.now().isoformat()})
+        row = result.first()
+    return row[0] if row else None
+
+async def with_inline_images(user_id: str, shared: Dict[str, Any]) -> Dict[str, Any]:
+    """Ответ /shared-diary в прежнем виде: вместо image_url — полное фото записи в base64"""
+    from bot import find_meal_image, load_meal_image
+    entries = []
+    for entry in shared["data"]["meal_entries"]:
+        match = re.search(r"/api/meal-image/[^/]+/(\d+)", entry.get("image_url") or "")
+        data = None
+        if match:
+            image = await find_meal_image(user_id, int(match.group(1)))
+            data = await load_meal_image(user_id, int(match.group(1)), image) if image else None
+        entry = {key: value for key, value in entry.items() if key != "image_url"}
+        entry["image"] = base64.b64encode(data).decode() if data else None
+        entries.append(entry)
+    return {**shared, "data": {**shared["data"], "meal_entries": entries}}
+
+async def build_payloads(user_id: str) -> Dict[str, Dict[str, Any]]:
+    from api_server import api_cache, build_stats, get_shared_diary
+    share_token = await find_share_token(user_id)
+    if share_token is None:
+        raise SystemExit(f"У пользователя {user_id} нет действующей ссылки на дневник (создать фикстуру: --seed)")
+    with contextlib.redirect_stdout(io.StringIO()):
+        stats = await build_stats(api_cache.get_cache_key("stats", user_id), user_id)
+        shared = await get_shared_diary(share_token)
+    return {
+        "/api/stats": stats,
+        "/shared-diary": shared,
+        "/shared-diary (фото в base64)": await with_inline_images(user_id, shared),
+    }
+
+DICT_ADAPTER = TypeAdapter(Dict[str, Any])
+
+def serialize_before(payload: Dict[str, Any]) -> bytes:
+    """response_model=Dict[str, Any] + JSONResponse: валидация, jsonable_encoder, json.dumps"""
+    validated = DICT_ADAPTER.validate_python(payload)
+    content = jsonable_encoder(validated)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+def serialize_after(payload: Dict[str, Any]) -> bytes:
+    """ORJSONResponse без response_model: jsonable_encoder, orjson.dumps"""
+    content = jsonable_encoder(payload)
+    return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+def cpu_time_ms(func, payload, runs: int) -> float:
+    """Среднее процессорное время одного вызова, мс"""
+    start = time.process_time()
+    for _ in range(runs):
+        func(payload)
+    return (time.process_time() - start) * 1000 / runs
+
+def sizes(body: bytes) -> str:
+    parts = [f"raw {len(body)}", f"gzip {len(gzip.compress(body, compresslevel=6))}"]
+    if brotli is not None:
+        parts.append(f"br {len(brotli.compress(body, quality=5))}")
+    return ", ".join(parts)
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--user-id", default=FIXTURE_USER_ID)
+    parser.add_argument("--seed", action="store_true", help="создать пользователя-фикстуру (только тестовая база)")
+    parser.add_argument("--runs", type=int, default=200)
+    args = parser.parse_args()
+    if orjson is None:
+        raise SystemExit("orjson не установлен: pip install orjson")
+    if args.seed:
+        await seed_fixture(args.user_id)
+    payloads = await build_payloads(args.user_id)
+    for endpoint, payload in payloads.items():
+        before, after = serialize_before(payload), serialize_after(payload)
+        assert json.loads(before) == json.loads(after)
+        before_ms = cpu_time_ms(serialize_before, payload, args.runs)
+        after_ms = cpu_time_ms(serialize_after, payload, args.runs)
+        print(endpoint)
+        print(f"  до:    {before_ms:.3f} мс CPU, байт: {sizes(before)}")
+        print(f"  после: {after_ms:.3f} мс CPU, байт: {sizes(after)}")
+        print(f"  ускорение сериализации: x{before_ms / after_ms:.1f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -11,15 +11,22 @@ import io
 import os
 from dotenv import load_dotenv
 import base64
+import binascii
+import hashlib
 import random
 import re
 from unicodedata import normalize as uni_normalize
 from datetime import datetime, timedelta, date, timezone
 import asyncio
+import time
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import Column, Integer, String, Float, DateTime, JSON, Boolean, Text, select, delete
+from sqlalchemy.orm import sessionmaker, deferred
+from sqlalchemy import Column, Integer, String, Float, DateTime, Date, JSON, Boolean, Text, LargeBinary, Index, select, delete, update, func, and_, or_
 from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import declarative_base
 from collections import OrderedDict
 from sqlalchemy import delete
@@ -51,8 +58,6 @@ class LimitedCache(OrderedDict):
         if len(self) > self.limit:
             self.popitem(last=False)
 
-product_cache = LimitedCache(limit=2000)
-
 # 📅 Отслеживание даты последнего фото от пользователя: user_id -> date
 last_photo_date: dict[int, date] = {}
 
@@ -79,30 +84,21 @@ async def calculate_summary_text(user_id: str, date_str: str) -> str:
 
         async with async_session() as session:
             result = await session.execute(
-                select(UserHistory).where(
+                select(
+                    func.count(UserHistory.id),
+                    *[func.coalesce(func.sum(getattr(UserHistory, c)), 0) for c in NUTRITION_COLUMNS]
+                ).where(
                     UserHistory.user_id == user_id,
                     UserHistory.timestamp >= datetime.combine(target_date, datetime.min.time()),
                     UserHistory.timestamp < datetime.combine(target_date + timedelta(days=1), datetime.min.time()),
                     UserHistory.type == "food"
                 )
             )
-            entries = result.scalars().all()
+            entries_count, total_kcal, total_prot, total_fat, total_carb, total_fiber = result.one()
 
-        if not entries:
+        if not entries_count:
             return "📭 В этот день не было добавлено ни одного блюда."
 
-        total_kcal = total_prot = total_fat = total_carb = total_fiber = 0.0
-
-        for entry in entries:
-            match = re.search(r"(\d+(?:[.,]\d+)?) ккал, Белки: (\d+(?:[.,]\d+)?) г, Жиры: (\d+(?:[.,]\d+)?) г, Углеводы: (\d+(?:[.,]\d+)?) г, Клетчатка: (\d+(?:[.,]\d+)?) г", entry.response)
-            if match:
-                kcal, prot, fat, carb, fiber = map(lambda x: float(x.replace(",", ".")), match.groups())
-                total_kcal += kcal
-                total_prot += prot
-                total_fat += fat
-                total_carb += carb
-                total_fiber += fiber
-
         total_kcal = round(total_kcal)
         total_prot = round(total_prot)
         total_fat = round(total_fat)
@@ -153,6 +149,52 @@ def round_totals_to_int(text):
         flags=re.IGNORECASE | re.DOTALL
     )
 
+# Колонки user_history с итогами КБЖУ записи о еде
+NUTRITION_COLUMNS = ("kcal", "protein", "fat", "carb", "fiber")
+
+def parse_nutrition_totals(response_text: str) -> tuple:
+    """
+    Извлекает итог КБЖУ из текста ответа бота («📊 Итого: … ккал, Белки: …»).
+
+    Нужен только при записи и для однократного бэкфилла старых строк —
+    при чтении итоги берутся из колонок kcal/protein/fat/carb/fiber.
+
+    Returns:
+        tuple: (kcal, protein, fat, carb, fiber), нули если итог не найден
+    """
+    match = re.search(
+        r'Итого:\s*[~≈]?\s*(\d+\.?\d*)\s*ккал.*?'
+        r'Белки[:\-]?\s*[~≈]?\s*(\d+\.?\d*)\s*г.*?'
+        r'Жиры[:\-]?\s*[~≈]?\s*(\d+\.?\d*)\s*г.*?'
+        r'Углеводы[:\-]?\s*[~≈]?\s*(\d+\.?\d*)\s*г.*?'
+        r'Клетчатка[:\-]?\s*[~≈]?\s*(\d+\.?\d*)\s*г',
+        response_text or "", flags=re.IGNORECASE | re.DOTALL
+    )
+    if match:
+        kcal, prot, fat, carb = map(lambda x: round(float(x)), match.groups()[:4])
+        fiber = round(float(match.groups()[4]), 1)
+        return kcal, prot, fat, carb, fiber
+    return 0, 0, 0, 0, 0.0
+
+def nutrition_totals(results: list) -> dict:
+    """Итоги КБЖУ по списку продуктов, округлённые так же, как в тексте ответа (round_totals_to_int)"""
+    return {
+        "kcal": round(sum(r["kcal"] for r in results)),
+        "protein": round(sum(r["protein"] for r in results)),
+        "fat": round(sum(r["fat"] for r in results)),
+        "carb": round(sum(r["carb"] for r in results)),
+        "fiber": round(sum(r["fiber"] for r in results), 1),
+    }
+
+def entry_macros(entry: dict) -> tuple:
+    """КБЖУ записи из колонок; текст разбирается только для строк, ещё не прошедших бэкфилл"""
+    if entry.get("kcal") is None:
+        return parse_nutrition_totals(entry.get("response"))
+    return (
+        round(entry["kcal"]), round(entry["protein"] or 0), round(entry["fat"] or 0),
+        round(entry["carb"] or 0), round(entry["fiber"] or 0, 1)
+    )
+
 class FixModeFilter(BoundFilter):
     key = 'fix_mode'
 
@@ -184,6 +226,12 @@ class UserData(Base):
     user_id = Column(String, primary_key=True)
     data = Column(JSON)
 
+class UserDataVersion(Base):
+    """Версия данных пользователя: растёт при каждой записи в историю или профиль (см. record_user_change)"""
+    __tablename__ = "user_data_versions"
+    user_id = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
 class UserHistory(Base):
     __tablename__ = "user_history"
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -193,8 +241,102 @@ class UserHistory(Base):
     timestamp = Column(DateTime)
     type = Column(String)
     data = Column(JSON)
-    compressed_image = Column(Text)  # Добавлено поле для сжатых изображений в формате base64
+    # Сжатое изображение в base64 (старые записи, до переноса в хранилище изображений).
+    # Отложенная загрузка: ORM-запросы не тянут его, пока не попросить явно через undefer()
+    compressed_image = deferred(Column(Text))
+    # Ключ фото в хранилище изображений (sha256 содержимого), см. image_store
+    image_key = Column(String(64))
+    # Ключи уменьшенных копий фото: {"thumb": ..., "thumb_webp": ..., "full_webp": ...}
+    image_renditions = Column(JSON)
+    # Итоги КБЖУ записи о еде, сохраняются при записи (см. add_history_entry)
+    kcal = Column(Float)
+    protein = Column(Float)
+    fat = Column(Float)
+    carb = Column(Float)
+    fiber = Column(Float)
 
+    # Все чтения истории идут по пользователю и диапазону времени
+    __table_args__ = (
+        Index("ix_user_history_user_id_timestamp", "user_id", "timestamp"),
+        # Проверка, ссылаются ли ещё записи на фото, перед его удалением из хранилища
+        Index("ix_user_history_image_key", "image_key"),
+    )
+
+class MealImage(Base):
+    """Фото блюд в бинарном виде (хранилище IMAGE_STORE=db), ключ — sha256 содержимого"""
+    __tablename__ = "meal_images"
+    key = Column(String(64), primary_key=True)
+    content_type = Column(String, nullable=False, default="image/jpeg")
+    data = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+class DailyNutritionRollup(Base):
+    """
+    Итоги КБЖУ пользователя за локальный день.
+    Обновляется инкрементально при добавлении/удалении записей о еде,
+    поэтому статистика читается одним запросом по первичному ключу.
+    """
+    __tablename__ = "daily_nutrition_rollup"
+    user_id = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    kcal = Column(Float, nullable=False, default=0)
+    protein = Column(Float, nullable=False, default=0)
+    fat = Column(Float, nullable=False, default=0)
+    carb = Column(Float, nullable=False, default=0)
+    fiber = Column(Float, nullable=False, default=0)
+    meal_count = Column(Integer, nullable=False, default=0)
+
+class DataMigration(Base):
+    """Выполненные однократные пересчёты данных (например, первичное заполнение daily_nutrition_rollup)"""
+    __tablename__ = "data_migrations"
+    name = Column(String, primary_key=True)
+    completed_at = Column(DateTime, nullable=False)
+
+class IngredientResolution(Base):
+    """
+    Результат сопоставления ингредиента со справочником (второй уровень кэша, общий
+    для процессов и переживающий перезапуски). КБЖУ — на 100 г.
+    status: "db" — найден в справочнике, "gpt" — не найден, значения оценены GPT
+    (пока не накоплено достаточно оценок, см. IngredientEstimate), "miss" — не найден, оценки ещё нет.
+    """
+    __tablename__ = "ingredient_resolution"
+    key = Column(String, primary_key=True)
+    status = Column(String, nullable=False)
+    matched_name = Column(String)
+    kcal = Column(Float)
+    protein = Column(Float)
+    fat = Column(Float)
+    carb = Column(Float)
+    fiber = Column(Float)
+    updated_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class PhotoAnalysis(Base):
+    """
+    Первый этап анализа фото (список продуктов от GPT): scope — пользователь и подпись
+    (см. photo_analysis_scope), dhash — перцептивный хэш фото (см. image_dhash)
+    """
+    __tablename__ = "photo_analysis_cache"
+    key = Column(String, primary_key=True)
+    scope = Column(String, nullable=False, index=True)
+    dhash = Column(String(16), nullable=False)
+    food_items = Column(JSON, nullable=False)
+    created_at = Column(DateTime, nullable=False, index=True)
+
+class IngredientEstimate(Base):
+    """
+    Накопленные оценки GPT для ингредиентов, которых нет в справочнике:
+    среднее КБЖУ на 100 г по всем ответам GPT и число таких ответов.
+    """
+    __tablename__ = "ingredient_estimates"
+    name_key = Column(String, primary_key=True)
+    occurrences = Column(Integer, nullable=False, default=0)
+    kcal = Column(Float, nullable=False, default=0)
+    protein = Column(Float, nullable=False, default=0)
+    fat = Column(Float, nullable=False, default=0)
+    carb = Column(Float, nullable=False, default=0)
+    fiber = Column(Float, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False)
 
 
 class Product(Base):
@@ -208,36 +350,17 @@ class Product(Base):
     fiber = Column(Float)
 
 async def search_product_by_name(name: str) -> dict:
-    async with async_session() as session:
-        # 1. Сначала точное совпадение по имени
-        result = await session.execute(
-            select(Product).where(Product.name.ilike(name)).limit(1)
-        )
-        product = result.scalar()
-        if product:
-            return {
-                "name": product.name,
-                "kcal": product.kcal,
-                "protein": product.protein,
-                "fat": product.fat,
-                "carb": product.carb,
-                "fiber": product.fiber,
-            }
-        # 2. Если не совпало — ищем по подстроке (как было раньше)
-        result = await session.execute(
-            select(Product).where(Product.name.ilike(f"%{name}%")).limit(1)
-        )
-        product = result.scalar()
-        if product:
-            return {
-                "name": product.name,
-                "kcal": product.kcal,
-                "protein": product.protein,
-                "fat": product.fat,
-                "carb": product.carb,
-                "fiber": product.fiber,
-            }
-        return {}
+    product = await product_catalogue.match(name, "products")
+    if product:
+        return {
+            "name": product["matched_name"],
+            "kcal": product["kcal"],
+            "protein": product["protein"],
+            "fat": product["fat"],
+            "carb": product["carb"],
+            "fiber": product["fiber"],
+        }
+    return {}
 
 function_definitions = [
     {
@@ -262,6 +385,37 @@ def normalize(text: str) -> str:
     text = unicodedata.normalize("NFKD", text.lower()).replace("ё", "е")
     return "".join([c for c in text if not unicodedata.combining(c)]).strip()
 
+# Фото готовится один раз: одна уменьшенная JPEG-копия идёт и в GPT, и в базу
+PHOTO_MAX_EDGE = int(os.getenv("PHOTO_MAX_EDGE", "768"))
+PHOTO_JPEG_QUALITY = int(os.getenv("PHOTO_JPEG_QUALITY", "75"))
+
+def prepare_photo(image_bytes: bytes, max_edge: int = PHOTO_MAX_EDGE, quality: int = PHOTO_JPEG_QUALITY) -> bytes:
+    """
+    Уменьшает фото по длинной стороне до max_edge и пережимает в JPEG
+
+    Args:
+        image_bytes: Исходные байты изображения
+        max_edge: Максимальная длина длинной стороны
+        quality: Качество JPEG (1-100)
+
+    Returns:
+        bytes: JPEG
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    # JPEG сразу декодируется в уменьшенном масштабе, без полноразмерной копии в памяти
+    image.draft("RGB", (max_edge, max_edge))
+
+    # Конвертируем в RGB если нужно (для JPEG)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGB')
+
+    # Изменяем размер с сохранением пропорций
+    image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality, optimize=True)
+    return buffer.getvalue()
+
 def compress_image(image_bytes: bytes, max_size: tuple = (600, 600), quality: int = 70) -> str:
     """
     Сжимает изображение и возвращает его в формате base64
@@ -275,34 +429,453 @@ def compress_image(image_bytes: bytes, max_size: tuple = (600, 600), quality: in
         str: Сжатое изображение в формате base64
     """
     try:
-        # Открываем изображение
-        image = Image.open(io.BytesIO(image_bytes))
-        
-        # Конвертируем в RGB если нужно (для JPEG)
-        if image.mode in ('RGBA', 'LA', 'P'):
-            image = image.convert('RGB')
-        
-        # Изменяем размер с сохранением пропорций
-        image.thumbnail(max_size, Image.Resampling.LANCZOS)
-        
-        # Сохраняем в буфер
-        buffer = io.BytesIO()
-        image.save(buffer, format='JPEG', quality=quality, optimize=True)
-        
-        # Конвертируем в base64
-        image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        
-        return image_base64
+        return base64.b64encode(prepare_photo(image_bytes, max(max_size), quality)).decode('utf-8')
     except Exception as e:
         logging.error(f"Ошибка при сжатии изображения: {e}")
         return ""
 
+def image_dhash(image_bytes: bytes, hash_size: int = 8) -> str:
+    """
+    Перцептивный dHash изображения: картинка уменьшается до (hash_size+1)×hash_size в оттенках
+    серого, каждый бит — светлее ли пиксель соседа справа. У пережатых и пересланных копий
+    одного фото хэши совпадают или отличаются в нескольких битах (см. dhash_distance).
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft("L", (hash_size * 8, hash_size * 8))  # JPEG декодируется сразу в уменьшенном виде
+    pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS).getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+def photo_analysis_scope(user_id: str, caption: str | None) -> str:
+    """
+    Область поиска в кэше анализа фото: пользователь + нормализованная подпись (она влияет на ответ GPT).
+    Похожие фото разных пользователей никогда не делят ответ
+    """
+    caption_hash = hashlib.md5(normalize(caption or "").encode("utf-8")).hexdigest()[:16]
+    return f"{user_id}:{caption_hash}"
+
+def dhash_distance(first: str, second: str) -> int:
+    """Расстояние Хэмминга между двумя dHash — число различающихся бит"""
+    return bin(int(first, 16) ^ int(second, 16)).count("1")
+
+# Уменьшенные копии фото для списков в WebApp: миниатюра по длинной стороне и WebP-варианты (по желанию)
+IMAGE_THUMB_EDGE = int(os.getenv("IMAGE_THUMB_EDGE", "96"))
+IMAGE_WEBP = os.getenv("IMAGE_WEBP", "0") == "1"
+# Тип содержимого по названию копии: полное фото — JPEG (image_key), остальные — см. make_renditions
+RENDITION_CONTENT_TYPES = {
+    "full": "image/jpeg",
+    "thumb": "image/jpeg",
+    "full_webp": "image/webp",
+    "thumb_webp": "image/webp",
+}
+
+def make_renditions(photo_bytes: bytes, quality: int = PHOTO_JPEG_QUALITY) -> dict:
+    """
+    Делает уменьшенные копии уже подготовленного фото (prepare_photo).
+
+    Returns:
+        dict: название копии -> байты ("thumb", при IMAGE_WEBP ещё "thumb_webp" и "full_webp")
+    """
+    image = Image.open(io.BytesIO(photo_bytes))
+    image.load()
+    thumb = image.copy()
+    thumb.thumbnail((IMAGE_THUMB_EDGE, IMAGE_THUMB_EDGE), Image.Resampling.LANCZOS)
+
+    def encode(img, image_format: str) -> bytes:
+        buffer = io.BytesIO()
+        if image_format == "WEBP":
+            img.save(buffer, format="WEBP", quality=quality, method=4)
+        else:
+            img.save(buffer, format="JPEG", quality=quality, optimize=True)
+        return buffer.getvalue()
+
+    renditions = {"thumb": encode(thumb, "JPEG")}
+    if IMAGE_WEBP:
+        renditions["thumb_webp"] = encode(thumb, "WEBP")
+        renditions["full_webp"] = encode(image, "WEBP")
+    return renditions
+
+def process_photo(image_bytes: bytes) -> tuple:
+    """
+    Вся CPU-работа над входящим фото за один проход (выполняется в пуле ImagePipeline).
+    Если фото не удалось подготовить (битый файл, неподдерживаемый формат), исключение
+    пробрасывается: исходный файл не уходит ни в GPT, ни в базу
+
+    Returns:
+        tuple: (подготовленный JPEG, он же в base64, dHash или None, уменьшенные копии — см. make_renditions)
+    """
+    image_bytes = prepare_photo(image_bytes)
+    try:
+        photo_hash = image_dhash(image_bytes)
+    except Exception as e:
+        logging.error(f"Не удалось посчитать хэш фото: {e}")
+        photo_hash = None
+    try:
+        renditions = make_renditions(image_bytes)
+    except Exception as e:
+        logging.error(f"Не удалось сделать уменьшенные копии фото: {e}")
+        renditions = {}
+    return image_bytes, base64.b64encode(image_bytes).decode("utf-8"), photo_hash, renditions
+
+# Пул для обработки изображений: "thread" или "process", число воркеров и лимит задач в обработке
+IMAGE_POOL_KIND = os.getenv("IMAGE_POOL_KIND", "thread")
+IMAGE_POOL_WORKERS = int(os.getenv("IMAGE_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+IMAGE_PIPELINE_MAX_IN_FLIGHT = int(os.getenv("IMAGE_PIPELINE_MAX_IN_FLIGHT", str(IMAGE_POOL_WORKERS * 2)))
+
+class ImagePipeline:
+    """
+    Обработка изображений вне event loop бота: задачи уходят в пул потоков или процессов,
+    одновременно в пуле не больше max_in_flight задач, остальные ждут своей очереди.
+    Собирает метрики очереди — глубину, пиковую глубину и время ожидания/обработки.
+    """
+
+    def __init__(self, kind: str = "thread", workers: int = 2, max_in_flight: int = 4):
+        self.kind = kind
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self._executor = None
+        self._semaphore = None
+        self.metrics = {
+            "waiting": 0, "in_flight": 0, "max_waiting": 0,
+            "completed": 0, "failed": 0, "wait_seconds": 0.0, "run_seconds": 0.0
+        }
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image")
+        return self._executor
+
+    async def run(self, func, *args):
+        """Выполняет func(*args) в пуле; для пула процессов func должна быть функцией модуля"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        metrics = self.metrics
+        queued_at = time.monotonic()
+        metrics["waiting"] += 1
+        metrics["max_waiting"] = max(metrics["max_waiting"], metrics["waiting"])
+        try:
+            await self._semaphore.acquire()
+        finally:
+            metrics["waiting"] -= 1
+
+        started_at = time.monotonic()
+        metrics["wait_seconds"] += started_at - queued_at
+        metrics["in_flight"] += 1
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+            metrics["completed"] += 1
+            return result
+        except Exception:
+            metrics["failed"] += 1
+            raise
+        finally:
+            metrics["in_flight"] -= 1
+            metrics["run_seconds"] += time.monotonic() - started_at
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        metrics = self.metrics
+        finished = metrics["completed"] + metrics["failed"]
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "max_in_flight": self.max_in_flight,
+            **{k: metrics[k] for k in ("waiting", "in_flight", "max_waiting", "completed", "failed")},
+            "avg_wait_ms": round(metrics["wait_seconds"] / finished * 1000, 1) if finished else 0,
+            "avg_run_ms": round(metrics["run_seconds"] / finished * 1000, 1) if finished else 0
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+image_pipeline = ImagePipeline(IMAGE_POOL_KIND, IMAGE_POOL_WORKERS, IMAGE_PIPELINE_MAX_IN_FLIGHT)
+
+# Где хранить фото блюд: "db" — таблица meal_images (bytea), "fs" — файлы в IMAGE_STORE_PATH
+# (каталог должен быть общим для бота и API)
+IMAGE_STORE = os.getenv("IMAGE_STORE", "db")
+IMAGE_STORE_PATH = os.getenv("IMAGE_STORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "meal_images"))
+
+class DatabaseImageStore:
+    """Фото в таблице meal_images. С session запись и удаление идут в транзакции вызывающего"""
+
+    async def put(self, key: str, data: bytes, content_type: str = "image/jpeg", session=None):
+        stmt = pg_insert(MealImage.__table__).values(
+            key=key, data=data, content_type=content_type, created_at=datetime.utcnow()
+        ).on_conflict_do_nothing(index_elements=["key"])
+        if session is not None:
+            await session.execute(stmt)
+            return
+        async with async_session() as session:
+            async with session.begin():
+                await session.execute(stmt)
+
+    async def get(self, key: str) -> bytes | None:
+        async with async_session() as session:
+            result = await session.execute(select(MealImage.data).where(MealImage.key == key))
+            return result.scalar()
+
+    async def delete(self, keys: list, session=None):
+        stmt = delete(MealImage).where(MealImage.key.in_(keys))
+        if session is not None:
+            await session.execute(stmt)
+            return
+        async with async_session() as session:
+            async with session.begin():
+                await session.execute(stmt)
+
+class FileSystemImageStore:
+    """
+    Фото файлами на диске: <root>/<первые 2 символа ключа>/<ключ>.
+    Фото, сохранённые до появления уменьшенных копий, лежат как <ключ>.jpg — читаются и удаляются тоже
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def _legacy_path(self, key: str) -> str:
+        return f"{self._path(key)}.jpg"
+
+    def _write(self, path: str, data: bytes):
+        if os.path.exists(path) or os.path.exists(f"{path}.jpg"):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _read(self, path: str) -> bytes | None:
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _remove(self, paths: list):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    async def put(self, key: str, data: bytes, content_type: str = "image/jpeg", session=None):
+        await asyncio.to_thread(self._write, self._path(key), data)
+
+    async def get(self, key: str) -> bytes | None:
+        data = await asyncio.to_thread(self._read, self._path(key))
+        if data is None:
+            data = await asyncio.to_thread(self._read, self._legacy_path(key))
+        return data
+
+    async def delete(self, keys: list, session=None):
+        await asyncio.to_thread(self._remove, [path for key in keys for path in (self._path(key), self._legacy_path(key))])
+
+image_store = FileSystemImageStore(IMAGE_STORE_PATH) if IMAGE_STORE == "fs" else DatabaseImageStore()
+
+def meal_photo_fields(photo_bytes: bytes, renditions: dict) -> tuple:
+    """
+    Ключи фото и его уменьшенных копий (sha256 содержимого — одинаковые фото хранятся один раз).
+
+    Returns:
+        tuple: (поля записи истории — image_key и image_renditions,
+                файлы для хранилища — ключ -> (байты, content type), см. store_meal_images)
+    """
+    images = {hashlib.sha256(photo_bytes).hexdigest(): (photo_bytes, "image/jpeg")}
+    rendition_keys = {}
+    for name, data in renditions.items():
+        rendition_keys[name] = hashlib.sha256(data).hexdigest()
+        images[rendition_keys[name]] = (data, RENDITION_CONTENT_TYPES[name])
+    return {"image_key": next(iter(images)), "image_renditions": rendition_keys}, images
+
+async def lock_image_keys(session, keys):
+    """
+    Блокирует ключи фото до конца транзакции session (advisory lock): сохранение фото вместе
+    с записью, которая на него ссылается, и проверка ссылок перед удалением не пересекаются
+    """
+    for key in sorted(set(keys)):
+        await session.execute(select(func.pg_advisory_xact_lock(func.hashtext(key))))
+
+async def store_meal_images(session, images: dict):
+    """Сохраняет файлы фото в хранилище под блокировкой их ключей, в транзакции записи истории"""
+    await lock_image_keys(session, images)
+    for key, (data, content_type) in images.items():
+        await image_store.put(key, data, content_type, session=session)
+
+async def release_meal_images(entries) -> None:
+    """
+    Удаляет из хранилища фото удалённых записей (с копиями), если на них не ссылаются другие записи.
+    Проверка ссылок и удаление идут в одной транзакции под блокировкой ключей,
+    поэтому параллельное сохранение того же фото не теряет файл
+    """
+    renditions_by_key = {
+        entry["image_key"]: entry.get("image_renditions") or {}
+        for entry in entries if entry.get("image_key")
+    }
+    if not renditions_by_key:
+        return
+    async with async_session() as session:
+        async with session.begin():
+            await lock_image_keys(session, renditions_by_key)
+            result = await session.execute(
+                select(UserHistory.image_key).where(UserHistory.image_key.in_(list(renditions_by_key))).distinct()
+            )
+            still_used = {row[0] for row in result.all()}
+            # Копии однозначно определяются содержимым полного фото, поэтому удаляются вместе с ним
+            orphaned = []
+            for key, renditions in renditions_by_key.items():
+                if key not in still_used:
+                    orphaned.extend([key, *renditions.values()])
+            if orphaned:
+                await image_store.delete(orphaned, session=session)
+
+async def migrate_history_images(batch_size: int = 100) -> int:
+    """
+    Однократно переносит base64-фото из user_history.compressed_image в хранилище
+    изображений вместе с уменьшенными копиями: пачками по первичному ключу,
+    после переноса base64 в записи очищается.
+
+    Returns:
+        int: Количество перенесённых фото
+    """
+    migrated = 0
+    last_id = 0
+    try:
+        while True:
+            async with async_session() as session:
+                result = await session.execute(
+                    select(UserHistory.id, UserHistory.compressed_image).where(
+                        UserHistory.id > last_id,
+                        UserHistory.image_key.is_(None),
+                        UserHistory.compressed_image.isnot(None),
+                        UserHistory.compressed_image != ""
+                    ).order_by(UserHistory.id).limit(batch_size)
+                )
+                rows = result.all()
+            if not rows:
+                break
+
+            updates, images = [], {}
+            for entry_id, image_base64 in rows:
+                try:
+                    data = base64.b64decode(image_base64)
+                    renditions = await image_pipeline.run(make_renditions, data)
+                except Exception as e:
+                    logging.warning(f"Фото записи {entry_id} повреждено, пропускаем: {e}")
+                    continue
+                fields, entry_images = meal_photo_fields(data, renditions)
+                updates.append({"id": entry_id, **fields, "compressed_image": None})
+                images.update(entry_images)
+
+            if updates:
+                async with async_session() as session:
+                    async with session.begin():
+                        await store_meal_images(session, images)
+                        await session.execute(update(UserHistory), updates)
+            migrated += len(updates)
+            last_id = rows[-1][0]
+    except Exception as e:
+        logging.error(f"Ошибка переноса фото в хранилище: {e}")
+    if migrated:
+        logging.info(f"Перенесено фото в хранилище изображений: {migrated}")
+    return migrated
+
+# Сколько хранится результат анализа фото
+PHOTO_ANALYSIS_TTL = timedelta(days=int(os.getenv("PHOTO_ANALYSIS_TTL_DAYS", "7")))
+# Сколько бит dHash (из 64) может отличаться у копий одного фото: пережатие и пересылка меняют единицы бит
+PHOTO_ANALYSIS_MAX_DISTANCE = int(os.getenv("PHOTO_ANALYSIS_MAX_DISTANCE", "6"))
+# Сколько последних фото пользователя с той же подписью сравнивается при поиске
+PHOTO_ANALYSIS_SCOPE_LIMIT = 200
+
+class PhotoAnalysisCache:
+    """
+    Кэш первого этапа анализа фото: LRU в памяти процесса и таблица photo_analysis_cache.
+    Повторно присланное (или пересланное, пережатое) тем же пользователем фото с той же подписью
+    не отправляется в GPT: ответ берётся у ближайшего по dHash фото, если оно отличается
+    не больше чем на PHOTO_ANALYSIS_MAX_DISTANCE бит.
+    """
+
+    def __init__(self, limit: int = 500):
+        self.local = LimitedCache(limit=limit)  # scope -> {dhash: запись}
+
+    @staticmethod
+    def closest(records: dict, photo_hash: str, now: datetime) -> list | None:
+        best = None
+        for dhash, record in records.items():
+            if record["created_at"] + PHOTO_ANALYSIS_TTL <= now:
+                continue
+            distance = dhash_distance(dhash, photo_hash)
+            if distance <= PHOTO_ANALYSIS_MAX_DISTANCE and (best is None or distance < best[0]):
+                best = (distance, record["food_items"])
+        return best[1] if best else None
+
+    async def get(self, scope: str, photo_hash: str) -> list | None:
+        now = datetime.utcnow()
+        food_items = self.closest(self.local.get(scope, {}), photo_hash, now)
+        if food_items is not None:
+            return food_items
+        try:
+            async with async_session() as session:
+                result = await session.execute(
+                    select(PhotoAnalysis.dhash, PhotoAnalysis.food_items, PhotoAnalysis.created_at).where(
+                        PhotoAnalysis.scope == scope,
+                        PhotoAnalysis.created_at > now - PHOTO_ANALYSIS_TTL
+                    ).order_by(PhotoAnalysis.created_at.desc()).limit(PHOTO_ANALYSIS_SCOPE_LIMIT)
+                )
+                rows = result.all()
+        except Exception as e:
+            logging.error(f"Ошибка чтения кэша анализа фото: {e}")
+            return None
+        records = {dhash: {"food_items": items, "created_at": created_at} for dhash, items, created_at in rows}
+        self.local[scope] = records
+        return self.closest(records, photo_hash, now)
+
+    async def put(self, scope: str, photo_hash: str, food_items: list):
+        now = datetime.utcnow()
+        records = self.local.get(scope) or {}
+        records[photo_hash] = {"food_items": food_items, "created_at": now}
+        self.local[scope] = records
+        stmt = pg_insert(PhotoAnalysis.__table__).values(
+            key=f"{scope}:{photo_hash}", scope=scope, dhash=photo_hash, food_items=food_items, created_at=now
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["key"],
+            set_={c: stmt.excluded[c] for c in ("food_items", "created_at")}
+        )
+        try:
+            async with async_session() as session:
+                async with session.begin():
+                    await session.execute(stmt)
+        except Exception as e:
+            logging.error(f"Ошибка записи в кэш анализа фото: {e}")
+
+    async def purge_expired(self):
+        async with async_session() as session:
+            async with session.begin():
+                await session.execute(
+                    delete(PhotoAnalysis).where(PhotoAnalysis.created_at <= datetime.utcnow() - PHOTO_ANALYSIS_TTL)
+                )
+
+photo_analysis_cache = PhotoAnalysisCache(limit=500)
+
 async def get_batch_kbzu(names: list[str]) -> dict:
     results = []
 
-    for name in names:
-        product_data = await match_product_name_to_db(name)
-
+    matches = await match_product_names_to_table(names, "products")
+    for name, (product_data, score) in zip(names, matches):
         if product_data:
             logging.warning(f"[MATCHED ✅] '{name}' => '{product_data['matched_name']}' из базы")
             results.append({
@@ -364,11 +937,8 @@ async def get_batch_kbzu(names: list[str]) -> dict:
     }
 
 async def match_product_names_to_db(names: list[str]) -> list[str]:
-    results = []
-    for name in names:
-        matched = await match_product_name_to_db(name)
-        results.append(matched["matched_name"] if matched else name)
-    return results
+    matches = await match_product_names_to_table(names, "products")
+    return [matched["matched_name"] if matched else name for name, (matched, score) in zip(names, matches)]
 
 
 # Helper to convert datetime in user data to ISO string for JSON storage
@@ -381,41 +951,463 @@ def _convert_user_data(obj):
         return [_convert_user_data(v) for v in obj]
     return obj
 
-async def get_user_data(user_id: str) -> dict:
-    async with async_session() as session:
-        result = await session.get(UserData, user_id)
-        return result.data if result else {}
+async def get_user_data(user_id: str) -> dict:
+    async with async_session() as session:
+        result = await session.get(UserData, user_id)
+        return result.data if result else {}
+
+# Канал LISTEN/NOTIFY, в который публикуются изменения данных пользователей (по нему API обновляет кэш)
+USER_CHANGES_CHANNEL = "user_changes"
+# Идентификатор процесса-источника: процесс, сделавший запись, сам обновляет свой кэш и пропускает своё уведомление
+CHANGE_SOURCE_ID = uuid.uuid4().hex
+
+async def record_user_change(session, user_id: str, kind: str, days=()):
+    """
+    Фиксирует изменение данных пользователя в транзакции session: увеличивает его
+    версию (по ней API строит ETag) и публикует событие в USER_CHANGES_CHANNEL.
+    Подписчики получают уведомление только после коммита.
+
+    Args:
+        kind: "meal" — добавлен или удалён приём пищи (days — его локальные даты),
+              "history" — другие записи истории, "favorites" — избранное, "user_data" — профиль
+    """
+    table = UserDataVersion.__table__
+    stmt = pg_insert(table).values(user_id=user_id, version=1)
+    await session.execute(stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id], set_={"version": table.c.version + 1}
+    ))
+    payload = json.dumps({
+        "user_id": user_id,
+        "kind": kind,
+        "days": sorted({day.isoformat() for day in days}),
+        "source": CHANGE_SOURCE_ID
+    })
+    await session.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": USER_CHANGES_CHANNEL, "payload": payload})
+
+async def get_user_version(user_id: str) -> tuple:
+    """
+    Версия данных пользователя и его часовой пояс — одним запросом по первичному ключу.
+
+    Returns:
+        tuple: (версия, utc_offset); (0, 0) для неизвестного пользователя
+    """
+    async with async_session() as session:
+        result = await session.execute(
+            select(UserDataVersion.version, UserData.data["utc_offset"].as_float())
+            .select_from(UserData)
+            .outerjoin(UserDataVersion, UserDataVersion.user_id == UserData.user_id)
+            .where(UserData.user_id == user_id)
+        )
+        row = result.first()
+    if not row:
+        return 0, 0
+    return row[0] or 0, row[1] or 0
+
+async def update_user_data(user_id: str, data: dict):
+    # Convert datetime objects to ISO strings for JSON
+    safe_data = _convert_user_data(data)
+    async with async_session() as session:
+        async with session.begin():
+            obj = await session.get(UserData, user_id)
+            old_offset = (obj.data or {}).get("utc_offset", 0) if obj else 0
+            if obj:
+                obj.data = safe_data
+            else:
+                session.add(UserData(user_id=user_id, data=safe_data))
+            await record_user_change(session, user_id, "user_data")
+    # Сменился часовой пояс — границы локальных дней сдвинулись, пересчитываем дневные итоги
+    if (safe_data.get("utc_offset", 0) or 0) != (old_offset or 0):
+        await rebuild_daily_rollup(user_id)
+
+# Типы записей истории, которые считаются приёмом пищи
+FOOD_ENTRY_TYPES = ("food", "text")
+
+def _to_naive_utc(timestamp: datetime) -> datetime:
+    """В user_history timestamp хранится как naive UTC"""
+    if timestamp.tzinfo is not None:
+        return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+# Пространство advisory-блокировок итогов пользователя (ключ из двух int4 не пересекается
+# с блокировками ключей фото, см. lock_image_keys)
+ROLLUP_LOCK_NAMESPACE = 1
+
+async def lock_user_rollup(session, user_id: str):
+    """
+    Блокирует дневные итоги пользователя до конца транзакции session: дельта записи о еде
+    и пересчёт итогов этого пользователя (rebuild_daily_rollup) не пересекаются
+    """
+    await session.execute(select(func.pg_advisory_xact_lock(ROLLUP_LOCK_NAMESPACE, func.hashtext(user_id))))
+
+async def _apply_rollup_delta(session, user_id: str, timestamp: datetime, macros: tuple, sign: int = 1):
+    """
+    Прибавляет (sign=1) или вычитает (sign=-1) КБЖУ записи к итогам её локального дня.
+
+    Returns:
+        date: локальный день записи
+    """
+    await lock_user_rollup(session, user_id)
+    user = await session.get(UserData, user_id)
+    utc_offset = ((user.data or {}).get("utc_offset", 0) if user else 0) or 0
+    day = (_to_naive_utc(timestamp) + timedelta(hours=utc_offset)).date()
+    if not (macros[0] or 0) > 0:
+        # Запись без калорий (итог не распознан) считается приёмом пищи, но в КБЖУ дня не входит
+        macros = (0,) * len(NUTRITION_COLUMNS)
+
+    table = DailyNutritionRollup.__table__
+    values = {c: sign * (v or 0) for c, v in zip(NUTRITION_COLUMNS, macros)}
+    stmt = pg_insert(table).values(user_id=user_id, day=day, meal_count=sign, **values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.day],
+        set_={c: table.c[c] + stmt.excluded[c] for c in (*NUTRITION_COLUMNS, "meal_count")}
+    )
+    await session.execute(stmt)
+    if sign < 0:
+        # День без приёмов пищи не храним
+        await session.execute(delete(DailyNutritionRollup).where(
+            DailyNutritionRollup.user_id == user_id,
+            DailyNutritionRollup.day == day,
+            DailyNutritionRollup.meal_count <= 0
+        ))
+    return day
+
+async def add_history_entry(user_id: str, entry: dict, images: dict = None):
+    """
+    Добавляет запись истории. images — файлы фото записи для хранилища
+    (см. meal_photo_fields): сохраняются в той же транзакции, что и запись
+    """
+    if entry.get("type") in FOOD_ENTRY_TYPES and entry.get("kcal") is None:
+        # Итоги не переданы явно (например, после исправления через GPT) — разбираем текст один раз при записи
+        entry = {**entry, **dict(zip(NUTRITION_COLUMNS, parse_nutrition_totals(entry.get("response"))))}
+    async with async_session() as session:
+        async with session.begin():
+            if images:
+                await store_meal_images(session, images)
+            session.add(UserHistory(user_id=user_id, **entry))
+            if entry.get("type") in FOOD_ENTRY_TYPES:
+                day = await _apply_rollup_delta(session, user_id, entry["timestamp"], entry_macros(entry))
+                await record_user_change(session, user_id, "meal", [day])
+            else:
+                await record_user_change(session, user_id, "history")
+
+async def delete_history_entries(user_id: str, timestamp: datetime) -> list:
+    """
+    Удаляет записи истории с указанным timestamp и вычитает их из дневных итогов
+    в той же транзакции.
+
+    Returns:
+        list: Удалённые записи (timestamp, type, response, ключи фото и колонки КБЖУ)
+    """
+    columns = ("timestamp", "type", "response", "image_key", "image_renditions", *NUTRITION_COLUMNS)
+    async with async_session() as session:
+        async with session.begin():
+            result = await session.execute(
+                delete(UserHistory).where(
+                    UserHistory.user_id == user_id,
+                    UserHistory.timestamp == _to_naive_utc(timestamp)
+                ).returning(*[getattr(UserHistory, c) for c in columns])
+            )
+            removed = [dict(zip(columns, row)) for row in result.all()]
+            days = set()
+            for entry in removed:
+                if entry["type"] in FOOD_ENTRY_TYPES:
+                    days.add(await _apply_rollup_delta(session, user_id, entry["timestamp"], entry_macros(entry), sign=-1))
+            if removed:
+                only_meals = all(entry["type"] in FOOD_ENTRY_TYPES for entry in removed)
+                await record_user_change(session, user_id, "meal" if only_meals else "history", days)
+    try:
+        await release_meal_images(removed)
+    except Exception as e:
+        logging.error(f"Не удалось удалить фото из хранилища: {e}")
+    return removed
+
+# Отметка в data_migrations о том, что дневные итоги построены по всей истории
+ROLLUP_MIGRATION = "daily_nutrition_rollup"
+
+async def rebuild_daily_rollup(user_id: str = None):
+    """
+    Пересчитывает дневные итоги из user_history одним SQL-запросом —
+    для одного пользователя или для всех (user_id=None).
+    Нужен при первом запуске и при смене часового пояса пользователя.
+
+    Параллельные записи о еде ждут окончания пересчёта и применяют свою дельту уже
+    к пересчитанным итогам: при полном пересчёте блокируется вся таблица итогов,
+    при пересчёте одного пользователя — только его итоги (lock_user_rollup).
+    """
+    user_filter = "AND h.user_id = :user_id" if user_id else ""
+    params = {"user_id": user_id} if user_id else {}
+    async with async_session() as session:
+        async with session.begin():
+            if user_id:
+                await lock_user_rollup(session, user_id)
+                await session.execute(delete(DailyNutritionRollup).where(DailyNutritionRollup.user_id == user_id))
+            else:
+                await session.execute(text("LOCK TABLE daily_nutrition_rollup IN EXCLUSIVE MODE"))
+                await session.execute(delete(DailyNutritionRollup))
+            await session.execute(text(f"""
+                INSERT INTO daily_nutrition_rollup (user_id, day, kcal, protein, fat, carb, fiber, meal_count)
+                SELECT h.user_id,
+                       CAST(h.timestamp + COALESCE(CAST(u.data ->> 'utc_offset' AS NUMERIC), 0) * INTERVAL '1 hour' AS DATE) AS day,
+                       COALESCE(SUM(h.kcal) FILTER (WHERE h.kcal > 0), 0),
+                       COALESCE(SUM(h.protein) FILTER (WHERE h.kcal > 0), 0),
+                       COALESCE(SUM(h.fat) FILTER (WHERE h.kcal > 0), 0),
+                       COALESCE(SUM(h.carb) FILTER (WHERE h.kcal > 0), 0),
+                       COALESCE(SUM(h.fiber) FILTER (WHERE h.kcal > 0), 0),
+                       COUNT(*)
+                FROM user_history h
+                LEFT JOIN user_data u ON u.user_id = h.user_id
+                WHERE h.type IN ('food', 'text') {user_filter}
+                GROUP BY h.user_id, day
+            """), params)
+            if not user_id:
+                await session.execute(
+                    pg_insert(DataMigration.__table__)
+                    .values(name=ROLLUP_MIGRATION, completed_at=datetime.utcnow())
+                    .on_conflict_do_nothing(index_elements=["name"])
+                )
+
+async def get_daily_rollup(user_id: str, start_date: date = None, end_date: date = None,
+                           newest_first: bool = False, limit: int = None) -> list:
+    """
+    Дневные итоги КБЖУ пользователя из daily_nutrition_rollup — только дни с приёмами пищи,
+    по возрастанию даты (или от новых к старым), не больше limit дней
+    """
+    columns = ("day", *NUTRITION_COLUMNS, "meal_count")
+    conditions = [DailyNutritionRollup.user_id == user_id]
+    if start_date is not None:
+        conditions.append(DailyNutritionRollup.day >= start_date)
+    if end_date is not None:
+        conditions.append(DailyNutritionRollup.day <= end_date)
+    query = (
+        select(*[getattr(DailyNutritionRollup, c) for c in columns])
+        .where(*conditions)
+        .order_by(DailyNutritionRollup.day.desc() if newest_first else DailyNutritionRollup.day)
+    )
+    if limit:
+        query = query.limit(limit)
+    async with async_session() as session:
+        result = await session.execute(query)
+        return [dict(zip(columns, row)) for row in result.all()]
+
+async def backfill_history_nutrition(batch_size: int = 500) -> int:
+    """
+    Однократно заполняет колонки КБЖУ у старых записей о еде, разбирая текст ответа.
+    Работает пачками по первичному ключу, поэтому безопасен для больших таблиц.
+
+    Returns:
+        int: Количество обновлённых записей
+    """
+    updated = 0
+    last_id = 0
+    while True:
+        async with async_session() as session:
+            async with session.begin():
+                result = await session.execute(
+                    select(UserHistory.id, UserHistory.response).where(
+                        UserHistory.id > last_id,
+                        UserHistory.type.in_(["food", "text"]),
+                        UserHistory.kcal.is_(None)
+                    ).order_by(UserHistory.id).limit(batch_size)
+                )
+                rows = result.all()
+                if not rows:
+                    break
+                await session.execute(update(UserHistory), [
+                    {"id": entry_id, **dict(zip(NUTRITION_COLUMNS, parse_nutrition_totals(response)))}
+                    for entry_id, response in rows
+                ])
+        updated += len(rows)
+        last_id = rows[-1][0]
+    if updated:
+        logging.info(f"Бэкфилл КБЖУ: обновлено записей {updated}")
+    return updated
+
+async def prepare_history_aggregates():
+    """
+    Фоновая подготовка агрегатов: бэкфилл КБЖУ, затем первичное заполнение дневных итогов.
+    Итоги строятся, пока нет отметки в data_migrations, — строки, которые успели
+    добавить записи о еде во время бэкфилла, не мешают полному пересчёту
+    """
+    try:
+        await backfill_history_nutrition()
+        async with async_session() as session:
+            rollup_built = await session.get(DataMigration, ROLLUP_MIGRATION)
+        if not rollup_built:
+            await rebuild_daily_rollup()
+            logging.info("Дневные итоги КБЖУ пересчитаны")
+    except Exception as e:
+        logging.error(f"Ошибка подготовки агрегатов истории: {e}")
+
+# Колонки user_history, которые можно запрашивать через get_history_range.
+# has_image — вычисляемый признак наличия фото, без чтения самого base64
+HISTORY_COLUMNS = ("id", "prompt", "response", "timestamp", "type", "data", "compressed_image", "image_key",
+                   "image_renditions", "has_image")
+# По умолчанию изображения не читаются — они отдаются через /api/meal-image
+DEFAULT_HISTORY_COLUMNS = ("id", "prompt", "response", "timestamp", "type", "data")
+
+def _history_column(name: str):
+    if name == "has_image":
+        return or_(
+            UserHistory.image_key.isnot(None),
+            and_(UserHistory.compressed_image.isnot(None), UserHistory.compressed_image != "")
+        ).label("has_image")
+    return getattr(UserHistory, name)
+
+def local_day_bounds(start_date: date, end_date: date, utc_offset: int = 0) -> tuple:
+    """
+    Переводит диапазон локальных дат пользователя в границы по UTC.
+
+    В user_history timestamp хранится как naive UTC, поэтому локальная полночь
+    пользователя сдвигается на его utc_offset.
+
+    Returns:
+        tuple: (начало включительно, конец не включительно) — naive UTC datetime
+    """
+    shift = timedelta(hours=utc_offset)
+    start_utc = datetime.combine(start_date, datetime.min.time()) - shift
+    end_utc = datetime.combine(end_date + timedelta(days=1), datetime.min.time()) - shift
+    return start_utc, end_utc
+
+def _history_filters(user_id: str, start_date=None, end_date=None, utc_offset: int = 0, types=None) -> list:
+    conditions = [UserHistory.user_id == user_id]
+    if start_date is not None or end_date is not None:
+        start_utc, end_utc = local_day_bounds(start_date or end_date, end_date or start_date, utc_offset)
+        if start_date is not None:
+            conditions.append(UserHistory.timestamp >= start_utc)
+        if end_date is not None:
+            conditions.append(UserHistory.timestamp < end_utc)
+    if types:
+        conditions.append(UserHistory.type.in_(list(types)))
+    return conditions
+
+async def get_history_range(
+    user_id: str,
+    start_date: date = None,
+    end_date: date = None,
+    utc_offset: int = 0,
+    types=None,
+    columns=None,
+    newest_first: bool = False,
+    limit: int = None,
+) -> list:
+    """
+    Возвращает записи истории за диапазон локальных дат пользователя.
+
+    Фильтрация по датам, типам, сортировка и выбор колонок выполняются в SQL,
+    поэтому стоимость запроса зависит от размера диапазона, а не от всей истории.
+
+    Args:
+        user_id: ID пользователя
+        start_date: Первая локальная дата (включительно), None — без ограничения
+        end_date: Последняя локальная дата (включительно), None — без ограничения
+        utc_offset: Смещение часового пояса пользователя в часах
+        types: Список типов записей ("food", "text", "weight", ...)
+        columns: Какие колонки вернуть (из HISTORY_COLUMNS), по умолчанию без изображения
+        newest_first: Сортировать от новых к старым
+        limit: Максимальное количество записей
+
+    Returns:
+        list: Список словарей с запрошенными колонками
+    """
+    columns = tuple(columns or DEFAULT_HISTORY_COLUMNS)
+    query = select(*[_history_column(c) for c in columns]).where(
+        *_history_filters(user_id, start_date, end_date, utc_offset, types)
+    )
+    order = UserHistory.timestamp.desc() if newest_first else UserHistory.timestamp
+    query = query.order_by(order)
+    if limit:
+        query = query.limit(limit)
+
+    async with async_session() as session:
+        result = await session.execute(query)
+        return [dict(zip(columns, row)) for row in result.all()]
+
+async def count_history_entries(user_id: str, start_date: date = None, end_date: date = None,
+                                utc_offset: int = 0, types=None) -> int:
+    """Считает записи истории за диапазон локальных дат без загрузки самих строк"""
+    async with async_session() as session:
+        result = await session.execute(
+            select(func.count(UserHistory.id)).where(
+                *_history_filters(user_id, start_date, end_date, utc_offset, types)
+            )
+        )
+        return result.scalar() or 0
+
+async def get_history_entries_at_second(user_id: str, timestamp: datetime, columns=None) -> list:
+    """Записи истории с timestamp в пределах той же секунды (микросекунды игнорируются)"""
+    second_start = _to_naive_utc(timestamp).replace(microsecond=0)
+    columns = tuple(columns or DEFAULT_HISTORY_COLUMNS)
+    async with async_session() as session:
+        result = await session.execute(
+            select(*[_history_column(c) for c in columns]).where(
+                UserHistory.user_id == user_id,
+                UserHistory.timestamp >= second_start,
+                UserHistory.timestamp < second_start + timedelta(seconds=1)
+            ).order_by(UserHistory.timestamp)
+        )
+        return [dict(zip(columns, row)) for row in result.all()]
+
+async def find_meal_image(user_id: str, entry_id: int, size: str = "full", webp: bool = False) -> dict | None:
+    """
+    Какую копию фото записи отдавать: нужного размера ("full" или "thumb") и, если есть, в WebP.
+    Если нужной копии нет (старые записи) — отдаётся полное фото. Сами байты не читаются (load_meal_image)
 
-async def update_user_data(user_id: str, data: dict):
-    # Convert datetime objects to ISO strings for JSON
-    safe_data = _convert_user_data(data)
+    Returns:
+        dict: name — отдаваемая копия ("legacy" — фото ещё в base64 в записи), key — её ключ
+              в хранилище (sha256 содержимого), content_type; None — если фото нет
+    """
     async with async_session() as session:
-        async with session.begin():
-            obj = await session.get(UserData, user_id)
-            if obj:
-                obj.data = safe_data
-            else:
-                session.add(UserData(user_id=user_id, data=safe_data))
+        result = await session.execute(
+            select(UserHistory.image_key, UserHistory.image_renditions, UserHistory.compressed_image.isnot(None)).where(
+                UserHistory.id == entry_id,
+                UserHistory.user_id == user_id
+            )
+        )
+        row = result.first()
+    if not row:
+        return None
+    image_key, renditions, has_base64 = row
+    if image_key:
+        renditions = {"full": image_key, **(renditions or {})}
+        candidates = [f"{size}_webp", size] if webp else [size]
+        name = next((c for c in candidates if c in renditions), "full")
+        return {"name": name, "key": renditions[name], "content_type": RENDITION_CONTENT_TYPES[name]}
+    if has_base64:
+        # Запись ещё не перенесена в хранилище изображений
+        return {"name": "legacy", "key": None, "content_type": "image/jpeg"}
+    return None
 
-async def add_history_entry(user_id: str, entry: dict):
+async def load_meal_image(user_id: str, entry_id: int, image: dict) -> bytes | None:
+    """Байты копии фото, найденной find_meal_image"""
+    if image["key"]:
+        return await image_store.get(image["key"])
     async with async_session() as session:
-        async with session.begin():
-            session.add(UserHistory(user_id=user_id, **entry))
+        result = await session.execute(
+            select(UserHistory.compressed_image).where(
+                UserHistory.id == entry_id,
+                UserHistory.user_id == user_id
+            )
+        )
+        image_base64 = result.scalar()
+    if not image_base64:
+        return None
+    try:
+        return base64.b64decode(image_base64)
+    except (binascii.Error, ValueError):
+        return None
 
-async def get_history(user_id: str) -> list:
+async def get_history_entry(user_id: str, timestamp: datetime, columns=None) -> dict | None:
+    """Находит запись истории по точному timestamp (он же ID записи в кнопках бота)"""
+    columns = tuple(columns or DEFAULT_HISTORY_COLUMNS)
     async with async_session() as session:
-        result = await session.execute(select(UserHistory).where(UserHistory.user_id == user_id).order_by(UserHistory.timestamp))
-        entries = result.scalars().all()
-        history_list = []
-        for e in entries:
-            history_list.append({
-                "prompt": e.prompt,
-                "response": e.response,
-                "timestamp": e.timestamp,
-                "type": e.type,
-                "compressed_image": e.compressed_image  # Добавляем поле compressed_image
-            })
-        return history_list
+        result = await session.execute(
+            select(*[_history_column(c) for c in columns]).where(
+                UserHistory.user_id == user_id,
+                UserHistory.timestamp == timestamp
+            ).limit(1)
+        )
+        row = result.first()
+        return dict(zip(columns, row)) if row else None
 
 # Custom filter for profile stage
 class ProfileStageFilter(BoundFilter):
@@ -505,6 +1497,10 @@ async def clean_old_photos():
         to_delete = [uid for uid, data in recent_photos.items() if data["time"] < cutoff]
         for uid in to_delete:
             del recent_photos[uid]
+        try:
+            await photo_analysis_cache.purge_expired()
+        except Exception as e:
+            logging.error(f"Ошибка очистки кэша анализа фото: {e}")
 
 
 
@@ -514,26 +1510,9 @@ async def clean_old_photos():
 import json
 
 async def get_kbzu_from_db(food_name: str):
-    async with async_session() as session:
-        result = await session.execute(select(Product.name))
-        all_names = [row[0] for row in result.all()]
-
-    match, score, _ = process.extractOne(food_name, all_names, scorer=fuzz.token_sort_ratio)
-
-    if score > 90:
-        async with async_session() as session:
-            result = await session.execute(select(Product).where(Product.name == match))
-            product = result.scalar()
-            if product:
-                return {
-                    "matched_name": match,
-                    "source": "db",
-                    "kcal": product.kcal,
-                    "protein": product.protein,
-                    "fat": product.fat,
-                    "carb": product.carb,
-                    "fiber": product.fiber
-                }
+    product = await product_catalogue.match(food_name, "products")
+    if product:
+        return {**product, "source": "db"}
 
     # Продукт не найден → вернём заготовку и скажем GPT, что нужно додумать
     return {
@@ -552,34 +1531,6 @@ from rapidfuzz import process, fuzz
 COOKED_KEYWORDS = ["отвар", "варен", "варён", "жарен", "запеч", "гриль", "тушен"]
 RAW_KEYWORDS = ["сырой", "сырое", "сырая", "сырые", "сухой", "сухая", "сухие", "неприготов"]
 
-# Эти переменные нужно инициализировать один раз при старте
-product_list = []
-product_map = {}
-
-async def load_products_from_db():
-    global product_list, product_map
-    async with async_session() as session:
-        result = await session.execute(select(Product))
-        products = result.scalars().all()
-
-        product_list = []
-        product_map = {}
-
-        for p in products:
-            norm_name = normalize(p.name)
-            replaced_name = replace_similar_words(norm_name)
-
-            product_list.append(replaced_name)
-            product_map[replaced_name] = {
-                "matched_name": p.name,
-                "source": "db",
-                "kcal": p.kcal,
-                "protein": p.protein,
-                "fat": p.fat,
-                "carb": p.carb,
-                "fiber": p.fiber
-            }
-
 SIMILAR_WORDS = {
     "вареные": "отварные",
     "варёные": "отварные",
@@ -610,6 +1561,10 @@ def replace_similar_words(text: str) -> str:
     replaced = [SIMILAR_WORDS.get(word.lower(), word.lower()) for word in words]
     return " ".join(replaced)
 
+def catalogue_key(name: str) -> str:
+    """Единая нормализация названий продуктов — и для строк справочника, и для запросов"""
+    return replace_similar_words(normalize(name))
+
 
 
 openai_index = 0  # глобальный счётчик
@@ -686,36 +1641,24 @@ async def show_today_summary_callback(callback_query: CallbackQuery):
     user_offset = data.get("utc_offset", 0)
     user_tz = timezone(timedelta(hours=user_offset))
     target_date = datetime.now(user_tz).date()
-    history_list = await get_history(user_id)
-    if not history_list or all(e["timestamp"].astimezone(user_tz).date() != target_date for e in history_list):
+    entries_today = await get_history_range(
+        user_id, target_date, target_date, user_offset,
+        types=["food", "text"], columns=("timestamp", "response", *NUTRITION_COLUMNS)
+    )
+    if not entries_today:
         # If no history at all or none for today
-        if not history_list:
+        if not await count_history_entries(user_id):
             await bot.send_message(chat_id, "Ты ещё не присылала фото еды 🍽️")
         else:
             await bot.send_message(chat_id, f"Нет данных на {target_date.strftime('%Y-%m-%d')} 📅")
         await callback_query.answer()
         return
-    entries_today = [e for e in history_list if e["timestamp"].astimezone(user_tz).date() == target_date]
 
     # Calculate totals and send each entry summary with delete button
     total_kcal = total_prot = total_fat = total_carb = total_fiber = 0
     for i, entry in enumerate(entries_today, start=1):
-        kcal = prot = fat = carb = fiber = 0
-
-
-        match = re.search(
-            r'Итого:\s*[~≈]?\s*(\d+\.?\d*)\s*ккал.*?'
-            r'Белки[:\-]?\s*[~≈]?\s*(\d+\.?\d*)\s*г.*?'
-            r'Жиры[:\-]?\s*[~≈]?\s*(\d+\.?\d*)\s*г.*?'
-            r'Углеводы[:\-]?\s*[~≈]?\s*(\d+\.?\d*)\s*г.*?'
-            r'Клетчатка[:\-]?\s*([~≈]?\s*\d+\.?\d*)\s*г',
-            entry['response'], flags=re.IGNORECASE | re.DOTALL
-        )
-
-        if match:
-            kcal, prot, fat, carb = map(lambda x: round(float(x)), match.groups()[:4])
-            fiber = round(float(match.groups()[4]), 1)
-            total_fiber += fiber
+        kcal, prot, fat, carb, fiber = entry_macros(entry)
+        total_fiber += fiber
         total_kcal += kcal
         total_prot += prot
         total_fat += fat
@@ -807,22 +1750,14 @@ async def summary_button_handler(message: types.Message):
 async def delete_entry(callback_query: CallbackQuery):
     user_id = str(callback_query.from_user.id)
     entry_id = callback_query.data.split(":", 1)[1]
-    history_list = await get_history(user_id)
-    if not history_list or len(history_list) == 0:
-        await callback_query.answer("История пуста.")
-        return
-    entry_to_remove = None
-    for entry in history_list:
-        if entry["timestamp"].isoformat() == entry_id:
-            entry_to_remove = entry
-            break
+    try:
+        entry_to_remove = await get_history_entry(user_id, datetime.fromisoformat(entry_id), columns=("timestamp",))
+    except ValueError:
+        entry_to_remove = None
     if entry_to_remove:
         # Remove from database
         try:
-            dt = entry_to_remove["timestamp"]
-            async with async_session() as session:
-                async with session.begin():
-                    await session.execute(delete(UserHistory).where(UserHistory.user_id == user_id, UserHistory.timestamp == dt))
+            await delete_history_entries(user_id, entry_to_remove["timestamp"])
         except Exception as e:
             logging.error(f"Failed to delete entry: {e}")
         # Edit the message with the removed entry
@@ -834,25 +1769,15 @@ async def delete_entry(callback_query: CallbackQuery):
             user_offset = data.get("utc_offset", 0)
             user_tz = timezone(timedelta(hours=user_offset))
             target_date = datetime.now(user_tz).date()
-            # Recompute todaаy's totals without the removed entry
-            entries_today = [e for e in history_list if e["timestamp"].date() == target_date and e["timestamp"] != entry_to_remove["timestamp"]]
+            # Recompute todaаy's totals without the removed entry (it is already deleted from the DB)
+            entries_today = await get_history_range(
+                user_id, target_date, target_date, user_offset,
+                types=["food", "text"], columns=("response", *NUTRITION_COLUMNS)
+            )
             total_kcal = total_prot = total_fat = total_carb = total_fiber = 0
             for e in entries_today:
-                kcal = prot = fat = carb = fiber = 0
-
-                match = re.search(
-                    r'Итого:\s*[~≈]?\s*(\d+\.?\d*)\s*ккал.*?'
-                    r'Белки[:\-]?\s*[~≈]?\s*(\d+\.?\d*)\s*г.*?'
-                    r'Жиры[:\-]?\s*[~≈]?\s*(\d+\.?\d*)\s*г.*?'
-                    r'Углеводы[:\-]?\s*[~≈]?\s*(\d+\.?\d*)\s*г.*?'
-                    r'Клетчатка[:\-]?\s*([~≈]?\s*\d+\.?\d*)\s*г',
-                    entry['response'], flags=re.IGNORECASE | re.DOTALL
-                )
-
-                if match:
-                    kcal, prot, fat, carb = map(lambda x: round(float(x)), match.groups()[:4])
-                    fiber = round(float(match.groups()[4]), 1)
-                    total_fiber += fiber
+                kcal, prot, fat, carb, fiber = entry_macros(e)
+                total_fiber += fiber
                 total_kcal += kcal
                 total_prot += prot
                 total_fat += fat
@@ -921,12 +1846,12 @@ async def delete_entry(callback_query: CallbackQuery):
 @dp.message_handler(commands=['история', 'history'])
 async def show_history(message: types.Message):
     user_id = str(message.from_user.id)
-    history_list = await get_history(user_id)
+    history_list = await get_history_range(user_id, columns=("prompt", "response"), newest_first=True, limit=10)
     if not history_list or len(history_list) == 0:
         await message.reply("История пуста. Сначала отправь фото еды 🍽️")
         return
     text = "🗂 *История последних 10 запросов:*\n\n"
-    for i, entry in enumerate(history_list[-10:], start=1):
+    for i, entry in enumerate(reversed(history_list), start=1):
         prompt_preview = entry['prompt'][:60].strip()
         text += f"{i}. _{prompt_preview}_\n"
         text += f"{entry['response'][:500].strip()}\n\n"
@@ -1295,12 +2220,11 @@ async def handle_photo(message: types.Message):
             await message.reply("Подожди немного перед следующим фото 🙏 Я обрабатываю по одной за раз.")
             return
 
-    history_list = await get_history(user_id)
     user_offset = data.get("utc_offset", 0)
     user_tz = timezone(timedelta(hours=user_offset))
     today = datetime.now(user_tz).date()
-    photo_entries_today = [e for e in history_list if e.get("type") == "food" and e["timestamp"].date() == today]
-    if len(photo_entries_today) >= 10:
+    photo_entries_today = await count_history_entries(user_id, today, today, user_offset, types=["food"])
+    if photo_entries_today >= 10:
         data["last_photo_time"] = now
         await update_user_data(user_id, data)
         await message.reply("⚠️ Сегодня уже загружено 10 фото. Новые будут доступны завтра.")
@@ -1313,8 +2237,14 @@ async def handle_photo(message: types.Message):
     photo = message.photo[-1]
     file = await bot.get_file(photo.file_id)
     file_bytes = await bot.download_file(file.file_path)
-    image_bytes = file_bytes.getvalue()
-    base64_image = base64.b64encode(image_bytes).decode("utf-8")
+    # Одна уменьшенная копия фото — и для запроса к GPT, и для сохранения в базу.
+    # Pillow и base64 работают в пуле, не блокируя обработку других сообщений
+    try:
+        image_bytes, base64_image, photo_hash, renditions = await image_pipeline.run(process_photo, file_bytes.getvalue())
+    except Exception as e:
+        logging.error(f"Ошибка при подготовке фото: {e}")
+        await message.reply("⚠️ Не удалось открыть фото. Пришли его ещё раз обычным фото (не файлом).")
+        return
 
     user_caption = message.caption.strip() if message.caption else None
     caption_block = (
@@ -1329,102 +2259,70 @@ async def handle_photo(message: types.Message):
 
     try:
         client = get_openai_client()
-        messages = [
-            {"role": "system", "content": (
-                "Ты нутрициолог. Пользователь прислал фото еды.\n\n"
-                "Определи, какие продукты на фото, примерный ВЕС каждого (в граммах).\n"
-                "⚠️ Для каждого ингредиента всегда возвращай два значения веса — минимальный (grams_min) и максимальный (grams_max) — на основании видимого объёма.\n"
-                "Если на фото есть предметы с известным размером — такие как вилка, ложка, рука, чашка, кружка или стандартная тарелка — используй их как масштаб для определения веса и размера порции.\n"
-                "Если невозможно использовать масштаб, оценивай по минимально возможной стандартной порции или минимальному объёму в граммах для этого продукта в России (например, ломтик хлеба — 20-40 г, банан — 100-130 г и т.п.).\n"
-                "Всегда указывай только те продукты или ингредиенты, которые явно видны на фото. Каждый видимый ингридиент указывай только ОТДЕЛЬНО. Запрещено объединять продукты в одно блюдо, даже если они соприкасаются. Только раздельные позиции — например: 'лаваш', 'сыр', а не 'лаваш с сыром'\n"
-                "Только продукты в готовом виде (например, 'гречка варёная', 'куриная грудка жареная').\n"
-                "Если видно бренд — укажи 'branded': true, иначе — 'branded': false\n"
-                "Не оценивай КБЖУ, только название, граммы и branded.\n"
-                "Если на фото есть не относящиеся к делу люди, другие части тела, фон — не анализируй их как ингредиенты, а рассматривай только для оценки масштаба."
-                "Ответ СТРОГО верни в формате JSON-списка без пояснений и кода:\n"
-                "[{\"name\": \"название продукта на русском языке\", \"grams_min\": число, \"grams_max\": число, \"branded\": true/false}]"
-            )},
-            {"role": "user", "content": [
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
-                *([caption_block] if caption_block else [])
-            ]}
-        ]
-        try:
-            response = await client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                max_tokens=700,
-                temperature=0,
-                functions=functions,
-                function_call="auto"
-            )
-        except Exception as e:
-            await message.reply("⚠️ Не удалось получить ответ от AI. Попробуй снова через минуту.")
-            logging.error(f"[OpenAI ERROR in handle_photo]: {e}")
-            return
+        # Повторное (или пересланное) фото с той же подписью — берём готовый список продуктов
+        photo_scope = photo_analysis_scope(user_id, user_caption)
+        food_items = await photo_analysis_cache.get(photo_scope, photo_hash) if photo_hash else None
+        if food_items is not None:
+            logging.info(f"[♻️ Повторное фото] {photo_scope}:{photo_hash} — анализ из кэша")
+        else:
+            messages = [
+                {"role": "system", "content": (
+                    "Ты нутрициолог. Пользователь прислал фото еды.\n\n"
+                    "Определи, какие продукты на фото, примерный ВЕС каждого (в граммах).\n"
+                    "⚠️ Для каждого ингредиента всегда возвращай два значения веса — минимальный (grams_min) и максимальный (grams_max) — на основании видимого объёма.\n"
+                    "Если на фото есть предметы с известным размером — такие как вилка, ложка, рука, чашка, кружка или стандартная тарелка — используй их как масштаб для определения веса и размера порции.\n"
+                    "Если невозможно использовать масштаб, оценивай по минимально возможной стандартной порции или минимальному объёму в граммах для этого продукта в России (например, ломтик хлеба — 20-40 г, банан — 100-130 г и т.п.).\n"
+                    "Всегда указывай только те продукты или ингредиенты, которые явно видны на фото. Каждый видимый ингридиент указывай только ОТДЕЛЬНО. Запрещено объединять продукты в одно блюдо, даже если они соприкасаются. Только раздельные позиции — например: 'лаваш', 'сыр', а не 'лаваш с сыром'\n"
+                    "Только продукты в готовом виде (например, 'гречка варёная', 'куриная грудка жареная').\n"
+                    "Если видно бренд — укажи 'branded': true, иначе — 'branded': false\n"
+                    "Не оценивай КБЖУ, только название, граммы и branded.\n"
+                    "Если на фото есть не относящиеся к делу люди, другие части тела, фон — не анализируй их как ингредиенты, а рассматривай только для оценки масштаба."
+                    "Ответ СТРОГО верни в формате JSON-списка без пояснений и кода:\n"
+                    "[{\"name\": \"название продукта на русском языке\", \"grams_min\": число, \"grams_max\": число, \"branded\": true/false}]"
+                )},
+                {"role": "user", "content": [
+                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
+                    *([caption_block] if caption_block else [])
+                ]}
+            ]
+            try:
+                response = await client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=messages,
+                    max_tokens=700,
+                    temperature=0,
+                    functions=functions,
+                    function_call="auto"
+                )
+            except Exception as e:
+                await message.reply("⚠️ Не удалось получить ответ от AI. Попробуй снова через минуту.")
+                logging.error(f"[OpenAI ERROR in handle_photo]: {e}")
+                return
 
-        content = response.choices[0].message.content.strip()
-        if content.startswith("```"):
-            content = content.replace("```json", "").replace("```", "").strip()
+            content = response.choices[0].message.content.strip()
+            if content.startswith("```"):
+                content = content.replace("```json", "").replace("```", "").strip()
 
-        logging.warning(f"[GPT raw JSON] {content}")
-        try:
-            food_items = json.loads(content)  # <= ЭТУ строку и всё ниже не меняй!
-        except json.JSONDecodeError:
-            await message.reply("⚠️ Не удалось обработать фото. Попробуй ещё раз.")
-            return
+            logging.warning(f"[GPT raw JSON] {content}")
+            try:
+                food_items = json.loads(content)  # <= ЭТУ строку и всё ниже не меняй!
+            except json.JSONDecodeError:
+                await message.reply("⚠️ Не удалось обработать фото. Попробуй ещё раз.")
+                return
+            if photo_hash:
+                await photo_analysis_cache.put(photo_scope, photo_hash, food_items)
 
         # Проверяем продукты через кэш и БД
-        results = []
-        not_found = []
+        items = []
         for item in food_items:
-            name = item["name"]
             grams_min = item.get("grams_min")
             grams_max = item.get("grams_max")
             if grams_min is not None and grams_max is not None:
                 grams = (grams_min + grams_max) // 2
             else:
                 grams = grams_min or grams_max
-        
-            is_branded = item.get("branded", False)  # 🟡 добавлено поле branded
-            cached = product_cache.get(name.lower())
-            if cached:
-                nutr = cached
-                matched_name = name
-            else:
-                if is_branded:
-                    matched = await match_product_name_to_brand_table(name)  # 🟡 ищем в брендах
-                else:
-                    matched = await match_product_name_to_ready_table(name)  # 🟡 ищем в готовых
-
-                if matched:
-                    nutr = {
-                        "kcal": matched["kcal"],
-                        "protein": matched["protein"],
-                        "fat": matched["fat"],
-                        "carb": matched["carb"],
-                        "fiber": matched["fiber"]
-                    }
-                    product_cache[name.lower()] = nutr
-                    matched_name = matched["matched_name"]
-                else:
-                    nutr = None
-                    matched_name = name
-
-            if nutr:
-                logging.info(f"[✅ Из БД] {matched_name} — {grams} г")
-                results.append({
-                    "name": matched_name,
-                    "grams": grams,
-                    "kcal": round(nutr["kcal"] * grams / 100),
-                    "protein": round(nutr["protein"] * grams / 100, 1),
-                    "fat": round(nutr["fat"] * grams / 100, 1),
-                    "carb": round(nutr["carb"] * grams / 100, 1),
-                    "fiber": round(nutr["fiber"] * grams / 100, 1)
-                })
-            else:
-                logging.warning(f"[❌ GPT сам считает] {name} — {grams} г")
-                not_found.append({"name": name, "grams": grams, "branded": is_branded})
+            items.append({"name": item["name"], "grams": grams, "branded": item.get("branded", False)})  # 🟡 добавлено поле branded
+        results, not_found, estimated_names = await resolve_food_items(items)
 
         # Если есть ненайденные — отправляем второй запрос в GPT
         if not_found:
@@ -1456,6 +2354,7 @@ async def handle_photo(message: types.Message):
             if second_content.startswith("```"):
                 second_content = second_content.replace("```json", "").replace("```", "").strip()
             gpt_items = json.loads(second_content)
+            await remember_gpt_estimates(not_found, gpt_items)
             for item in gpt_items:
                 logging.warning(f"[🧠 Придумано GPT] {item['name']} — {item['grams']} г")
                 results.append({
@@ -1471,7 +2370,7 @@ async def handle_photo(message: types.Message):
         # Собираем итоговое сообщение
         total_kcal = total_prot = total_fat = total_carb = total_fiber = 0
         text_lines = ["🍽️ На фото:"]
-        not_found_names = {item["name"] for item in not_found if item.get("branded")}
+        not_found_names = {item["name"] for item in not_found if item.get("branded")} | estimated_names
         for r in results:
             total_kcal += r["kcal"]
             total_prot += r["protein"]
@@ -1504,8 +2403,9 @@ async def handle_photo(message: types.Message):
     if now.tzinfo is not None:
         now = now.replace(tzinfo=None)
     
-    # Сжимаем изображение для сохранения в базу данных
-    compressed_image = compress_image(image_bytes, max_size=(600, 600), quality=70)
+    # Сохраняем ту же подготовленную копию, что ушла в GPT, и миниатюры — в бинарном виде в хранилище
+    # изображений, в истории только ключи. Если хранилище недоступно — по-старому, base64 в записи
+    image_fields, images = meal_photo_fields(image_bytes, renditions)
     
     try:
         entry = {
@@ -1514,10 +2414,14 @@ async def handle_photo(message: types.Message):
             "timestamp": now,
             "type": "food",  # Исправлено: было "photo", должно быть "food"
             "data": parsed_ingredients,
-            "compressed_image": compressed_image  # Добавляем сжатое изображение
+            **nutrition_totals(parsed_ingredients)
         }
         
-        await add_history_entry(user_id, entry)
+        try:
+            await add_history_entry(user_id, {**entry, **image_fields}, images=images)  # Ссылка на фото блюда
+        except Exception as e:
+            logging.error(f"Не удалось сохранить фото в хранилище: {e}")
+            await add_history_entry(user_id, {**entry, "compressed_image": base64_image})
         
     except Exception as e:
         print(f"❌ ОШИБКА при сохранении записи: {e}")
@@ -1589,11 +2493,10 @@ async def handle_voice_audio(message: types.Message):
     data["usage_count"] = usage_count + 1
     await update_user_data(user_id, data)
 
-    history_list = await get_history(user_id)
     user_offset = data.get("utc_offset", 0)
-    today = datetime.utcnow().astimezone(timezone(timedelta(hours=user_offset))).date()
-    text_entries_today = [e for e in history_list if e.get("type") == "text" and e["timestamp"].date() == today]
-    if len(text_entries_today) >= 60:
+    today = datetime.now(timezone(timedelta(hours=user_offset))).date()
+    text_entries_today = await count_history_entries(user_id, today, today, user_offset, types=["text"])
+    if text_entries_today >= 60:
         await message.reply("⚠️ Сегодня ты уже отправила 10 описаний еды. Новые можно будет отправить завтра.")
         return
 
@@ -1665,46 +2568,10 @@ async def handle_voice_audio(message: types.Message):
         await message.reply(f"⚠️ Ошибка обработки текста: {e}")
         return
 
-    results = []
-    not_found = []
-
-    for item in food_items:
-        name = item["name"]
-        grams = item["grams"]
-        is_branded = item.get("branded", False)
-
-        cached = product_cache.get(name.lower())
-        if cached:
-            nutr = cached
-            matched_name = name
-        else:
-            matched = await match_product_name_to_brand_table(name) if is_branded else await match_product_name_to_ready_table(name)
-            if matched:
-                nutr = {
-                    "kcal": matched["kcal"],
-                    "protein": matched["protein"],
-                    "fat": matched["fat"],
-                    "carb": matched["carb"],
-                    "fiber": matched["fiber"]
-                }
-                matched_name = matched["matched_name"]
-                product_cache[name.lower()] = nutr
-            else:
-                nutr = None
-                matched_name = name
-
-        if nutr:
-            results.append({
-                "name": matched_name,
-                "grams": grams,
-                "kcal": round(nutr["kcal"] * grams / 100),
-                "protein": round(nutr["protein"] * grams / 100, 1),
-                "fat": round(nutr["fat"] * grams / 100, 1),
-                "carb": round(nutr["carb"] * grams / 100, 1),
-                "fiber": round(nutr["fiber"] * grams / 100, 1)
-            })
-        else:
-            not_found.append({"name": name, "grams": grams, "branded": is_branded})
+    # Сопоставление с двумя таблицами (через кэш, одним пакетом для всех ингредиентов)
+    results, not_found, estimated_names = await resolve_food_items(
+        [{"name": item["name"], "grams": item["grams"], "branded": item.get("branded", False)} for item in food_items]
+    )
 
 
     if not_found:
@@ -1728,6 +2595,7 @@ async def handle_voice_audio(message: types.Message):
             if second_content.startswith("```"):
                 second_content = second_content.replace("```json", "").replace("```", "").strip()
             gpt_items = json.loads(second_content)
+            await remember_gpt_estimates(not_found, gpt_items)
             for item in gpt_items:
                 results.append({
                     "name": item["name"],
@@ -1745,7 +2613,7 @@ async def handle_voice_audio(message: types.Message):
 
     total_kcal = total_prot = total_fat = total_carb = total_fiber = 0
     text_lines = ["🍽️ В тарелке:"]
-    not_found_names = {item["name"] for item in not_found if item.get("branded")}
+    not_found_names = {item["name"] for item in not_found if item.get("branded")} | estimated_names
 
     for r in results:
         total_kcal += r["kcal"]
@@ -1764,7 +2632,7 @@ async def handle_voice_audio(message: types.Message):
     if not_found_names:
         text_lines.append("🔸 * — точный состав не найден, возможна погрешность")
 
-    if len(text_entries_today) == 0 and show_hint:
+    if text_entries_today == 0 and show_hint:
         text_lines.append("\n💡 Что-то не учёл? Нажми на кнопку «Исправить» и напиши уточнение или запиши голосом — я пересчитаю.\n")
         text_lines.append("Чтобы посмотреть итоги за день, нажми «🍎 Итоги за день» внизу. Если у тебя открыта клавиатура — нажми на кнопочку справа от поля ввода (похожа на 🎛), и появятся кнопки.")
 
@@ -1777,7 +2645,8 @@ async def handle_voice_audio(message: types.Message):
         "response": answer,
         "timestamp": now,
         "type": "text",
-        "data": results
+        "data": results,
+        **nutrition_totals(results)
     }
     await add_history_entry(user_id, entry)
 
@@ -1872,11 +2741,10 @@ async def handle_text_food(message: types.Message):
     data["usage_count"] = usage_count + 1
     await update_user_data(user_id, data)
 
-    history_list = await get_history(user_id)
     user_offset = data.get("utc_offset", 0)
-    today = datetime.utcnow().astimezone(timezone(timedelta(hours=user_offset))).date()
-    text_entries_today = [e for e in history_list if e.get("type") == "text" and e["timestamp"].date() == today]
-    if len(text_entries_today) >= 60:
+    today = datetime.now(timezone(timedelta(hours=user_offset))).date()
+    text_entries_today = await count_history_entries(user_id, today, today, user_offset, types=["text"])
+    if text_entries_today >= 60:
         await message.reply("⚠️ Сегодня ты уже отправила 10 описаний еды. Новые можно будет отправить завтра.")
         return
 
@@ -1919,52 +2787,10 @@ async def handle_text_food(message: types.Message):
         await message.reply(f"⚠️ Не удалось обработать текст. Попробуй ещё раз.\n{e}")
         return
 
-    # Сопоставление с двумя таблицами
-    results = []
-    not_found = []
-    for item in food_items:
-        name = item["name"]
-        grams = item["grams"]
-        is_branded = item.get("branded", False)
-
-        cached = product_cache.get(name.lower())
-        if cached:
-            nutr = cached
-            matched_name = name
-        else:
-            if is_branded:
-                matched = await match_product_name_to_brand_table(name)
-            else:
-                matched = await match_product_name_to_ready_table(name)
-
-            if matched:
-                nutr = {
-                    "kcal": matched["kcal"],
-                    "protein": matched["protein"],
-                    "fat": matched["fat"],
-                    "carb": matched["carb"],
-                    "fiber": matched["fiber"]
-                }
-                product_cache[name.lower()] = nutr
-                matched_name = matched["matched_name"]
-            else:
-                nutr = None
-                matched_name = name
-
-        if nutr:
-            logging.info(f"[✅ Из БД] {matched_name} — {grams} г")
-            results.append({
-                "name": matched_name,
-                "grams": grams,
-                "kcal": round(nutr["kcal"] * grams / 100),
-                "protein": round(nutr["protein"] * grams / 100, 1),
-                "fat": round(nutr["fat"] * grams / 100, 1),
-                "carb": round(nutr["carb"] * grams / 100, 1),
-                "fiber": round(nutr["fiber"] * grams / 100, 1)
-            })
-        else:
-            logging.warning(f"[❌ GPT сам считает] {name} — {grams} г")
-            not_found.append({"name": name, "grams": grams, "branded": is_branded})
+    # Сопоставление с двумя таблицами (через кэш, одним пакетом для всех ингредиентов)
+    results, not_found, estimated_names = await resolve_food_items(
+        [{"name": item["name"], "grams": item["grams"], "branded": item.get("branded", False)} for item in food_items]
+    )
 
     # Второй GPT-запрос, если что-то не найдено
     if not_found:
@@ -1990,6 +2816,7 @@ async def handle_text_food(message: types.Message):
             if second_content.startswith("```"):
                 second_content = second_content.replace("```json", "").replace("```", "").strip()
             gpt_items = json.loads(second_content)
+            await remember_gpt_estimates(not_found, gpt_items)
             for item in gpt_items:
                 logging.warning(f"[🧠 Придумано GPT] {item['name']} — {item['grams']} г")
                 results.append({
@@ -2008,7 +2835,7 @@ async def handle_text_food(message: types.Message):
     # Формируем итог
     total_kcal = total_prot = total_fat = total_carb = total_fiber = 0
     text_lines = ["🍽️ В тарелке:"]
-    not_found_names = {item["name"] for item in not_found if item.get("branded")}
+    not_found_names = {item["name"] for item in not_found if item.get("branded")} | estimated_names
 
     for r in results:
         total_kcal += r["kcal"]
@@ -2028,7 +2855,7 @@ async def handle_text_food(message: types.Message):
     if not_found_names:
         text_lines.append("🔸 * — точный состав не найден, возможна погрешность")
 
-    if len(text_entries_today) == 0 and show_hint:
+    if text_entries_today == 0 and show_hint:
         text_lines.append("\n💡 Что-то не учёл? Нажми на кнопку «Исправить» и напиши уточнение или запиши голосом — я пересчитаю.\n")
         text_lines.append("Чтобы посмотреть итоги за день, нажми «🍎 Итоги за день» внизу. Если у тебя открыта клавиатура — нажми на кнопочку справа от поля ввода (похожа на 🎛), и появятся кнопки.")
 
@@ -2041,7 +2868,8 @@ async def handle_text_food(message: types.Message):
         "response": answer,
         "timestamp": now,
         "type": "text",
-        "data": results
+        "data": results,
+        **nutrition_totals(results)
     }
     await add_history_entry(user_id, entry)
 
@@ -2080,12 +2908,7 @@ async def handle_fix_input(message: types.Message):
         await message.reply("⚠️ Дата режима 'исправить' повреждена. Режим сброшен.")
         return
 
-    history_list = await get_history(user_id)
-    # Сравниваем timestamp как строку, без микросекунд
-    def ts_clean(val):
-        return str(val).split(".")[0]  # отсекаем микросекунды
-
-    matched_entries = [e for e in history_list if ts_clean(e["timestamp"]) == ts_clean(target_ts)]
+    matched_entries = await get_history_entries_at_second(user_id, target_ts)
     if not matched_entries:
         data["fix_mode"] = None
         data["prompts"] = []
@@ -2128,9 +2951,6 @@ async def handle_fix_input(message: types.Message):
     data["prompts"].append(user_fix)
     await update_user_data(user_id, data)
 
-    history_list = await get_history(user_id)
-    user_offset = data.get("utc_offset", 0)
-    today = datetime.utcnow().astimezone(timezone(timedelta(hours=user_offset))).date()
     timestamp_str = data.get("fix_mode")
     if not timestamp_str:
         data["fix_mode"] = None
@@ -2143,20 +2963,8 @@ async def handle_fix_input(message: types.Message):
     if target_ts.tzinfo is None:
         target_ts = target_ts.replace(tzinfo=timezone.utc)
 
-    # Ищем запись по timestamp, игнорируя микросекунды и разные типы хранения времени
-    def ts_clean(val):
-        try:
-            # если это datetime
-            from datetime import datetime
-            if isinstance(val, datetime):
-                return val.replace(microsecond=0, tzinfo=None).isoformat()
-            # если строка, отрезаем микросекунды
-            return str(val).split(".")[0]
-        except Exception:
-            return str(val)
-    ts_target = ts_clean(target_ts)
-
-    previous_entries = [e for e in history_list if ts_clean(e["timestamp"]) == ts_target]
+    # Ищем запись по timestamp, игнорируя микросекунды
+    previous_entries = await get_history_entries_at_second(user_id, target_ts)
     if not previous_entries:
         await message.reply("⚠️ Не удалось найти запись для исправления.")
         return
@@ -2207,12 +3015,7 @@ async def handle_fix_input(message: types.Message):
         if previous_entries:
             old_entry = previous_entries[0]
             try:
-                async with async_session() as session:
-                    async with session.begin():
-                        await session.execute(delete(UserHistory).where(
-                            UserHistory.user_id == user_id,
-                            UserHistory.timestamp == old_entry["timestamp"]
-                        ))
+                await delete_history_entries(user_id, old_entry["timestamp"])
             except Exception as e:
                 logging.error(f"Failed to delete previous entry: {e}")
         if now.tzinfo is not None:
@@ -2312,6 +3115,31 @@ async def check_and_fix_database_structure():
                 print("✅ Поле compressed_image добавлено!")
             else:
                 print("✅ Поле compressed_image уже существует")
+
+            # Колонки с итогами КБЖУ (заполняются при записи и бэкфиллом)
+            for column in NUTRITION_COLUMNS:
+                await session.execute(text(
+                    f"ALTER TABLE user_history ADD COLUMN IF NOT EXISTS {column} DOUBLE PRECISION"
+                ))
+
+            # Ссылка на фото в хранилище изображений
+            await session.execute(text(
+                "ALTER TABLE user_history ADD COLUMN IF NOT EXISTS image_key VARCHAR(64)"
+            ))
+            await session.execute(text(
+                "ALTER TABLE user_history ADD COLUMN IF NOT EXISTS image_renditions JSON"
+            ))
+
+            # Индекс для выборок истории по пользователю и диапазону дат
+            await session.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_user_history_user_id_timestamp "
+                "ON user_history (user_id, timestamp)"
+            ))
+            # Индекс для проверки ссылок на фото при удалении записей
+            await session.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_user_history_image_key ON user_history (image_key)"
+            ))
+            await session.commit()
             
             # Проверяем несколько последних записей
             print("\n🔍 Проверяем последние записи типа 'food'...")
@@ -2341,7 +3169,6 @@ async def check_and_fix_database_structure():
 
 # Startup and shutdown events
 async def on_startup(dp):
-    await load_products_from_db()
     # Ensure database tables exist
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
@@ -2349,7 +3176,13 @@ async def on_startup(dp):
     # 🔧 Проверяем и исправляем структуру таблицы UserHistory
     await check_and_fix_database_structure()
 
+    # Индексы справочников продуктов в памяти процесса
+    await product_catalogue.refresh(force=True)
+
     # Запустить фоновую задачу
+    asyncio.create_task(prepare_history_aggregates())
+    asyncio.create_task(migrate_history_images())
+    asyncio.create_task(watch_product_tables())
     asyncio.create_task(send_morning_reminders())
     asyncio.create_task(clean_old_photos())
 
@@ -2357,6 +3190,7 @@ async def on_startup(dp):
 
 async def on_shutdown(dp):
     logging.info("Выключение...")
+    image_pipeline.shutdown()
 
 
 from aiohttp import web
@@ -2367,6 +3201,12 @@ WEBHOOK_URL = f"https://via-alina-bot-webhook.onrender.com{WEBHOOK_PATH}"
 async def handle_index(request):
     return web.Response(text="✅ Бот работает.")
 
+async def handle_catalogue_stats(request):
+    return web.json_response(product_catalogue.stats())
+
+async def handle_image_pipeline_stats(request):
+    return web.json_response(image_pipeline.stats())
+
 async def handle_webhook(request):
     try:
         request_data = await request.json()
@@ -2381,19 +3221,44 @@ async def handle_webhook(request):
 def normalize_name(text: str) -> str:
     return text.lower().replace("ё", "е").strip()
 
-async def match_product_name_to_table(name: str, table_name: str) -> dict | None:
-    async with async_session() as session:
-        result = await session.execute(
-            text(f"SELECT name, kcal, protein, fat, carb, fiber FROM {table_name}")
-        )
-        rows = result.fetchall()
+# Таблицы справочника продуктов, по которым идёт сопоставление ингредиентов
+PRODUCT_TABLES = ("products", "productbrend")
+# Как часто (в секундах) проверять, не изменились ли таблицы продуктов
+PRODUCT_INDEX_REFRESH_INTERVAL = int(os.getenv("PRODUCT_INDEX_REFRESH_INTERVAL", "300"))
 
-    norm_name = normalize(name)
-    
-    # 1. Сначала ищем строгое совпадение по нормализованному названию
-    for row in rows:
-        if normalize(row[0]) == norm_name:
-            return {
+class ProductMatcherIndex:
+    """
+    Индекс таблицы продуктов в памяти процесса.
+
+    Названия нормализуются один раз при загрузке (catalogue_key): словарь для точных совпадений,
+    готовый список вариантов для fuzzy-поиска и данные строк по тому же индексу.
+    Поиск продукта не обращается к БД.
+    """
+
+    # Минимальный fuzzy-score (token_set_ratio), при котором продукт считается найденным
+    score_cutoff = 85
+
+    def __init__(self, table_name: str):
+        self.table_name = table_name
+        self.exact = {}
+        self.choices = []
+        self.payloads = []
+        self.signature = None
+        self.loaded = False
+
+    async def load(self):
+        async with async_session() as session:
+            result = await session.execute(
+                text(f"SELECT name, kcal, protein, fat, carb, fiber FROM {self.table_name}")
+            )
+            rows = result.fetchall()
+
+        exact, choices, payloads = {}, [], []
+        for row in rows:
+            if not row[0]:
+                continue
+            norm_name = catalogue_key(row[0])
+            payload = {
                 "matched_name": row[0],
                 "kcal": row[1],
                 "protein": row[2],
@@ -2401,22 +3266,434 @@ async def match_product_name_to_table(name: str, table_name: str) -> dict | None
                 "carb": row[4],
                 "fiber": row[5]
             }
-    # 2. Если не найдено — делаем fuzzy-match как раньше
-    name_list = [normalize(row[0]) for row in rows]
-    match = process.extractOne(norm_name, name_list, scorer=fuzz.token_set_ratio)
+            # При дублях побеждает первая строка — как при прежнем переборе таблицы
+            exact.setdefault(norm_name, payload)
+            choices.append(norm_name)
+            payloads.append(payload)
+
+        # Подменяем структуры целиком, чтобы параллельные поиски не видели полузагруженный индекс
+        self.exact, self.choices, self.payloads = exact, choices, payloads
+        self.loaded = True
+        product_logger.info(f"Индекс продуктов {self.table_name}: загружено {len(choices)} строк")
+
+    async def fetch_signature(self):
+        """Счётчик изменений таблицы из статистики Postgres — дешёвая проверка без чтения строк"""
+        async with async_session() as session:
+            result = await session.execute(
+                text(
+                    "SELECT n_tup_ins + n_tup_upd + n_tup_del FROM pg_stat_user_tables "
+                    "WHERE relname = :table_name"
+                ),
+                {"table_name": self.table_name}
+            )
+            return result.scalar()
+
+    async def refresh(self, force: bool = False) -> bool:
+        """Перезагружает индекс, если таблица изменилась. Возвращает True, если была перезагрузка"""
+        signature = await self.fetch_signature()
+        if force or not self.loaded or signature != self.signature:
+            await self.load()
+            self.signature = signature
+            return True
+        return False
+
+    def match(self, name: str) -> tuple:
+        """
+        Returns:
+            tuple: (данные продукта или None, score)
+        """
+        norm_name = catalogue_key(name)
+
+        # 1. Сначала ищем строгое совпадение по нормализованному названию
+        payload = self.exact.get(norm_name)
+        if payload:
+            return payload, 100.0
+
+        # 2. Если не найдено — fuzzy-match по заранее подготовленному списку
+        if not self.choices:
+            return None, 0.0
+        match = process.extractOne(norm_name, self.choices, scorer=fuzz.token_set_ratio, score_cutoff=self.score_cutoff)
+        if match:
+            return self.payloads[match[2]], float(match[1])
+        return None, 0.0
+
+    def match_many(self, names: list[str]) -> list[tuple]:
+        """
+        Сопоставляет сразу все названия: точные совпадения — по словарю,
+        остальные — одной матрицей process.cdist на всех ядрах.
+
+        Returns:
+            list: (данные продукта или None, score) для каждого названия в том же порядке
+        """
+        norm_names = [catalogue_key(name) for name in names]
+        results = [(self.exact[n], 100.0) if n in self.exact else (None, 0.0) for n in norm_names]
+        pending = [i for i, n in enumerate(norm_names) if n not in self.exact]
+        if not pending or not self.choices:
+            return results
+
+        scores = process.cdist(
+            [norm_names[i] for i in pending], self.choices,
+            scorer=fuzz.token_set_ratio, score_cutoff=self.score_cutoff, workers=-1
+        )
+        best = scores.argmax(axis=1)
+        for row, i in enumerate(pending):
+            score = float(scores[row, best[row]])
+            if score >= self.score_cutoff:
+                results[i] = (self.payloads[best[row]], score)
+        return results
+
+class ProductCatalogue:
+    """
+    Единый справочник продуктов процесса: индексы всех таблиц продуктов и метрики поиска.
+    Через него идут все сопоставления — в обработчиках и в функциях для GPT.
+    """
+
+    def __init__(self, table_names):
+        self.indexes = {table_name: ProductMatcherIndex(table_name) for table_name in table_names}
+        self.metrics = {
+            table_name: {"lookups": 0, "exact_hits": 0, "fuzzy_hits": 0, "misses": 0, "reloads": 0}
+            for table_name in table_names
+        }
+
+    async def _index(self, table_name: str) -> ProductMatcherIndex:
+        index = self.indexes[table_name]
+        if not index.loaded:
+            await self.refresh_table(table_name)
+        return index
+
+    def _record(self, table_name: str, score: float, found: bool):
+        metrics = self.metrics[table_name]
+        metrics["lookups"] += 1
+        if not found:
+            metrics["misses"] += 1
+        elif score >= 100:
+            metrics["exact_hits"] += 1
+        else:
+            metrics["fuzzy_hits"] += 1
+
+    async def match(self, name: str, table_name: str = "products") -> dict | None:
+        index = await self._index(table_name)
+        payload, score = index.match(name)
+        self._record(table_name, score, payload is not None)
+        return payload
+
+    async def match_many(self, names: list[str], table_name: str = "products") -> list[tuple]:
+        """Пакетное сопоставление: (данные продукта или None, score) для каждого названия"""
+        index = await self._index(table_name)
+        results = index.match_many(names)
+        for payload, score in results:
+            self._record(table_name, score, payload is not None)
+        return results
+
+    async def refresh_table(self, table_name: str, force: bool = False):
+        index = self.indexes[table_name]
+        try:
+            was_loaded = index.loaded
+            if await index.refresh(force=force):
+                self.metrics[table_name]["reloads"] += 1
+                if was_loaded and not force:
+                    # Таблица изменилась — сохранённые сопоставления с ней могли устареть
+                    await ingredient_cache.invalidate_table(table_name)
+        except Exception as e:
+            logging.error(f"Не удалось обновить индекс продуктов {table_name}: {e}")
+
+    async def refresh(self, force: bool = False):
+        for table_name in self.indexes:
+            await self.refresh_table(table_name, force=force)
+
+    def stats(self) -> dict:
+        stats = {}
+        for table_name, index in self.indexes.items():
+            metrics = self.metrics[table_name]
+            hits = metrics["exact_hits"] + metrics["fuzzy_hits"]
+            stats[table_name] = {
+                **metrics,
+                "rows": len(index.choices),
+                "hit_rate": round(hits / metrics["lookups"], 3) if metrics["lookups"] else 0
+            }
+        return stats
 
-    if match and match[1] >= 85:
-        for row in rows:
-            if normalize(row[0]) == match[0]:
-                return {
-                    "matched_name": row[0],
-                    "kcal": row[1],
-                    "protein": row[2],
-                    "fat": row[3],
-                    "carb": row[4],
-                    "fiber": row[5]
-                }
-    return None
+product_catalogue = ProductCatalogue(PRODUCT_TABLES)
+
+async def watch_product_tables():
+    """
+    Фоновая задача: перезагружает индексы продуктов после изменения таблиц,
+    чистит просроченные сопоставления и пишет метрики поиска
+    """
+    while True:
+        await asyncio.sleep(PRODUCT_INDEX_REFRESH_INTERVAL)
+        await product_catalogue.refresh()
+        try:
+            await ingredient_cache.purge_expired()
+        except Exception as e:
+            logging.error(f"Ошибка очистки кэша сопоставлений: {e}")
+        product_logger.info(f"Справочник продуктов: {product_catalogue.stats()}")
+
+async def match_product_name_to_table(name: str, table_name: str) -> dict | None:
+    return await product_catalogue.match(name, table_name)
+
+async def match_product_names_to_table(names: list[str], table_name: str) -> list[tuple]:
+    """Пакетное сопоставление: (данные продукта или None, score) для каждого названия"""
+    return await product_catalogue.match_many(names, table_name)
+
+# Сколько живут записи кэша сопоставлений, по статусу
+INGREDIENT_CACHE_TTL = {
+    "db": timedelta(days=int(os.getenv("INGREDIENT_CACHE_DB_TTL_DAYS", "30"))),
+    "gpt": timedelta(days=int(os.getenv("INGREDIENT_CACHE_GPT_TTL_DAYS", "7"))),
+    "miss": timedelta(hours=int(os.getenv("INGREDIENT_CACHE_MISS_TTL_HOURS", "24"))),
+}
+# Сколько раз GPT должен оценить ингредиент, прежде чем отвечать накопленной оценкой без запроса к GPT
+GPT_ESTIMATE_MIN_OCCURRENCES = int(os.getenv("GPT_ESTIMATE_MIN_OCCURRENCES", "3"))
+
+def ingredient_key(name: str, branded: bool = False) -> str:
+    table_name = "productbrend" if branded else "products"
+    return f"{table_name}:{catalogue_key(name)}"
+
+class IngredientResolutionCache:
+    """
+    Двухуровневый кэш сопоставлений ингредиентов: LRU в памяти процесса
+    и таблица ingredient_resolution в Postgres. Хранит и найденные продукты,
+    и промахи (с оценкой GPT на 100 г, если она есть), каждое со своим TTL.
+    """
+
+    def __init__(self, limit: int = 2000):
+        self.local = LimitedCache(limit=limit)
+
+    async def get_many(self, keys) -> dict:
+        now = datetime.utcnow()
+        found = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            record = self.local.get(key)
+            if record and record["expires_at"] > now:
+                self.local.move_to_end(key)
+                found[key] = record
+            else:
+                missing.append(key)
+
+        if missing:
+            try:
+                async with async_session() as session:
+                    result = await session.execute(
+                        select(IngredientResolution).where(
+                            IngredientResolution.key.in_(missing),
+                            IngredientResolution.expires_at > now
+                        )
+                    )
+                    for row in result.scalars().all():
+                        record = {
+                            "status": row.status,
+                            "matched_name": row.matched_name,
+                            **{c: getattr(row, c) for c in NUTRITION_COLUMNS},
+                            "expires_at": row.expires_at
+                        }
+                        self.local[row.key] = record
+                        found[row.key] = record
+            except Exception as e:
+                logging.error(f"Ошибка чтения кэша сопоставлений: {e}")
+        return found
+
+    async def put_many(self, records: dict):
+        """records: ключ -> {"status", "matched_name", kcal/protein/fat/carb/fiber на 100 г}"""
+        if not records:
+            return
+        now = datetime.utcnow()
+        rows = []
+        for key, record in records.items():
+            record = {**record, "expires_at": now + INGREDIENT_CACHE_TTL[record["status"]]}
+            self.local[key] = record
+            rows.append({
+                "key": key,
+                "status": record["status"],
+                "matched_name": record.get("matched_name"),
+                **{c: record.get(c) for c in NUTRITION_COLUMNS},
+                "updated_at": now,
+                "expires_at": record["expires_at"]
+            })
+        try:
+            async with async_session() as session:
+                async with session.begin():
+                    stmt = pg_insert(IngredientResolution.__table__).values(rows)
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=["key"],
+                        set_={c: stmt.excluded[c] for c in ("status", "matched_name", *NUTRITION_COLUMNS, "updated_at", "expires_at")}
+                    )
+                    await session.execute(stmt)
+        except Exception as e:
+            logging.error(f"Ошибка записи в кэш сопоставлений: {e}")
+
+    async def invalidate_table(self, table_name: str):
+        """Сбрасывает сопоставления по таблице продуктов, если она изменилась"""
+        prefix = f"{table_name}:"
+        for key in [k for k in self.local if k.startswith(prefix)]:
+            del self.local[key]
+        async with async_session() as session:
+            async with session.begin():
+                await session.execute(
+                    delete(IngredientResolution).where(IngredientResolution.key.startswith(prefix))
+                )
+
+    async def purge_expired(self):
+        async with async_session() as session:
+            async with session.begin():
+                await session.execute(
+                    delete(IngredientResolution).where(IngredientResolution.expires_at <= datetime.utcnow())
+                )
+
+ingredient_cache = IngredientResolutionCache(limit=2000)
+
+def _scale_per_100g(name: str, grams, per_100g: dict) -> dict:
+    return {
+        "name": name,
+        "grams": grams,
+        "kcal": round((per_100g["kcal"] or 0) * grams / 100),
+        "protein": round((per_100g["protein"] or 0) * grams / 100, 1),
+        "fat": round((per_100g["fat"] or 0) * grams / 100, 1),
+        "carb": round((per_100g["carb"] or 0) * grams / 100, 1),
+        "fiber": round((per_100g["fiber"] or 0) * grams / 100, 1)
+    }
+
+async def resolve_food_items(items: list) -> tuple:
+    """
+    Находит КБЖУ ингредиентов: сначала в кэше сопоставлений, остальные —
+    одним пакетом в справочнике продуктов (результат, включая промахи, кэшируется).
+    Для ненайденных в справочнике используется накопленная оценка GPT, если она
+    набрала GPT_ESTIMATE_MIN_OCCURRENCES ответов, а до этого — последняя оценка GPT из кэша.
+
+    Args:
+        items: [{"name", "grams", "branded"}]
+
+    Returns:
+        tuple: (results — посчитанные позиции, not_found — позиции для расчёта через GPT,
+                estimated_names — брендовые позиции, посчитанные по оценке GPT)
+    """
+    keys = [ingredient_key(item["name"], item["branded"]) for item in items]
+    resolutions = await ingredient_cache.get_many(keys)
+
+    to_match = [item for item, key in zip(items, keys) if key not in resolutions]
+    if to_match:
+        matches = await match_food_items(to_match)
+        new_records = {}
+        for item in to_match:
+            matched = matches.get(item["name"])
+            if matched:
+                new_records[ingredient_key(item["name"], item["branded"])] = {"status": "db", **matched}
+            else:
+                new_records[ingredient_key(item["name"], item["branded"])] = {"status": "miss"}
+        await ingredient_cache.put_many(new_records)
+        resolutions.update(new_records)
+
+    estimates = await get_learned_estimates(
+        [catalogue_key(item["name"]) for item, key in zip(items, keys) if resolutions[key]["status"] != "db"]
+    )
+
+    results, not_found, estimated_names = [], [], set()
+    for item, key in zip(items, keys):
+        resolution = resolutions[key]
+        name, grams = item["name"], item["grams"]
+        estimate = estimates.get(catalogue_key(name))
+        if resolution["status"] == "db":
+            logging.info(f"[✅ Из БД] {resolution['matched_name']} — {grams} г")
+            results.append(_scale_per_100g(resolution["matched_name"], grams, resolution))
+        elif estimate:
+            logging.info(f"[♻️ Накопленная оценка GPT ×{estimate['occurrences']}] {name} — {grams} г")
+            results.append(_scale_per_100g(name, grams, estimate))
+            if item["branded"]:
+                estimated_names.add(name)
+        elif resolution["status"] == "gpt":
+            logging.info(f"[♻️ Сохранённая оценка GPT] {name} — {grams} г")
+            results.append(_scale_per_100g(name, grams, resolution))
+            if item["branded"]:
+                estimated_names.add(name)
+        else:
+            logging.warning(f"[❌ GPT сам считает] {name} — {grams} г")
+            not_found.append({"name": name, "grams": grams, "branded": item["branded"]})
+    return results, not_found, estimated_names
+
+async def get_learned_estimates(name_keys: list) -> dict:
+    """Накопленные оценки GPT (на 100 г), набравшие достаточно ответов: name_key -> запись"""
+    if not name_keys:
+        return {}
+    columns = ("name_key", "occurrences", *NUTRITION_COLUMNS)
+    try:
+        async with async_session() as session:
+            result = await session.execute(
+                select(*[getattr(IngredientEstimate, c) for c in columns]).where(
+                    IngredientEstimate.name_key.in_(set(name_keys)),
+                    IngredientEstimate.occurrences >= GPT_ESTIMATE_MIN_OCCURRENCES
+                )
+            )
+            return {row[0]: dict(zip(columns, row)) for row in result.all()}
+    except Exception as e:
+        logging.error(f"Ошибка чтения накопленных оценок GPT: {e}")
+        return {}
+
+async def remember_gpt_estimates(not_found: list, gpt_items: list):
+    """
+    Сохраняет ответ GPT для ненайденных ингредиентов: в кэш сопоставлений (status "gpt") —
+    чтобы следующий раз обойтись без GPT, и в накопленные оценки (скользящее среднее на 100 г)
+    """
+    # Сопоставляем только по названию: порядок позиций в ответе GPT не гарантирован,
+    # а позиции без пары не сохраняются
+    by_name = {catalogue_key(item.get("name") or ""): item for item in gpt_items}
+    pairs = [(item, by_name.get(catalogue_key(item["name"]))) for item in not_found]
+
+    observations, records = {}, {}
+    for item, estimate in pairs:
+        grams = (estimate or {}).get("grams") or item["grams"]
+        if not estimate or not grams:
+            continue
+        try:
+            per_100g = {c: float(estimate.get(c) or 0) * 100 / grams for c in NUTRITION_COLUMNS}
+        except (TypeError, ValueError):
+            continue
+        observations[catalogue_key(item["name"])] = per_100g
+        records[ingredient_key(item["name"], item["branded"])] = {
+            "status": "gpt", "matched_name": item["name"], **per_100g
+        }
+    if not observations:
+        return
+    await ingredient_cache.put_many(records)
+
+    table = IngredientEstimate.__table__
+    now = datetime.utcnow()
+    stmt = pg_insert(table).values([
+        {"name_key": name_key, "occurrences": 1, **values, "updated_at": now}
+        for name_key, values in observations.items()
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["name_key"],
+        set_={
+            "occurrences": table.c.occurrences + 1,
+            "updated_at": stmt.excluded.updated_at,
+            **{c: table.c[c] + (stmt.excluded[c] - table.c[c]) / (table.c.occurrences + 1) for c in NUTRITION_COLUMNS}
+        }
+    )
+    try:
+        async with async_session() as session:
+            async with session.begin():
+                await session.execute(stmt)
+    except Exception as e:
+        logging.error(f"Ошибка сохранения оценок GPT: {e}")
+
+async def match_food_items(food_items: list) -> dict:
+    """
+    Сопоставляет все ингредиенты одного ответа GPT с таблицами продуктов —
+    по одному пакетному вызову на таблицу (бренды / готовые продукты).
+
+    Returns:
+        dict: название ингредиента -> данные продукта или None
+    """
+    names_by_table = {}
+    for item in food_items:
+        table_name = "productbrend" if item.get("branded", False) else "products"
+        names_by_table.setdefault(table_name, []).append(item["name"])
+
+    matches = {}
+    for table_name, names in names_by_table.items():
+        for name, (payload, score) in zip(names, await match_product_names_to_table(names, table_name)):
+            matches[name] = payload
+    return matches
 
 # 🔍 Поиск в таблице без брендов
 async def match_product_name_to_ready_table(name: str) -> dict | None:
@@ -2429,6 +3706,8 @@ async def match_product_name_to_brand_table(name: str) -> dict | None:
 
 app = web.Application()
 app.router.add_get("/", handle_index)
+app.router.add_get("/catalogue/stats", handle_catalogue_stats)
+app.router.add_get("/images/stats", handle_image_pipeline_stats)
 app.router.add_post(WEBHOOK_PATH, handle_webhook)
 
 async def startup_wrapper(app):
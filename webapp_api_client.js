@@ -9,13 +9,36 @@ class TelegramBotApiClient {
     }
 
     /**
-     * Получение данных дневника питания пользователя
+     * Первый экран WebApp одним запросом
      * @param {string} userId - ID пользователя в Telegram
-     * @returns {Promise<Object>} - Данные дневника питания
+     * @param {string[]} sections - Разделы (profile, day_summary, diary_data, stats, favorites), по умолчанию все
+     * @returns {Promise<Object>} - Данные разделов по именам
      */
-    async getDiary(userId) {
+    async getBootstrap(userId, sections = null) {
         try {
-            const response = await this._fetchWithAuth(`${this.apiBaseUrl}/diary/${userId}`);
+            const query = sections ? `?sections=${encodeURIComponent(sections.join(','))}` : '';
+            const response = await this._fetchWithAuth(`${this.apiBaseUrl}/bootstrap/${userId}${query}`);
+            return response.data;
+        } catch (error) {
+            console.error('Ошибка при получении первого экрана:', error);
+            throw error;
+        }
+    }
+
+    /**
+     * Получение страницы дневника питания пользователя (от новых дней к старым)
+     * @param {string} userId - ID пользователя в Telegram
+     * @param {string} before - Курсор: next_before из предыдущей страницы (опционально)
+     * @param {number} limit - Сколько дней вернуть (опционально)
+     * @returns {Promise<Object>} - Данные дневника питания (days, next_before, has_more)
+     */
+    async getDiary(userId, before = null, limit = null) {
+        try {
+            const params = new URLSearchParams();
+            if (before) params.set('before', before);
+            if (limit) params.set('limit', limit);
+            const query = params.toString();
+            const response = await this._fetchWithAuth(`${this.apiBaseUrl}/diary/${userId}${query ? `?${query}` : ''}`);
             return response.data;
         } catch (error) {
             console.error('Ошибка при получении данных дневника:', error);